@@ -80,13 +80,14 @@ class BarterClient(AllChannelClient):
             self._logger.error("barter community not loaded")
         if candidate_id == 0:
             # Send a message to all candidate.
-            for c in self.all_vars.itervalues():
-                candidate = Candidate((str(c['host']), c['port']), False)
+            for peer_id in self.get_peers():
+                host, port = self.get_peer_ip_port_by_id(peer_id)
+                candidate = Candidate((str(host), port), False)
                 self._bccommunity.create_stats_request(candidate, BartercastStatisticTypes.TORRENTS_RECEIVED)
         else:
             # Send a message to a specific candidate.
-            target = self.all_vars[candidate_id]
-            candidate = Candidate((str(target['host']), target['port']), False)
+            host, port = self.get_peer_ip_port_by_id(candidate_id)
+            candidate = Candidate((str(host), port), False)
             self._bccommunity.create_stats_request(candidate, BartercastStatisticTypes.TORRENTS_RECEIVED)
 
     def close(self):
@@ -1,11 +1,20 @@
 import os
 import sys
-from random import expovariate, random
-from gumby.scenario import ScenarioRunner
+from gumby.scenario import PeerSet, ScenarioRunner
 from collections import defaultdict
 
 class ChurnAnalyzer(ScenarioRunner):
 
+    """
+    Replays the online, offline and add_friend actions of a scenario and writes, for every timestamp,
+    the average fraction of online friends of the peers that have friends (counted as 0 while the
+    peer itself is offline) and the amount of online peers. The output has one row per timestamp
+    with a "time online_friends online_peers" header, followed by the session averages as comments.
+
+    The amount of online friends of every peer is updated as the peers change state, so the cost
+    depends on the amount of state changes instead of on the amount of peers and friends.
+    """
+
     def __init__(self, filename, outputfile=sys.stdout, max_tstmp=sys.maxint):
         ScenarioRunner.__init__(self, filename)
 
@@ -14,8 +23,16 @@ class ChurnAnalyzer(ScenarioRunner):
         self._callables['offline'] = self.offline
         self._callables['add_friend'] = self.add_friend
 
-        self._peer_state = defaultdict(lambda: "offline")
+        self._peer_online = defaultdict(bool)
         self._peer_friends = defaultdict(list)
+        # friend -> peers that added it as a friend (once for every time they did)
+        self._friend_of = defaultdict(list)
+        # peer -> amount of its friends that are online
+        self._online_friends = defaultdict(int)
+        # amount of friends -> sum of the online friends of the online peers with that amount of
+        # friends. The average is computed from these integers, so it doesn't drift.
+        self._online_friends_by_degree = defaultdict(int)
+        self._nr_online = 0
 
         self._time_online = defaultdict(lambda :[0, 0, 0, 0])
         self._prev_online = defaultdict(int)
@@ -25,7 +42,6 @@ class ChurnAnalyzer(ScenarioRunner):
 
         sorted_scenario = defaultdict(list)
 
-        prev_tstmp = -1
         for (tstmp, lineno, clb, args) in self._parse_scenario(filename):
             if clb in self._callables and tstmp < max_tstmp:
                 sorted_scenario[tstmp].append((self.yes_peers, clb, args))
@@ -33,27 +49,40 @@ class ChurnAnalyzer(ScenarioRunner):
         tstmps = sorted_scenario.keys()
         tstmps.sort()
 
+        print >> outputfile, "time online_friends online_peers"
         for tstmp in tstmps:
             for yes_peers, clb, args in sorted_scenario[tstmp]:
                 for peer in yes_peers:
                     self._callables[clb](tstmp, peer, *args)
 
-                if prev_tstmp != tstmp:
-                    self.print_connections(tstmp, outputfile)
-                    prev_tstmp = tstmp
+            self.print_connections(tstmp, outputfile)
 
-        self.print_averages(outputfile, tstmps[-1])
+        if tstmps:
+            self.print_averages(outputfile, tstmps[-1])
 
     def _parse_for_this_peer(self, peerspec):
         if peerspec:
             self.yes_peers, self.no_peers = self._parse_peerspec(peerspec)
         else:
-            self.yes_peers = set()
-            self.no_peers = set()
+            self.yes_peers = PeerSet()
+            self.no_peers = PeerSet()
         return True
 
+    def _count_online_friends(self, peer, sign):
+        # Don't use self._peer_friends[peer], a peer without friends must not be added to it
+        if peer in self._peer_friends:
+            self._online_friends_by_degree[len(self._peer_friends[peer])] += sign * self._online_friends[peer]
+
     def online(self, tstmp, peer):
-        self._peer_state[peer] = "online"
+        if not self._peer_online[peer]:
+            self._peer_online[peer] = True
+            self._nr_online += 1
+            self._count_online_friends(peer, 1)
+            for friend_of in self._friend_of.get(peer, ()):
+                self._online_friends[friend_of] += 1
+                if self._peer_online[friend_of]:
+                    self._online_friends_by_degree[len(self._peer_friends[friend_of])] += 1
+
         self._prev_online[peer] = tstmp
 
         been_offline = tstmp - self._prev_offline[peer]
@@ -63,7 +92,15 @@ class ChurnAnalyzer(ScenarioRunner):
         self.max_offline = max(self.max_offline, been_offline)
 
     def offline(self, tstmp, peer):
-        self._peer_state[peer] = "offline"
+        if self._peer_online[peer]:
+            self._count_online_friends(peer, -1)
+            self._peer_online[peer] = False
+            self._nr_online -= 1
+            for friend_of in self._friend_of.get(peer, ()):
+                self._online_friends[friend_of] -= 1
+                if self._peer_online[friend_of]:
+                    self._online_friends_by_degree[len(self._peer_friends[friend_of])] -= 1
+
         self._prev_offline[peer] = tstmp
 
         been_online = tstmp - self._prev_online[peer]
@@ -73,27 +110,23 @@ class ChurnAnalyzer(ScenarioRunner):
         self.max_online = max(self.max_online, been_online)
 
     def add_friend(self, tstmp, peer, friend):
-        self._peer_friends[peer].append(int(friend))
+        friend = int(friend)
+        if self._peer_online[peer]:
+            self._count_online_friends(peer, -1)
 
-    def print_connections(self, tstmp, outputfile):
-        if len(self._peer_friends):
-            print >> outputfile, tstmp,
-
-            sum_can_connect_to = 0
-            for peer, friends in self._peer_friends.iteritems():
-                can_connect_to = 0
-                if self._peer_state[peer] == "online":
-                    for friend in friends:
-                        if self._peer_state[friend] == "online":
-                            can_connect_to += 1
-
-                    if len(friends):
-                        can_connect_to /= float(len(friends))
+        self._peer_friends[peer].append(friend)
+        self._friend_of[friend].append(peer)
+        if self._peer_online[friend]:
+            self._online_friends[peer] += 1
 
-                # print >> outputfile, peer, can_connect_to,
-                sum_can_connect_to += can_connect_to
+        if self._peer_online[peer]:
+            self._count_online_friends(peer, 1)
 
-            print >> outputfile, "average", sum_can_connect_to / float(len(self._peer_friends))
+    def print_connections(self, tstmp, outputfile):
+        if len(self._peer_friends):
+            sum_can_connect_to = sum(online_friends / float(degree)
+                                     for degree, online_friends in self._online_friends_by_degree.iteritems())
+            print >> outputfile, tstmp, sum_can_connect_to / len(self._peer_friends), self._nr_online
 
     def print_averages(self, outputfile, max_tstmp):
         online_time = offline_time = 0
@@ -109,9 +142,9 @@ class ChurnAnalyzer(ScenarioRunner):
             ave_off_sessions += nr_off_sessions
             nr_peers += 1
 
-        print >> outputfile, "average online", online_time / float(nr_peers), "offline", offline_time / float(nr_peers), nr_peers
-        print >> outputfile, "average online", ave_on_sessions / float(nr_peers), "offline", ave_off_sessions / float(nr_peers), nr_peers
-        print >> outputfile, "max online", self.max_online, "offline", self.max_offline
+        print >> outputfile, "# average online", online_time / float(nr_peers), "offline", offline_time / float(nr_peers), nr_peers
+        print >> outputfile, "# average online", ave_on_sessions / float(nr_peers), "offline", ave_off_sessions / float(nr_peers), nr_peers
+        print >> outputfile, "# max online", self.max_online, "offline", self.max_offline
 
 def main(inputfile, outputfile, max_tstmp=sys.maxint):
     inputfile = os.path.abspath(inputfile)
@@ -44,7 +44,10 @@ from sys import path as pythonpath
 from hashlib import sha1
 
 from gumby.experiments.dispersyclient import DispersyExperimentScriptClient, main, buffer_online
+from gumby.scenario import EXECUTE_IN_THREAD
 
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from twisted.python.log import msg
 
 # TODO(emilon): Fix this crap
@@ -85,7 +88,8 @@ class SocialClient(DispersyExperimentScriptClient):
 
     def registerCallbacks(self):
         self.scenario_runner.register(self.insert_my_key, 'insert_my_key')
-        self.scenario_runner.register(self.add_friend, 'add_friend')
+        # Decoding the keys of all the friends at once blocks the reactor for too long
+        self.scenario_runner.register(self.add_friend, 'add_friend', EXECUTE_IN_THREAD)
         self.scenario_runner.register(self.add_foaf, 'add_foaf')
         self.scenario_runner.register(self.connect_to_friends, 'connect_to_friends')
         self.scenario_runner.register(self.set_community_class, 'set_community_class')
@@ -159,33 +163,41 @@ class SocialClient(DispersyExperimentScriptClient):
         self._community._mypref_db.addMyPreference(keyhash, {})
         self._community._friend_db.add_my_key(key, keyhash)
 
-    @buffer_online
     def add_friend(self, peer_id):
+        """
+        Runs in the scenario thread pool: only reads the vars of the friend and decodes its key, the
+        friend is stored by store_friend() on the reactor thread.
+        """
         if peer_id != self.my_id:
             peer_id = int(peer_id)
 
             # if we don't get the ipport, then this peer isn't deployed to the das
             ipport = self.get_peer_ip_port_by_id(peer_id)
-            key = self.get_private_keypair_by_id(peer_id)
+            peer_vars = self.get_peer_vars(peer_id)
 
-            if ipport and key:
-                key = key.pub()
+            if ipport and peer_vars:
+                # Not through get_private_keypair_by_id(), its cache of decoded keys isn't thread safe
+                key = self._decode_private_keypair(peer_vars['private_keypair']).pub()
                 keyhash = self._crypto.key_to_hash(key)
                 keyhash_as_long = long(sha1(self._crypto.key_to_bin(key)).hexdigest(), 16)
-                self._community._mypref_db.addMyPreference(keyhash_as_long, {})
-                self._community._friend_db.add_friend(str(peer_id), key, keyhash_as_long)
-
-                self.friends.add(keyhash)
-                self.friendhashes[peer_id] = keyhash_as_long
-                self.friendiphashes[ipport] = keyhash_as_long
-
-                if not self.monitor_friends_lc:
-                    self.monitor_friends_lc = lc = LoopingCall(self.monitor_friends)
-                    lc.start(5.0, now=True)
+                reactor.callFromThread(self.store_friend, peer_id, ipport, key, keyhash, keyhash_as_long)
 
             elif ipport:
                 print >> sys.stderr, "Got ip/port, but not key?", peer_id
 
+    @buffer_online
+    def store_friend(self, peer_id, ipport, key, keyhash, keyhash_as_long):
+        self._community._mypref_db.addMyPreference(keyhash_as_long, {})
+        self._community._friend_db.add_friend(str(peer_id), key, keyhash_as_long)
+
+        self.friends.add(keyhash)
+        self.friendhashes[peer_id] = keyhash_as_long
+        self.friendiphashes[ipport] = keyhash_as_long
+
+        if not self.monitor_friends_lc:
+            self.monitor_friends_lc = lc = LoopingCall(self.monitor_friends)
+            lc.start(5.0, now=True)
+
     @buffer_online
     def add_foaf(self, peer_id, his_friends):
         if peer_id != self.my_id:
@@ -0,0 +1,209 @@
+# commandoutput.py ---
+#
+# Filename: commandoutput.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 18:12:06 2026 (+0200)
+
+# Commentary:
+#
+# Handling of the output of the commands spawned by the runner, local or through SSH.
+#
+# * LineDecoder splits the chunks of a stream into lines incrementally: every byte is only looked at
+#   once, and a line that grows past max_length is passed on in pieces instead of being buffered.
+# * LineForwarder logs the lines, optionally rate limited (at most rate lines per second) and/or
+#   sampled (one of every sample lines). The amount of lines that weren't logged is reported.
+# * CommandOutput puts them together for a stream of a command, and can spool the raw output to a
+#   file per command so nothing is lost when the logging is limited.
+#
+# The limits and the spool directory are shared by all the commands, see setOutputOptions().
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import re
+from itertools import count
+from os import makedirs, path
+from time import time
+
+# Longest line kept in memory, longer ones are passed on in pieces of this size
+MAX_LINE_LENGTH = 64 * 1024
+
+_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^A-Za-z0-9_.-]+")
+
+_options = {'rate': 0, 'sample': 1, 'spool_dir': None}
+_spool_numbers = count(1)
+
+
+def setOutputOptions(rate=0, sample=1, spool_dir=None):
+    """
+    Sets how the output of the commands created from now on is handled: at most rate lines per second
+    are logged (0 is unlimited), only one of every sample lines is logged, and the raw output is
+    written to a file per command and stream in spool_dir (None doesn't spool it).
+    """
+    if spool_dir and not path.isdir(spool_dir):
+        makedirs(spool_dir)
+    _options.update(rate=rate, sample=max(sample, 1), spool_dir=spool_dir)
+
+
+class LineDecoder(object):
+
+    def __init__(self, lineReceived, max_length=MAX_LINE_LENGTH):
+        self._lineReceived = lineReceived
+        self._max_length = max_length
+        # The pieces of the line being received
+        self._partial = []
+        self._partial_length = 0
+        # A chunk ended with \r, so a \n at the start of the next one belongs to the same line break
+        self._skip_lf = False
+
+    def dataReceived(self, data):
+        if not data:
+            return
+        if self._skip_lf and data[0] == '\n':
+            data = data[1:]
+        self._skip_lf = data.endswith('\r')
+
+        lines = _LINE_BREAK.split(data)
+        last = lines.pop()
+        if lines:
+            if self._partial:
+                self._partial.append(lines[0])
+                lines[0] = ''.join(self._partial)
+                self._partial = []
+                self._partial_length = 0
+            for line in lines:
+                self._lineReceived(line)
+
+        if last:
+            self._partial.append(last)
+            self._partial_length += len(last)
+            if self._partial_length > self._max_length:
+                partial = ''.join(self._partial)
+                cut = len(partial) - len(partial) % self._max_length
+                for start in xrange(0, cut, self._max_length):
+                    self._lineReceived(partial[start:start + self._max_length])
+                self._partial = [partial[cut:]] if cut < len(partial) else []
+                self._partial_length = len(partial) - cut
+
+    def close(self):
+        """
+        Passes on the last line if it didn't end with a line break.
+        """
+        if self._partial:
+            self._lineReceived(''.join(self._partial))
+            self._partial = []
+            self._partial_length = 0
+
+
+class LineForwarder(object):
+
+    def __init__(self, logger, msg, args=(), rate=0, sample=1, clock=time):
+        """
+        Logs every line with logger.info(msg, *(args + (line,))), limited to rate lines per second and
+        one of every sample lines.
+        """
+        self._logger = logger
+        self._msg = msg
+        self._args = tuple(args)
+        self._rate = rate
+        self._sample = sample
+        self._clock = clock
+
+        self._lines = 0
+        self._skipped = 0
+        self._second = None
+        self._logged_this_second = 0
+
+    def __call__(self, line):
+        self._lines += 1
+        if self._sample > 1 and (self._lines - 1) % self._sample:
+            self._skipped += 1
+            return
+
+        if self._rate:
+            second = int(self._clock())
+            if second != self._second:
+                self._reportSkipped()
+                self._second = second
+                self._logged_this_second = 0
+            if self._logged_this_second >= self._rate:
+                self._skipped += 1
+                return
+            self._logged_this_second += 1
+
+        self._logger.info(self._msg, *(self._args + (line.rstrip(),)))
+
+    def _reportSkipped(self):
+        if self._skipped:
+            self._logger.info(self._msg, *(self._args + ("(%d lines not logged)" % self._skipped,)))
+            self._skipped = 0
+
+    def close(self):
+        self._reportSkipped()
+
+
+class CommandOutput(object):
+
+    """
+    A stream of the output of a command: logged line by line, and spooled if setOutputOptions() enabled it.
+    """
+
+    def __init__(self, logger, msg, args, name, stream):
+        self._closed = False
+        self._forwarder = LineForwarder(logger, msg, args, _options['rate'], _options['sample'])
+        self._decoder = LineDecoder(self._forwarder)
+
+        # The spool file is only created once there is some output
+        self._spool = None
+        self._spool_filename = None
+        if _options['spool_dir']:
+            filename = "%04d_%s.%s.log" % (next(_spool_numbers), _UNSAFE_FILENAME_CHARS.sub('_', name)[:100], stream)
+            self._spool_filename = path.join(_options['spool_dir'], filename)
+
+    def dataReceived(self, data):
+        if self._closed:
+            # The remaining output was already logged, and the spool file closed
+            return
+        if self._spool_filename:
+            if not self._spool:
+                self._spool = open(self._spool_filename, 'ab')
+            self._spool.write(data)
+        self._decoder.dataReceived(data)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._decoder.close()
+        self._forwarder.close()
+        if self._spool:
+            self._spool.close()
+        self._spool = self._spool_filename = None
+
+#
+# commandoutput.py ends here
@@ -1,16 +1,161 @@
 import os
 import sys
-from random import expovariate, random, randint
-from gumby.scenario import ScenarioRunner
+from itertools import chain, imap
+from math import log
+from multiprocessing import Pool, cpu_count
+from random import Random
+from gumby.scenario import PeerSet, ScenarioRunner
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Amount of peers generated by each task of the process pool
+PEERS_PER_SHARD = 50
+
+
+def peer_random(seed, lineno, peer):
+    """
+    Returns the random generator of a peer for the churn line at lineno.
+
+    Every peer gets its own generator, so the output doesn't depend on how the peers are sharded.
+    Python seeds the Mersenne Twister with the 32 bit words of a number and NumPy with an array of
+    them, so both generate exactly the same numbers.
+    """
+    if numpy is not None:
+        return numpy.random.RandomState([seed & 0xffffffff, lineno, peer])
+    return Random((seed & 0xffffffff) + (lineno << 32) + (peer << 64))
+
+
+def uniforms(rng, count):
+    if numpy is not None:
+        return rng.random_sample(count)
+    return [rng.random() for _ in xrange(count)]
+
+
+def accumulate(tstmp, delays):
+    """
+    Returns tstmp followed by the running sums of tstmp and delays, added one by one as a loop would.
+    """
+    if numpy is not None:
+        return numpy.cumsum(numpy.concatenate(([tstmp], delays)))
+    times = [tstmp]
+    for delay in delays:
+        tstmp += delay
+        times.append(tstmp)
+    return times
+
+
+def concatenate(chunks):
+    if numpy is not None:
+        return numpy.concatenate(chunks)
+    return list(chain(*chunks))
+
+
+def before(times, max_tstmp):
+    """
+    Returns the times (sorted) lower than max_tstmp.
+    """
+    if numpy is not None:
+        return times[:numpy.searchsorted(times, max_tstmp)]
+    return [tstmp for tstmp in times if tstmp < max_tstmp]
+
+
+def churn(rng, tstmp, max_tstmp, churn_type, desired_mean=300, min_online=5.0):
+    """
+    Returns the times at which a peer goes online or offline, and the state it goes to at each of them.
+    """
+    desired_mean = float(desired_mean)
+    min_online = float(min_online)
+
+    go_online = uniforms(rng, 1)[0] < 0.5
+    if churn_type == 'expon':
+        lambd = 1.0 / (desired_mean - min_online)
+
+        # Draw the delays in chunks until they get past max_tstmp
+        chunks = [[tstmp]]
+        while chunks[-1][-1] < max_tstmp:
+            count = int((max_tstmp - chunks[-1][-1]) / desired_mean * 1.2) + 16
+            if numpy is not None:
+                delays = min_online + -numpy.log(1.0 - uniforms(rng, count)) / lambd
+            else:
+                delays = [min_online + -log(1.0 - u) / lambd for u in uniforms(rng, count)]
+            chunks.append(accumulate(chunks[-1][-1], delays)[1:])
+        times = before(concatenate(chunks), max_tstmp)
+
+    elif churn_type == 'fixed':
+        # The first delay is random.randint(min_online, desired_mean)
+        low, high = int(min_online), int(desired_mean) + 1
+        if low != min_online or high != desired_mean + 1 or high <= low:
+            raise ValueError("invalid range for fixed churn: %s-%s" % (min_online, desired_mean))
+
+        first = low + int(uniforms(rng, 1)[0] * (high - low))
+        count = int((max_tstmp - tstmp - first) / desired_mean) + 2 if max_tstmp > tstmp else 0
+        times = before(accumulate(tstmp, [first] + [desired_mean] * count), max_tstmp)
+
+    else:
+        raise NotImplementedError('only expon churn is implemented, got %s' % churn_type)
+
+    return times, [go_online == (i % 2 == 0) for i in xrange(len(times))]
+
+
+def churn_pattern(rng, tstmp, max_tstmp, pattern, min_online=5.0):
+    """
+    Returns the times at which a peer goes online or offline, and the state it goes to at each of them.
+    Pattern has the chance (in %) of being online for each min_online period, and is repeated as needed.
+    """
+    pattern = [online / 100.0 for online in map(float, pattern.split(','))]
+    min_online = float(min_online)
+
+    count = int((max_tstmp - tstmp) / min_online) + 1 if max_tstmp > tstmp else 0
+    times = before(accumulate(tstmp, [min_online] * count), max_tstmp)
+    chances = uniforms(rng, len(times))
+
+    if numpy is not None:
+        if not len(times):
+            return times, []
+        online = chances < numpy.resize(pattern, len(times))
+        changes = numpy.flatnonzero(numpy.concatenate(([True], online[1:] != online[:-1])))
+        return times[changes], online[changes].tolist()
+
+    changed_times = []
+    states = []
+    prev_state = None
+    for i, tstmp in enumerate(times):
+        go_online = chances[i] < pattern[i % len(pattern)]
+        if go_online != prev_state:
+            changed_times.append(tstmp)
+            states.append(go_online)
+            prev_state = go_online
+    return changed_times, states
+
+
+CHURN_GENERATORS = {'churn': churn,
+                    'churn_pattern': churn_pattern}
+
+
+def generate_shard(task):
+    """
+    Generates the scenario lines of a churn line for a shard of peers, returns them as a single string.
+    """
+    clb, tstmp, max_tstmp, args, lineno, seed, peers = task
+    lines = []
+    for peer in peers:
+        times, states = CHURN_GENERATORS[clb](peer_random(seed, lineno, peer), tstmp, max_tstmp, *args)
+        # Truncated like "%d" does
+        times = times.astype(numpy.int64).tolist() if numpy is not None else map(int, times)
+        endings = (" offline {%s}\n" % peer, " online {%s}\n" % peer)
+        lines.extend(["@0:" + str(time) + endings[online] for time, online in zip(times, states)])
+    return "".join(lines)
+
 
 class ScenarioPreProcessor(ScenarioRunner):
 
-    def __init__(self, filename, outputfile=sys.stdout, max_tstmp=0):
+    def __init__(self, filename, outputfile=sys.stdout, max_tstmp=0, seed=0, processes=None):
         ScenarioRunner.__init__(self, filename)
 
-        self._callables = {}
-        self._callables['churn'] = self.churn
-        self._callables['churn_pattern'] = self.churn_pattern
+        self._callables = CHURN_GENERATORS
 
         print >> sys.stderr, "Looking for max_timestamp, max_peer... in %s" % filename,
 
@@ -20,77 +165,52 @@ class ScenarioPreProcessor(ScenarioRunner):
 
         print >> sys.stderr, "\tfound %d and %d" % (max_tstmp, self.max_peer)
 
-        _max_peer = self.max_peer
-        print >> sys.stderr, "Preprocessing file...",
-        for (tstmp, lineno, clb, args) in self._parse_scenario(filename):
-
-            print >> outputfile, self.file_buffer[1][lineno - 1][1]
-            if clb in self._callables:
-                for peer in self.yes_peers:
-                    for line in self._callables[clb](tstmp, max_tstmp, *args):
-                        print >> outputfile, line, '{%s}' % peer
-        print >> sys.stderr, "\tdone"
+        processes = processes or cpu_count()
+        pool = Pool(processes) if processes > 1 else None
+        try:
+            print >> sys.stderr, "Preprocessing file...",
+            for lineno, line in self._read_scenario(filename):
+                cmd = self._parse_scenario_line(*self._split_line(lineno, line))
+                if cmd is None:
+                    continue
+
+                outputfile.write(line + "\n")
+                tstmp, lineno, clb, args = cmd
+                if clb in self._callables:
+                    peers = list(self.yes_peers)
+                    tasks = [(clb, tstmp, max_tstmp, args, lineno, seed, peers[i:i + PEERS_PER_SHARD])
+                             for i in xrange(0, len(peers), PEERS_PER_SHARD)]
+                    # The shards are written in order, so the output doesn't depend on the amount of processes
+                    for lines in (pool.imap(generate_shard, tasks) if pool else imap(generate_shard, tasks)):
+                        outputfile.write(lines)
+            print >> sys.stderr, "\tdone"
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
 
     def _parse_for_this_peer(self, peerspec):
         if peerspec:
             self.yes_peers, self.no_peers = self._parse_peerspec(peerspec)
-            self.max_peer = max(self.max_peer, max(self.yes_peers))
+            self.max_peer = max(self.max_peer, self.yes_peers.max_peer)
         else:
-            self.yes_peers = set()
-            self.no_peers = set()
+            self.yes_peers = PeerSet()
+            self.no_peers = PeerSet()
 
         if not self.yes_peers:
-            self.yes_peers = set(range(1, self.max_peer + 1))
-        for peer in self.no_peers:
-            self.yes_peers.discard(peer)
+            self.yes_peers = PeerSet([(1, self.max_peer)])
+        if self.no_peers:
+            self.yes_peers = self.yes_peers.difference(self.no_peers)
 
         return True
 
-    def churn(self, tstmp, max_tstmp, churn_type, desired_mean=300, min_online=5.0):
-        desired_mean = float(desired_mean)
-        min_online = float(min_online)
-
-        def get_delay(step):
-            if churn_type == 'expon':
-                return min_online + expovariate(1.0 / (desired_mean - min_online))
-            elif churn_type == 'fixed':
-                if step == 1:
-                    return randint(min_online, desired_mean)
-                return desired_mean
-            else:
-                raise NotImplementedError('only expon churn is implemented, got %s' % churn_type)
-
-        go_online = random() < 0.5
-        step = 1
-        while tstmp < max_tstmp:
-            yield "@0:%d %s" % (tstmp, "online" if go_online else "offline")
-            tstmp += get_delay(step)
-            go_online = not go_online
-            step += 1
-
-    def churn_pattern(self, tstmp, max_tstmp, pattern, min_online=5.0):
-        pattern = [online / 100.0 for online in map(float, pattern.split(','))]
-        min_online = float(min_online)
-
-        i = 0
-        prev_state = None
-        while tstmp < max_tstmp:
-            go_online = random() < pattern[i]
-            i = (i + 1) % len(pattern)
-
-            if go_online != prev_state:
-                yield "@0:%d %s" % (tstmp, "online" if go_online else "offline")
-                prev_state = go_online
-
-            tstmp += min_online
-
 
-def main(inputfile, outputfile, maxtime=0):
+def main(inputfile, outputfile, maxtime=0, seed=0):
     inputfile = os.path.abspath(inputfile)
     if os.path.exists(inputfile):
         f = open(outputfile, 'w')
 
-        ScenarioPreProcessor(inputfile, f, maxtime)
+        ScenarioPreProcessor(inputfile, f, maxtime, seed)
 
         f.close()
     else:
@@ -98,12 +218,14 @@ def main(inputfile, outputfile, maxtime=0):
 
 if __name__ == '__main__':
     if len(sys.argv) < 3:
-        print "Usage: %s <input-file> <output-file> (<max-time>)" % (sys.argv[0])
+        print "Usage: %s <input-file> <output-file> (<max-time>) (<seed>)" % (sys.argv[0])
         print >> sys.stderr, sys.argv
 
         exit(1)
 
-    if len(sys.argv) == 4:
+    if len(sys.argv) == 5:
+        main(sys.argv[1], sys.argv[2], float(sys.argv[3]), int(sys.argv[4]))
+    elif len(sys.argv) == 4:
         main(sys.argv[1], sys.argv[2], float(sys.argv[3]))
     else:
         main(sys.argv[1], sys.argv[2])
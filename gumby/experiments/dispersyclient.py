@@ -42,13 +42,14 @@ import json
 import logging
 from collections import Iterable, defaultdict
 from os import chdir, environ, getpid, makedirs, path, symlink
-from random import random
 from sys import exit, stderr, stdout
+from tempfile import gettempdir
 from time import time
 from traceback import print_exc
 
 from gumby.log import setupLogging
 from gumby.scenario import ScenarioRunner
+from gumby.scenariotrace import TRACE_FILENAME
 from gumby.sync import ExperimentClient, ExperimentClientFactory
 
 from twisted.internet import reactor
@@ -81,16 +82,24 @@ class DispersyExperimentScriptClient(ExperimentClient):
         self._online_buffer = []
 
         self._crypto = self.initializeCrypto()
+
+    def onAdmitted(self):
+        # Only generate the member once admitted, not for every connection attempt rejected with retry:
         self.generateMyMember()
         self.vars['private_keypair'] = base64.encodestring(self.my_member_private_key)
+        return ExperimentClient.onAdmitted(self)
 
     def onVarsSend(self):
         scenario_file_path = path.join(environ['EXPERIMENT_DIR'], self.scenario_file)
-        self.scenario_runner = ScenarioRunner(scenario_file_path)
+        # @CONF_OPTION SCENARIO_INDEX_DIR: Dir where the scenario is compiled to, so every instance only loads its own actions. (default is the system temp dir)
+        # @CONF_OPTION SCENARIO_THREAD_POOL_SIZE: Max amount of threads running the scenario actions registered to be executed in a thread. (default is 4)
+        self.scenario_runner = ScenarioRunner(scenario_file_path,
+                                              index_dir=environ.get('SCENARIO_INDEX_DIR', gettempdir()),
+                                              thread_pool_size=int(environ.get('SCENARIO_THREAD_POOL_SIZE', 4)))
 
         t1 = time()
-        self.scenario_runner._read_scenario(scenario_file_path)
-        self._logger.debug('Took %.2f to read scenario file', time() - t1)
+        self.scenario_runner.compile_index()
+        self._logger.debug('Took %.2f to compile scenario file', time() - t1)
 
     def onIdReceived(self):
         self._logger.debug('Got ID %s assigned', self.my_id)
@@ -112,6 +121,11 @@ class DispersyExperimentScriptClient(ExperimentClient):
         self.scenario_runner.register(self.reset_dispersy_statistics, 'reset_dispersy_statistics')
         self.scenario_runner.register(self.annotate)
         self.scenario_runner.register(self.peertype)
+        self.scenario_runner.register(self.enter_barrier, 'barrier')
+        self.scenario_runner.register(self.wait_barrier)
+        # Not registered as publish, some of the clients already have a publish action
+        self.scenario_runner.register(self.publish_value)
+        self.scenario_runner.register(self.wait_value)
 
         self.registerCallbacks()
 
@@ -129,6 +143,10 @@ class DispersyExperimentScriptClient(ExperimentClient):
         chdir(my_dir)
         self._stats_file = open("statistics.log", 'w')
 
+        # @CONF_OPTION SCENARIO_TRACE: Write a trace of the scenario actions run by every instance next to its statistics.log, to be summarized with summarize_scenario_traces.py. (default is false)
+        if environ.get('SCENARIO_TRACE', 'false').lower() == 'true':
+            self.scenario_runner.trace_to(path.join(my_dir, TRACE_FILENAME))
+
         # TODO(emilon): Fix me or kill me
         try:
             bootstrap_fn = path.join(environ['PROJECT_DIR'], 'tribler', 'bootstraptribler.txt')
@@ -329,28 +347,52 @@ class DispersyExperimentScriptClient(ExperimentClient):
     def peertype(self, peertype):
         self._stats_file.write('%.1f %s %s %s\n' % (time(), self.my_id, "peertype", peertype))
 
+    # The following actions need SYNC_PERSISTENT to be enabled.
+
+    def enter_barrier(self, name):
+        """
+        Example: '@0:100 barrier downloads_done'
+        """
+        self.barrier(name).addCallback(lambda _: self.annotate("barrier %s released" % name))
+
+    def wait_barrier(self, name, action, *args):
+        """
+        Runs action once all the instances reached the barrier.
+        Example: '@0:100 wait_barrier downloads_done stop'
+        """
+        clb = self.scenario_runner.get_callable(action)
+        self.barrier(name).addCallback(lambda _: clb(*args))
+
+    def publish_value(self, key, value):
+        """
+        Example: '@0:50 publish_value seeder_ready 1'
+        """
+        self.publish_sync_value(key, value)
+
+    def wait_value(self, key, action, *args):
+        """
+        Runs action once any instance published a value for key.
+        Example: '@0:100 wait_value seeder_ready start_download'
+        """
+        clb = self.scenario_runner.get_callable(action)
+        self.wait_for_value(key).addCallback(lambda _: clb(*args))
+
     #
     # Aux. functions
     #
 
 
     def get_private_keypair_by_id(self, peer_id):
-        if str(peer_id) in self.all_vars:
-            key = self.all_vars[str(peer_id)]['private_keypair']
-            if isinstance(key, basestring):
-                key = self.all_vars[str(peer_id)]['private_keypair'] = self._crypto.key_from_private_bin(base64.decodestring(key))
-            return key
+        return self.peer_directory.get_key(peer_id, self._decode_private_keypair)
 
-    def get_private_keypair(self, ip, port):
-        port = int(port)
-        for peer_dict in self.all_vars.itervalues():
-            if peer_dict['host'] == ip and int(peer_dict['port']) == port:
-                key = peer_dict['private_keypair']
-                if isinstance(key, basestring):
-                    key = peer_dict['private_keypair'] = self._crypto.key_from_private_bin(base64.decodestring(key))
-                return key
+    def _decode_private_keypair(self, key):
+        return self._crypto.key_from_private_bin(base64.decodestring(key))
 
-        err("Could not get_private_keypair for", ip, port)
+    def get_private_keypair(self, ip, port):
+        # get_peer_id already logs the unknown peers
+        peer_id = self.get_peer_id(ip, port)
+        if peer_id is not None:
+            return self.get_private_keypair_by_id(peer_id)
 
     def str2bool(self, v):
         return v.lower() in ("yes", "true", "t", "1")
@@ -416,6 +458,8 @@ class DispersyExperimentScriptClient(ExperimentClient):
         prev_endpoint_send = {}
         prev_created_messages = {}
         prev_bootstrap_candidates = {}
+        prev_scenario_lag = {}
+        prev_scenario_actions = {}
 
         while True:
             self._dispersy.statistics.update()
@@ -498,6 +542,8 @@ class DispersyExperimentScriptClient(ExperimentClient):
             prev_total_fail = self.print_on_change("statistics-walk-fail", prev_total_fail, self._dispersy.statistics.walk_failure_dict)
             prev_endpoint_recv = self.print_on_change("statistics-endpoint-recv", prev_endpoint_recv, self._dispersy.statistics.endpoint_recv)
             prev_endpoint_send = self.print_on_change("statistics-endpoint-send", prev_endpoint_send, self._dispersy.statistics.endpoint_send)
+            prev_scenario_lag = self.print_on_change("scenario-lag", prev_scenario_lag, self.scenario_runner.get_lag_stats())
+            prev_scenario_actions = self.print_on_change("scenario-actions", prev_scenario_actions, self.scenario_runner.get_action_stats())
 
             yield deferLater(reactor, 5.0, lambda : None)
 
@@ -506,12 +552,23 @@ def main(client_class):
     from gumby.instrumentation import init_instrumentation
     init_instrumentation()
     setupLogging()
+    # @CONF_OPTION SYNC_USE_PEER_TABLE: Read the peer vars from the node-local table written by the sync relay instead of keeping a copy in every instance. (default is false)
+    if environ.get('SYNC_USE_PEER_TABLE', 'false').lower() == 'true':
+        client_class.use_peer_table = True
+    # @CONF_OPTION SYNC_MAX_CACHED_KEYS: Max amount of decoded peer keys each instance keeps in memory. (default is unlimited)
+    if environ.get('SYNC_MAX_CACHED_KEYS'):
+        client_class.max_cached_keys = int(environ['SYNC_MAX_CACHED_KEYS'])
+    # @CONF_OPTION SYNC_PERSISTENT: Keep the connection with the experiment server open during the experiment so the barrier, wait_barrier, publish_value and wait_value actions can be used. (default is false)
+    if environ.get('SYNC_PERSISTENT', 'false').lower() == 'true':
+        client_class.persistent_sync = True
+    # @CONF_OPTION SYNC_HEARTBEAT_INTERVAL: Send a heartbeat to the experiment server every this amount of seconds during the experiment, so it can abort it if too many instances are lost. (float, default is no heartbeats)
+    if environ.get('SYNC_HEARTBEAT_INTERVAL'):
+        client_class.heartbeat_interval = float(environ['SYNC_HEARTBEAT_INTERVAL'])
     factory = ExperimentClientFactory({}, client_class)
     logger = logging.getLogger()
     logger.debug("Connecting to: %s:%s", environ['SYNC_HOST'], int(environ['SYNC_PORT']))
-    # Wait for a random amount of time before connecting to try to not overload the server when we have a lot of connections
-    reactor.callLater(random() * 10,
-                      lambda: reactor.connectTCP(environ['SYNC_HOST'], int(environ['SYNC_PORT']), factory))
+    # The experiment server will tell us when to retry if it is too busy to take our connection right now
+    reactor.connectTCP(environ['SYNC_HOST'], int(environ['SYNC_PORT']), factory)
     reactor.exitCode = 0
     reactor.run()
     exit(reactor.exitCode)
@@ -0,0 +1,117 @@
+# peerdirectory.py ---
+#
+# Filename: peerdirectory.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sat Oct 17 18:05:12 2026 (+0200)
+
+# Commentary:
+#
+# Indexed access to the vars of the experiment peers received from the sync server.
+#
+# The directory is built once when the vars arrive and keeps an index by id and by (host, port),
+# so mapping an incoming candidate back to a peer id doesn't need to scan all the peers. Keys
+# decoded from the peer vars are cached, optionally evicting the least recently used ones.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from collections import OrderedDict
+
+
+class PeerDirectory(object):
+
+    """
+    Looks up peers by id or address. The records can come from a dict of id -> vars (as found in
+    the all_vars document) or from a node-local PeerTable, which is already indexed.
+
+    If max_cached_keys is set, only that many decoded keys will be kept around.
+    """
+
+    def __init__(self, records=None, peer_table=None, peer_count=None, max_cached_keys=None):
+        self._records = {}
+        self._addresses = {}
+        self._peer_table = peer_table
+        self._peer_count = peer_count
+
+        self._keys = OrderedDict()
+        self._max_cached_keys = max_cached_keys
+
+        if records:
+            self.update(records)
+
+    def update(self, records):
+        for peer_id, peer_vars in records.iteritems():
+            peer_id = str(peer_id)
+            self._records[peer_id] = peer_vars
+            self._addresses[(peer_vars['host'], int(peer_vars['port']))] = peer_id
+
+    def get_ids(self):
+        if self._peer_table:
+            return self._peer_table.get_ids()
+        if self._peer_count is not None:
+            # Only some of the records are known when looking up the peers on demand
+            return [str(peer_id) for peer_id in xrange(1, self._peer_count + 1)]
+        return self._records.keys()
+
+    def get_id(self, host, port):
+        if self._peer_table:
+            return self._peer_table.get_id(host, port)
+        return self._addresses.get((host, int(port)))
+
+    def get_address(self, peer_id):
+        if self._peer_table:
+            return self._peer_table.get_address(peer_id)
+        peer_vars = self._records.get(str(peer_id))
+        if peer_vars:
+            return peer_vars['host'], peer_vars['port']
+
+    def get_vars(self, peer_id):
+        if self._peer_table:
+            return self._peer_table.get_vars(peer_id)
+        return self._records.get(str(peer_id))
+
+    def get_key(self, peer_id, decoder, var='private_keypair'):
+        """
+        Returns decoder(vars[var]) for the given peer, decoding it only the first time (or again
+        after it has been evicted from the cache).
+        """
+        peer_id = str(peer_id)
+        if peer_id in self._keys:
+            key = self._keys.pop(peer_id)
+        else:
+            peer_vars = self.get_vars(peer_id)
+            if peer_vars is None:
+                return None
+            key = decoder(peer_vars[var])
+
+        self._keys[peer_id] = key
+        if self._max_cached_keys and len(self._keys) > self._max_cached_keys:
+            self._keys.popitem(last=False)
+        return key
+
+#
+# peerdirectory.py ends here
@@ -0,0 +1,175 @@
+# peertable.py ---
+#
+# Filename: peertable.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sat Oct 17 16:21:47 2026 (+0200)
+
+# Commentary:
+#
+# Memory mapped, read only table with the vars of all the experiment peers.
+#
+# The sync relay writes the table once per node so all the instances running on that node can
+# share it instead of keeping their own parsed copy of the all_vars JSON document. Only the
+# records that are actually looked up get parsed.
+#
+# File layout (all integers are little endian):
+# * Header:        magic, peer count, address index offset, vars blob offset.
+# * Records:       one per peer, sorted by id: id, host, port, vars offset, vars length.
+# * Address index: one per peer, sorted by port: port, record index.
+# * Vars blob:     the JSON encoded vars of every peer (without the host and port).
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+import mmap
+import os
+from struct import Struct
+
+MAGIC = "GUMBYPT\x01"
+
+_HEADER = Struct("<8sIQQ")
+# 46 bytes is enough for any textual IPv4 or IPv6 address
+_RECORD = Struct("<I46sHQI")
+_ADDRESS = Struct("<HI")
+
+
+def write_peer_table(filename, peer_records):
+    """
+    Writes a peer table with the given records (a dict of id -> vars, as found in the all_vars
+    document) to filename. The file is replaced atomically.
+    """
+    records = sorted((int(peer_id), peer_vars) for peer_id, peer_vars in peer_records.iteritems())
+
+    record_data = []
+    addresses = []
+    blobs = []
+    blob_size = 0
+    for index, (peer_id, peer_vars) in enumerate(records):
+        peer_vars = peer_vars.copy()
+        host = str(peer_vars.pop('host'))
+        port = int(peer_vars.pop('port'))
+        blob = json.dumps(peer_vars)
+
+        record_data.append(_RECORD.pack(peer_id, host, port, blob_size, len(blob)))
+        addresses.append((port, index))
+        blobs.append(blob)
+        blob_size += len(blob)
+    addresses.sort()
+
+    address_offset = _HEADER.size + len(records) * _RECORD.size
+    blob_offset = address_offset + len(addresses) * _ADDRESS.size
+
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, len(records), address_offset, blob_offset))
+        f.write("".join(record_data))
+        f.write("".join(_ADDRESS.pack(port, index) for port, index in addresses))
+        f.write("".join(blobs))
+    os.rename(tmp_filename, filename)
+
+
+class PeerTable(object):
+
+    """
+    Read only access to a peer table written by write_peer_table().
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, self._address_offset, self._blob_offset = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a peer table" % filename)
+
+    def _record(self, index):
+        return _RECORD.unpack_from(self._map, _HEADER.size + index * _RECORD.size)
+
+    def _find(self, peer_id):
+        peer_id = int(peer_id)
+
+        # The ids are contiguous when the table is written by the sync relay, so try that first.
+        index = peer_id - 1
+        if 0 <= index < self.count:
+            record = self._record(index)
+            if record[0] == peer_id:
+                return record
+
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = self._record(middle)
+            if record[0] < peer_id:
+                low = middle + 1
+            elif record[0] > peer_id:
+                high = middle
+            else:
+                return record
+
+    def get_ids(self):
+        return [str(self._record(index)[0]) for index in xrange(self.count)]
+
+    def get_address(self, peer_id):
+        record = self._find(peer_id)
+        if record:
+            return record[1].rstrip("\0"), record[2]
+
+    def get_id(self, host, port):
+        port = int(port)
+
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if _ADDRESS.unpack_from(self._map, self._address_offset + middle * _ADDRESS.size)[0] < port:
+                low = middle + 1
+            else:
+                high = middle
+
+        for index in xrange(low, self.count):
+            address_port, record_index = _ADDRESS.unpack_from(self._map, self._address_offset + index * _ADDRESS.size)
+            if address_port != port:
+                break
+            record = self._record(record_index)
+            if record[1].rstrip("\0") == host:
+                return str(record[0])
+
+    def get_vars(self, peer_id):
+        record = self._find(peer_id)
+        if record:
+            peer_id, host, port, offset, length = record
+            offset += self._blob_offset
+            peer_vars = json.loads(self._map[offset:offset + length])
+            peer_vars['host'] = host.rstrip("\0")
+            peer_vars['port'] = port
+            return peer_vars
+
+    def close(self):
+        self._map.close()
+
+#
+# peertable.py ends here
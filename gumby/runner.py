@@ -37,18 +37,30 @@
 
 # Code:
 
-from os import path, chdir, environ, makedirs
+from os import path, chdir, environ, makedirs, close, remove
 from shutil import rmtree
+from tempfile import mkstemp
+from time import time
 import logging
 import sys
+from functools import partial
 
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred, setDebugging, gatherResults, succeed
+from twisted.internet.defer import Deferred, FirstError, setDebugging, gatherResults, succeed
+from twisted.internet.error import ProcessTerminated
 from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.protocols.basic import FileSender
 
 
+from .commandoutput import CommandOutput, setOutputOptions
 from .settings import configToEnv, loadConfig
-from .sshclient import runRemoteCMD
+from .sshclient import closeRemoteConnections, runRemoteCMD
+from .stepgraph import StepGraph
+from .sync import EXPERIMENT_ABORTED_EXIT_CODE
+from .workspacesync import (build_manifest, diff_manifests, load_synced_manifest, manifest_digest,
+                            remote_check_command, remote_extract_command, save_synced_manifest, write_sync_archive)
 setDebugging(True)
 
 
@@ -65,42 +77,109 @@ class ExperimentRunner():
         self._workspace_dir = path.abspath(config['workspace_dir'])
         self._output_dir = path.join(self._workspace_dir, 'output')
         self._env_runner = "scripts/run_in_env.py"
+        # The hash cache and the manifests synced to every head node
+        self._sync_dir = path.join(self._workspace_dir, 'local', 'workspace_sync')
+        self._workspace_manifest = None
+        self._ship_output = path.abspath(path.join(path.dirname(__file__), "..", "scripts", "ship_output.py"))
+        self._output_collector = None
+        # host -> Deferred of the output collection running for it
+        self._output_collections = {}
 
     def logPrefix(self):
         return "ExperimentRunner"
 
-    def copyWorkspaceToHeadNodes(self):
-        self._logger.info("Syncing workspaces on remote head nodes...")
+    def buildWorkspaceManifest(self):
+        def onManifestBuilt(manifest):
+            self._logger.info("Workspace manifest with %d files built in %.2f seconds", len(manifest), time() - start)
+            self._workspace_manifest = manifest
 
-        def onCopySuccess(ignored):
-            self._logger.info("Great copying success!")
-
-        def onCopyFailure(failure):
-            self._logger.error("Meh, copy fail.")
-            return failure
+        start = time()
+        d = deferToThread(build_manifest, self._workspace_dir, path.join(self._sync_dir, 'hashes.json'))
+        return d.addCallback(onManifestBuilt)
 
-        def onSingleCopyFailure(failure, host):
+    def copyWorkspaceToHeadNode(self, host):
+        def onSingleCopyFailure(failure):
             self._logger.error("Failed to synchronize the workspace to the remote host: %s.", host)
             return failure
 
-        copy_list = []
-
-        # First, we need to copy the stuff to the das4 clusters we want to use to run the experiment
-        for host in self._cfg['head_nodes']:
-            pp = OneShotProcessProtocol("Rsync to remote %s" % host)
-            workspace_dir = self._cfg['workspace_dir']
-            args = ("/usr/bin/rsync", "-az", "--recursive", "--exclude=.git*",
-                    "--exclude=.svn", "--exclude=local", "--exclude=output", "--delete-excluded", "--delete-during",
-                    workspace_dir + '/', ":".join((host, self._remote_workspace_dir + '/')
-                                                  ))
-            self._logger.info("Running: %s ", ' '.join(args))
-            reactor.spawnProcess(pp, args[0], args)
+        if self._cfg['workspace_sync'] == 'manifest':
+            d = self.syncWorkspaceToHeadNode(host)
+        else:
+            d = self.rsyncWorkspaceToHeadNode(host)
+        return d.addErrback(onSingleCopyFailure)
+
+    def syncWorkspaceToHeadNode(self, host):
+        """
+        Sends the files that changed since the last sync to host, buildWorkspaceManifest() has to be run first.
+        """
+        manifest = self._workspace_manifest
+        digest = manifest_digest(manifest)
+        synced_filename = path.join(self._sync_dir, host + '.json')
+        synced_digest, synced_manifest = load_synced_manifest(synced_filename)
+        start = time()
+
+        def onCheckFailed(failure):
+            failure.trap(ProcessTerminated)
+            self._logger.info("The workspace on %s doesn't match the last synced manifest, sending all of it", host)
+            return {}
+
+        def sendChanges(remote_manifest):
+            changed, deleted = diff_manifests(remote_manifest, manifest)
+            if not changed and not deleted:
+                self._logger.info("The workspace on %s is up to date, nothing to send (checked in %.2f seconds)",
+                                  host, time() - start)
+                return
+
+            fd, archive_filename = mkstemp(prefix='gumby_workspace_', suffix='.tar.gz')
+            close(fd)
+            d = deferToThread(write_sync_archive, self._workspace_dir, changed, deleted, archive_filename)
+            d.addCallback(sendArchive, archive_filename, changed, deleted)
+            return d.addBoth(removeArchive, archive_filename)
+
+        def sendArchive(raw_bytes, archive_filename, changed, deleted):
+            sent_bytes = path.getsize(archive_filename)
+            pp = OneShotProcessProtocol("Workspace sync to %s" % host)
+            args = ("/usr/bin/ssh", host, remote_extract_command(self._remote_workspace_dir, digest))
+            self._logger.info("Sending %d changed and %d deleted files to %s", len(changed), len(deleted), host)
+            transport = reactor.spawnProcess(pp, args[0], args)
+
+            archive = open(archive_filename, 'rb')
+
+            def onArchiveSent(_):
+                archive.close()
+                transport.closeStdin()
+            FileSender().beginFileTransfer(archive, transport).addBoth(onArchiveSent)
+
+            return pp.getDeferred().addCallback(onSent, len(changed), len(deleted), raw_bytes, sent_bytes)
+
+        def onSent(_, changed, deleted, raw_bytes, sent_bytes):
+            save_synced_manifest(synced_filename, manifest)
+            duration = time() - start
+            self._logger.info("Workspace synced to %s in %.2f seconds: %d files changed, %d deleted, %.2f MB archived, "
+                              "%.2f MB sent (%.2f MB/s)", host, duration, changed, deleted, raw_bytes / 1048576.0,
+                              sent_bytes / 1048576.0, sent_bytes / 1048576.0 / max(duration, 0.001))
+
+        def removeArchive(result, archive_filename):
+            remove(archive_filename)
+            return result
+
+        # Clears the remote output and checks that the head node still has what was last sent to it
+        d = runRemoteCMD(host, remote_check_command(self._remote_workspace_dir, synced_digest))
+        d.addCallbacks(lambda _: synced_manifest, onCheckFailed)
+        d.addCallback(sendChanges)
+        return d
 
-            copy_list.append(pp.getDeferred().addErrback(onSingleCopyFailure, host))
+    def rsyncWorkspaceToHeadNode(self, host):
+        pp = OneShotProcessProtocol("Rsync to remote %s" % host)
+        workspace_dir = self._cfg['workspace_dir']
+        args = ("/usr/bin/rsync", "-az", "--recursive", "--exclude=.git*",
+                "--exclude=.svn", "--exclude=local", "--exclude=output", "--delete-excluded", "--delete-during",
+                workspace_dir + '/', ":".join((host, self._remote_workspace_dir + '/')
+                                              ))
+        self._logger.info("Running: %s ", ' '.join(args))
+        reactor.spawnProcess(pp, args[0], args)
 
-        d = gatherResults(copy_list, consumeErrors=True)
-        d.addCallbacks(onCopySuccess, onCopyFailure)
-        return d
+        return pp.getDeferred()
 
     def collectOutputFromHeadNodes(self):
         self._logger.info("Syncing output data back from head nodes...")
@@ -116,28 +195,77 @@ class ExperimentRunner():
             self._logger.error("Failed to collect the ouput data from the remote host: %s.", host)
             return failure
 
-        copy_list = []
+        def collectFromAll(_):
+            # Only the data written since the last incremental collection is left to be shipped
+            copy_list = [self.collectOutputFromHeadNode(host).addErrback(onSingleCopyFailure, host)
+                         for host in self._cfg['head_nodes']]
+            return gatherResults(copy_list, consumeErrors=True)
+
+        d = self.stopOutputCollection()
+        d.addCallback(collectFromAll)
+        d.addCallbacks(onCopySuccess, onCopyFailure)
+        return d
 
+    def collectOutputFromHeadNode(self, host):
         try:
             makedirs(self._output_dir)
         except OSError:
             pass
 
-        for host in self._cfg['head_nodes']:
+        if self._cfg['output_collection'] == 'stream':
+            pp = OneShotProcessProtocol("Output shipping from remote %s" % host)
+            args = (sys.executable, self._ship_output, "pull", "--exclude=.git*", "--exclude=.svn", "--exclude=local",
+                    "--remote-python", self.getRemotePython(),
+                    "--remote-script", path.join(self._remote_workspace_dir, 'gumby', 'scripts', 'ship_output.py'),
+                    ":".join((host, self._remote_workspace_dir + '/output')),
+                    path.join(self._workspace_dir, "output", host)
+                    )
+        else:
             pp = OneShotProcessProtocol("Rsync from remote %s" % host)
             args = ("/usr/bin/rsync", "-az", "--recursive", "--exclude=.git*",
                     "--exclude=.svn", "--exclude=local", "--delete-excluded", "--delete-during",
                     ":".join((host, self._remote_workspace_dir + '/output/')),
                     path.join(self._workspace_dir, "output", host) + "/"
                     )
-            self._logger.info("Running: %s ", ' '.join(args))
-            reactor.spawnProcess(pp, args[0], args)
+        self._logger.info("Running: %s ", ' '.join(args))
+        reactor.spawnProcess(pp, args[0], args)
 
-            copy_list.append(pp.getDeferred().addErrback(onSingleCopyFailure, host))
+        return pp.getDeferred()
 
-        d = gatherResults(copy_list, consumeErrors=True)
-        d.addCallbacks(onCopySuccess, onCopyFailure)
-        return d
+    def startOutputCollection(self):
+        """
+        Keeps collecting the output of the head nodes while the experiment runs, so only the last of it
+        has to be shipped once it finishes.
+        """
+        interval = self._cfg['output_collection_interval']
+        if self._cfg['output_collection'] != 'stream' or not interval or not self._cfg['head_nodes']:
+            return
+        self._output_collector = LoopingCall(self.collectOutputIncrementally)
+        self._output_collector.start(interval, now=False)
+
+    def collectOutputIncrementally(self):
+        def onCollectionFailure(failure, host):
+            self._logger.warning("Incremental output collection from %s failed, retrying later: %s",
+                                 host, failure.getErrorMessage())
+
+        def onCollectionDone(_, host):
+            del self._output_collections[host]
+
+        for host in self._cfg['head_nodes']:
+            # Don't pile up collections from a slow head node
+            if host not in self._output_collections:
+                d = self._output_collections[host] = self.collectOutputFromHeadNode(host)
+                d.addErrback(onCollectionFailure, host)
+                d.addCallback(onCollectionDone, host)
+
+    def stopOutputCollection(self):
+        """
+        Stops collecting the output incrementally, returns a Deferred that fires once the running
+        collections have finished.
+        """
+        if self._output_collector and self._output_collector.running:
+            self._output_collector.stop()
+        return gatherResults(self._output_collections.values())
 
     def spawnTracker(self):
         def onTrackerFailure(failure):
@@ -197,23 +325,15 @@ class ExperimentRunner():
         else:
             return succeed(None)
 
-    def runRemoteSetup(self):
+    def runRemoteSetupOnHost(self, host):
         def onSetupSuccess(ignored):
-            self._logger.info("Remote setup successful!")
+            self._logger.info("Remote setup on %s successful!", host)
 
-        def onSetupFailure(failure):
-            return failure
         if self._cfg['remote_setup_cmd']:
-            d = self.runCommandOnAllRemotes(self._cfg['remote_setup_cmd'])
-            d.addCallbacks(onSetupSuccess, onSetupFailure)
-            return d
+            return self.runCommandOnRemote(host, self._cfg['remote_setup_cmd']).addCallback(onSetupSuccess)
         else:
             return succeed(None)
 
-    def runSetupScripts(self):
-        self._logger.info("Running local and remote setup scripts")
-        return gatherResults((self.runRemoteSetup(), self.runLocalSetup()), consumeErrors=True)
-
     def runCommand(self, command, remote=False):
         if remote:
             self._logger.info("Remotely running command %s", command)
@@ -231,18 +351,22 @@ class ExperimentRunner():
         return pp.getDeferred()
 
     def runCommandOnAllRemotes(self, command):
-        remote_instance_list = []
+        remote_instance_list = [self.runCommandOnRemote(host, command) for host in self._cfg['head_nodes']]
+        return gatherResults(remote_instance_list, consumeErrors=True)
+
+    def getRemotePython(self):
         # TODO: Allow for other venv dirs to be used by setting the path in the config file.
-        # use remote _env_runner
         if self._cfg["use_remote_venv"]:
-            python = "$HOME/venv/bin/python"
+            return "$HOME/venv/bin/python"
         else:
-            python = "python"
+            return "python"
+
+    def runCommandOnRemote(self, host, command):
+        # use remote _env_runner
+        python = self.getRemotePython()
         args = " ".join((python, path.join(self._remote_workspace_dir, 'gumby', self._env_runner), " ", self._cfg_path, " ", command))
-        for host in self._cfg['head_nodes']:
-            self._logger.info("Executing command in %s: %s", host, args)
-            remote_instance_list.append(runRemoteCMD(host, args))
-        return gatherResults(remote_instance_list, consumeErrors=True)
+        self._logger.info("Executing command in %s: %s", host, args)
+        return runRemoteCMD(host, args)
 
     def startTracker(self):
         def onTrackerFailure(failure):
@@ -262,6 +386,12 @@ class ExperimentRunner():
 
     def startExperimentServer(self):
         def onConfigServerDied(failure):
+            if failure.check(FirstError):
+                failure = failure.value.subFailure
+            if failure.check(ProcessTerminated) and failure.value.exitCode == EXPERIMENT_ABORTED_EXIT_CODE:
+                # The instances have been told to stop, the output will be collected once they exit.
+                self._logger.error("Config server aborted the experiment as too many instances were lost.")
+                return
             self._logger.error("Config server has exited with status: %s", failure.getErrorMessage())
             # TODO: Add a config option to not shut down the experiment when the config server dies???
             reactor.exitCode = 1
@@ -288,6 +418,7 @@ class ExperimentRunner():
 
         if self._cfg['remote_instance_cmd']:
             dr = self._instances_d = self.runCommandOnAllRemotes(self._cfg['remote_instance_cmd'])
+            self.startOutputCollection()
         else:
             dr = succeed(None)
         if self._cfg['local_instance_cmd']:
@@ -317,6 +448,9 @@ class ExperimentRunner():
 
         chdir(self._workspace_dir)
 
+        # Don't keep the pooled SSH connections to the head nodes open until the process dies
+        reactor.addSystemEventTrigger('before', 'shutdown', closeRemoteConnections)
+
         # Step 1:
         # Inject all the config options as env variables to give sub-processes easy acces to them.
         self.local_env = environ.copy()
@@ -328,38 +462,58 @@ class ExperimentRunner():
         if path.exists(self._output_dir):
             rmtree(self._output_dir)
 
+        # The output of the commands can be limited in the log, the spool keeps all of it.
+        setOutputOptions(self._cfg['output_log_rate'], self._cfg['output_log_sample'],
+                         path.join(self._output_dir, 'command_output') if self._cfg.as_bool('output_spool') else None)
+
+        # Steps 3 to 9 run as a graph, every step starts as soon as the ones it requires have finished.
+        steps = StepGraph()
+        head_nodes = self._cfg['head_nodes']
+        remote_setup_steps = ["remote_setup %s" % host for host in head_nodes]
+
         # Step 3:
         # Sync the working dir with the head nodes
-        d = Deferred()
-        d.addCallback(lambda _: self.copyWorkspaceToHeadNodes())
-
         # Step 4:
-        # Run the set up script, both locally and in the head nodes
-        d.addCallback(lambda _: self.runSetupScripts())
+        # Run the set up script, both locally and in the head nodes. Every head node runs its set up as soon as its
+        # workspace is synced.
+        steps.addStep("local_setup", self.runLocalSetup)
+        sync_requires = []
+        if head_nodes and self._cfg['workspace_sync'] == 'manifest':
+            steps.addStep("workspace_manifest", self.buildWorkspaceManifest)
+            sync_requires.append("workspace_manifest")
+        for host, setup_step in zip(head_nodes, remote_setup_steps):
+            steps.addStep("sync %s" % host, partial(self.copyWorkspaceToHeadNode, host), requires=sync_requires)
+            steps.addStep(setup_step, partial(self.runRemoteSetupOnHost, host), requires=["sync %s" % host])
 
         # Step 5:
         # Start the tracker, either locally or on the first head node of the list.
-        d.addCallback(lambda _: self.startTracker())
+        steps.addStep("tracker", self.startTracker,
+                      requires=remote_setup_steps if self._cfg.as_bool('tracker_run_remote') else ["local_setup"])
 
         # Step 6:
         # Start the config server, always locally if running instances locally as the head nodes are firewalled and
         # can only be reached from the outside trough SSH.
-        d.addCallback(lambda _: self.startExperimentServer())
+        steps.addStep("experiment_server", self.startExperimentServer,
+                      requires=(remote_setup_steps if self._cfg.as_bool('experiment_server_run_remote')
+                                else ["local_setup"]))
 
         # Step 7:
         # Spawn both local and remote instance runner scripts, which will connect to the config server and wait for all
         # of them to be ready before starting the experiment.
-        d.addCallback(lambda _: self.startInstances())
+        steps.addStep("instances", self.startInstances,
+                      requires=["local_setup", "tracker", "experiment_server"] + remote_setup_steps)
 
         # Step 8:
         # Collect all the data from the remote head nodes.
-        d.addCallback(lambda _: self.collectOutputFromHeadNodes())
+        steps.addStep("collect_output", self.collectOutputFromHeadNodes, requires=["instances"])
 
         # Step 9:
         # Extract the data and graph stuff
-        d.addCallback(lambda _: self.runPostProcess())
+        steps.addStep("post_process", self.runPostProcess, requires=["collect_output"])
 
         # TODO: From here onwards
+        d = Deferred()
+        d.addCallback(lambda _: steps.run())
         reactor.callLater(0, d.callback, None)
         # reactor.callLater(60, reactor.stop)
 
@@ -372,12 +526,16 @@ class OneShotProcessProtocol(ProcessProtocol):
         self._logger = logging.getLogger(self.__class__.__name__)
 
         self.command = command
-        self._stdout_bytes = ''
-        self._stderr_bytes = ''
+        label = self.command[:20].strip() + "..." if len(self.command) > 20 else ""
+        self._stdout = CommandOutput(self._logger, '[%s] OUT: %s', (label,), command, 'out')
+        self._stderr = CommandOutput(self._logger, '[%s] ERR: %s', (label,), command, 'err')
         self._d = Deferred()
 
-    def processExited(self, reason):
-        # TODO(emilon): Process self._stdout_bytes, _sterr_bytes before exiting, to make sure no output is lost.
+    def processEnded(self, reason):
+        # Unlike processExited, this is only called once stdout and stderr have been closed too, so no
+        # output can arrive anymore. Log whatever is left of it before reporting the exit.
+        self._stdout.close()
+        self._stderr.close()
         # self._logger.info('CMD "%s" Process exited with reason: %s', self.command, reason)
         self._logger.info('[%s] exit code %s', self.command, reason.value.exitCode)
         if reason.value.exitCode:
@@ -386,29 +544,10 @@ class OneShotProcessProtocol(ProcessProtocol):
             self._d.callback(None)
 
     def outReceived(self, data):
-        # we could recv more than 1 line and/or a partial line.
-        self._stdout_bytes += data
-        remainder = ""
-        for line in self._stdout_bytes.splitlines(True):
-            if line.endswith('\n'):
-                self._logger.info('[%s] OUT: %s', self.command[:20].strip() + "..." if len(self.command) >20 else "",
-                                  line.rstrip())
-            else:
-                # It's a partial line (part of the last one), save it to the buffer instead
-                remainder = line
-        self._stdout_bytes = remainder
+        self._stdout.dataReceived(data)
 
     def errReceived(self, data):
-        self._stderr_bytes += data
-        remainder = ""
-        for line in self._stderr_bytes.splitlines(True):
-            if line.endswith('\n'):
-                self._logger.info('[%s] ERR: %s', self.command[:20].strip() + "..." if len(self.command) >20 else "",
-                                  line.rstrip())
-            else:
-                # It's a partial line (part of the last one), save it to the buffer instead
-                remainder = line
-        self._stderr_bytes = remainder
+        self._stderr.dataReceived(data)
 
     def getDeferred(self):
         return self._d
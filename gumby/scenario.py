@@ -48,13 +48,109 @@
 import logging
 import shlex
 import sys
-from itertools import ifilter
-from os import environ
+from bisect import bisect_right
+from collections import defaultdict
+from fcntl import LOCK_EX, flock
+from hashlib import sha1
+from heapq import merge
+from itertools import ifilter, izip
+from operator import itemgetter
+from os import environ, path
+from random import Random
 from re import compile as re_compile
-from threading import RLock
 from time import time
 
 from twisted.internet import reactor
+from twisted.internet.interfaces import IReactorThreads
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from gumby.scenarioindex import ALL_PEERS, EXCLUDING_PEERS, MAGIC, ScenarioIndex, write_scenario_index
+from gumby.scenariotrace import ScenarioTracer
+
+# Execution policies of the scenario callables, see ScenarioRunner.register()
+EXECUTE_IN_REACTOR = 'reactor'
+EXECUTE_IN_THREAD = 'thread'
+EXECUTE_COALESCED = 'coalesced'
+
+# Actions running on the reactor thread for longer than this are reported
+SLOW_ACTION_THRESHOLD = 0.5
+
+# Max amount of parsed peerspecs kept by a parser, generated scenarios can have lots of distinct ones
+PEERSPEC_CACHE_SIZE = 100000
+
+
+class PeerSet(object):
+
+    """
+    Immutable set of peer numbers. Peer ranges are kept as sorted and merged (low, high) intervals,
+    so they don't need to be expanded to test if a peer is in them, and single peers in a frozenset.
+    """
+
+    __slots__ = ('_lows', '_highs', '_peers')
+
+    def __init__(self, intervals=(), peers=()):
+        self._lows = []
+        self._highs = []
+        for low, high in sorted(intervals):
+            if self._lows and low <= self._highs[-1] + 1:
+                self._highs[-1] = max(self._highs[-1], high)
+            else:
+                self._lows.append(low)
+                self._highs.append(high)
+        self._peers = frozenset(peers)
+
+    def _in_intervals(self, peer):
+        index = bisect_right(self._lows, peer) - 1
+        return index >= 0 and peer <= self._highs[index]
+
+    def _single_peers(self):
+        return sorted(peer for peer in self._peers if not self._in_intervals(peer))
+
+    def __contains__(self, peer):
+        return peer in self._peers or self._in_intervals(peer)
+
+    def __iter__(self):
+        ranges = (peer for low, high in izip(self._lows, self._highs) for peer in xrange(low, high + 1))
+        return merge(ranges, self._single_peers())
+
+    def __len__(self):
+        return sum(high - low + 1 for low, high in izip(self._lows, self._highs)) + len(self._single_peers())
+
+    def __nonzero__(self):
+        return bool(self._lows or self._peers)
+
+    def __repr__(self):
+        return "PeerSet(%r, %r)" % (self.intervals(), sorted(self._peers))
+
+    @property
+    def max_peer(self):
+        return max(self._highs[-1] if self._highs else 0, max(self._peers) if self._peers else 0)
+
+    def intervals(self):
+        return zip(self._lows, self._highs)
+
+    def difference(self, other):
+        """
+        Returns a new PeerSet with the peers of this set that aren't in other.
+        """
+        intervals = []
+        others = PeerSet(other.intervals() + [(peer, peer) for peer in other._peers]).intervals()
+        first = 0
+        for low, high in self.intervals():
+            while first < len(others) and others[first][1] < low:
+                first += 1
+            index = first
+            while low <= high and index < len(others) and others[index][0] <= high:
+                if others[index][0] > low:
+                    intervals.append((low, others[index][0] - 1))
+                low = max(low, others[index][1] + 1)
+                index += 1
+            if low <= high:
+                intervals.append((low, high))
+        return PeerSet(intervals, [peer for peer in self._peers if peer not in other])
 
 
 class ScenarioParser():
@@ -65,6 +161,8 @@ class ScenarioParser():
         TIMESPEC = [@][H:]M:S[-[H:]M:S]
 
             Use @ to schedule events based on the synchronized experiment starting timestamp.
+            If an end time is given, the event is spread over that window: every peer runs it at
+            its own moment of the window, which is random but always the same for a given peer.
 
         CALLABLE = string
 
@@ -90,55 +188,80 @@ class ScenarioParser():
 
     def __init__(self):
         self._logger = logging.getLogger(self.__class__.__name__)
-        self.file_lock = RLock()
-        self.file_buffer = None
+        # Most peerspecs are repeated over lots of lines, so parse each one only once.
+        self._peerspec_cache = {}
+        # $VARIABLE -> its replacement, looked up in the env once per variable.
+        self._substitutions = {}
+        self._peernumber = None
 
     def _read_scenario(self, filename):
         """
-        Read the scenario into memory return a list containing the lines.
+        Yields a (LINENO, LINE) tuple for every line of the scenario that is not empty or a comment.
+        The file is streamed, so only one line is kept in memory at a time.
         """
-        with self.file_lock:
-            if not self.file_buffer or self.file_buffer[0] != filename:
-                f = open(filename, "r")
-                lines = f.readlines()
-                f.close()
-
-                line_buffer = []
-
-                linenr = 1
-                for line in lines:
-                    if not line.startswith('#'):
-                        line = line.strip()
-                        line_buffer.append((linenr, line))
-                    linenr += 1
-
-                self.file_buffer = (filename, line_buffer)
-        return self.file_buffer[1]
+        with open(filename, "r") as f:
+            for lineno, line in enumerate(f, 1):
+                if not line.startswith('#'):
+                    line = line.strip()
+                    if line:
+                        yield lineno, line
 
     def _parse_scenario(self, filename):
         """
         Returns a list of commands that will be executed.
 
-        A command is a (TIMESTAMP, LINENO, CALLABLE, ARGS, PEERSPEC) tuple. CALLABLE is
+        A command is a (TIMESTAMP, LINENO, CALLABLE, ARGS) tuple. CALLABLE is
         the name of a function, method, etc. registered with this scenario using
         the register() method.
         """
+        for lineno, line, peerspec in self._split_scenario(filename):
+            cmd = self._parse_scenario_line(lineno, line, peerspec)
+            if cmd is not None:
+                yield cmd
+
+    def _split_scenario(self, filename):
+        """
+        Yields a (LINENO, LINE, PEERSPEC) tuple for every line of the scenario.
+        """
         try:
             for lineno, line in self._read_scenario(filename):
-                if line.endswith('}'):
-                    start = line.rfind('{') + 1
-                    peerspec = line[start:-1]
-                    line = line[:start - 1]
-                else:
-                    peerspec = ''
-
-                cmd = self._parse_scenario_line(lineno, line, peerspec)
-                if cmd is not None:
-                    yield cmd
+                yield self._split_line(lineno, line)
 
         except EnvironmentError:
             print >> sys.stderr, "Scenario file open/read error", filename
 
+    def _split_line(self, lineno, line):
+        """
+        Splits the peerspec from a scenario line, returns a (LINENO, LINE, PEERSPEC) tuple.
+        """
+        if line.endswith('}'):
+            start = line.rfind('{') + 1
+            return lineno, line[:start - 1], line[start:-1]
+        return lineno, line, ''
+
+    def _compile_scenario(self, filename, index_filename):
+        """
+        Parses all the lines of the scenario, no matter which peers they apply to, and writes them to
+        a scenario index (see gumby/scenarioindex.py). The index is shared by all the peers, so the
+        actions keep their whole time window, see _parse_line().
+        """
+        actions = defaultdict(list)
+        for lineno, line, peerspec in self._split_scenario(filename):
+            cmd = self._parse_line(lineno, line)
+            if cmd is None:
+                continue
+
+            yes_peers, no_peers = self._parse_peerspec(peerspec)
+            if no_peers:
+                actions[EXCLUDING_PEERS].append(cmd + (peerspec,))
+            elif yes_peers:
+                for peer in yes_peers:
+                    actions[peer].append(cmd)
+            else:
+                actions[ALL_PEERS].append(cmd)
+
+        write_scenario_index(index_filename, actions)
+
     def _parse_scenario_line(self, lineno, line, peerspec):
         """
         Parses one scenario line, and returns a command tuple. If a parsing
@@ -148,35 +271,73 @@ class ScenarioParser():
         The command tuple is described in _parse_scenario().
         """
         if self._parse_for_this_peer(peerspec):
-            line = self._preprocess_line(line)
-            try:
-                if line.startswith('#'):
-                    # Just a comment line, ignore. 
-                    return None
-                parts = line.split(' ', 2)
-                if len(parts) == 3:
-                    timespec, callable, args = parts
-                else:
-                    timespec, callable = parts
-                    args = ''
-
-                if timespec[0] == '@':
-                    timespec = timespec[1:]
-                timespec = timespec.split(':')
-                begin = int(timespec[-1])
-                if len(timespec) > 1:
-                    begin += int(timespec[-2]) * 60
-                if len(timespec) > 2:
-                    begin += int(timespec[-3]) * 3600
-
-                return (begin, lineno, callable, shlex.split(args))
-
-            except Exception, e:
-                print >> sys.stderr, "Ignoring invalid scenario line", lineno, line, str(e)
-
-        # line not for this peer or a parse error occurred
+            cmd = self._parse_line(lineno, line)
+            if cmd is not None:
+                return self._spread_action(cmd)
+
+        # line not for this peer
         return None
 
+    def _parse_line(self, lineno, line):
+        """
+        Parses one scenario line without its peerspec, and returns a (BEGIN, LINENO, CALLABLE, ARGS, END)
+        tuple, where BEGIN and END are the bounds of the TIMESPEC window (the same if it has no end).
+        If a parsing error is encountered returns None.
+        """
+        line = self._preprocess_line(line)
+        try:
+            if line.startswith('#'):
+                # Just a comment line, ignore.
+                return None
+            parts = line.split(' ', 2)
+            if len(parts) == 3:
+                timespec, callable, args = parts
+            else:
+                timespec, callable = parts
+                args = ''
+
+            if timespec[0] == '@':
+                timespec = timespec[1:]
+            begin, _, end = timespec.partition('-')
+            begin = self._parse_timespec(begin)
+            end = self._parse_timespec(end) if end else begin
+            if end < begin:
+                raise ValueError("window ends before it begins")
+
+            return (begin, lineno, callable, shlex.split(args), end)
+
+        except Exception, e:
+            print >> sys.stderr, "Ignoring invalid scenario line", lineno, line, str(e)
+
+        # a parse error occurred
+        return None
+
+    def _parse_timespec(self, timespec):
+        """
+        Returns the amount of seconds of a [H:]M:S time.
+        """
+        timespec = timespec.split(':')
+        seconds = int(timespec[-1])
+        if len(timespec) > 1:
+            seconds += int(timespec[-2]) * 60
+        if len(timespec) > 2:
+            seconds += int(timespec[-3]) * 3600
+        return seconds
+
+    def _spread_action(self, action):
+        """
+        Turns an action parsed by _parse_line() into a command tuple (see _parse_scenario()) by picking
+        the moment of its window when this peer should run it.
+
+        The offset in the window is seeded with the peer number and the line number, so it is the same
+        on every run of the experiment but not correlated between peers or lines. Without a peer
+        number, the start of the window is used.
+        """
+        begin, lineno, clb, args, end = action[:5]
+        if end > begin and self._peernumber is not None:
+            begin += Random(self._peernumber * 1000003 + lineno).random() * (end - begin)
+        return (begin, lineno, clb, args)
+
     def _parse_peerspec(self, peerspec):
         """
         Checks if current peernumber matches a peer specification.
@@ -185,41 +346,48 @@ class ScenarioParser():
             [{PEERNR1 [, PEERNR2, ...] [, PEERNR3-PEERNR6, ...]}]
 
         Note: An empty peer specification matches everything.
-        """
-        # get individual peers, if any, for a peer spec
-        yes_peers = set()
-        no_peers = set()
 
-        if peerspec:
-            if peerspec[0] == "!":
-                peers = no_peers
-                peerspec = peerspec[1:]
+        Returns a (yes_peers, no_peers) tuple of PeerSets, which are shared between all the
+        callers asking for the same peerspec.
+        """
+        if peerspec not in self._peerspec_cache:
+            if len(self._peerspec_cache) >= PEERSPEC_CACHE_SIZE:
+                self._peerspec_cache.clear()
+
+            # get individual peers, if any, for a peer spec
+            intervals = []
+            negate = peerspec.startswith("!")
+            peers = filter(str.strip, peerspec.lstrip("!").split(","))
+            if "-" in peerspec:
+                # parse the peer number pairs
+                for peer in [peer for peer in peers if "-" in peer]:
+                    low, high = peer.split("-")
+                    intervals.append((int(low), int(high)))
+                peers = [peer for peer in peers if "-" not in peer]
+
+            peer_set = PeerSet(intervals, map(int, peers))
+            if negate:
+                self._peerspec_cache[peerspec] = (PeerSet(), peer_set)
             else:
-                peers = yes_peers
+                self._peerspec_cache[peerspec] = (peer_set, PeerSet())
 
-            for peer in peerspec.split(","):
-                peer = peer.strip()
-                if peer:
-                    # parse the peer number (or peer number pair)
-                    if "-" in peer:
-                        low, high = peer.split("-")
-                        peers.update(xrange(int(low), int(high) + 1))
-                    else:
-                        peers.add(int(peer))
-
-        return yes_peers, no_peers
+        return self._peerspec_cache[peerspec]
 
     def _parse_for_this_peer(self):
         raise NotImplementedError('override this method please')
 
     def _preprocess_line(self, line):
         # Look for $VARIABLES to replace with config options from the env.
-        for substitution in self._re_substitution.findall(line):
-            if substitution[1:] in environ:
-                line = line.replace(substitution, environ[substitution[1:]])
-
+        if '$' in line:
+            line = self._re_substitution.sub(self._substitute, line)
         return line
 
+    def _substitute(self, match):
+        variable = match.group(1)
+        if variable not in self._substitutions:
+            self._substitutions[variable] = environ.get(variable[1:], variable)
+        return self._substitutions[variable]
+
 class ScenarioRunner(ScenarioParser):
 
     """
@@ -231,34 +399,133 @@ class ScenarioRunner(ScenarioParser):
 
     Users should register callables using register() before calling run(). All
     scenario events (lines) using unregistered callable names will be silently
-    ignored. The callables will be executed on the main Twisted thread.
+    ignored. By default the callables will be executed on the main Twisted thread,
+    see register() for the other options.
+
+    The actions are scheduled on clock, which defaults to the reactor. Any other IReactorTime
+    provider can be used instead, like a twisted.internet.task.Clock to replay the scenario without
+    waiting (see gumby/scenariodryrun.py). Such a clock can't get the results back from threads, so
+    the EXECUTE_IN_THREAD callables are then called in place like the EXECUTE_IN_REACTOR ones.
     """
 
-    def __init__(self, filename, expstartstamp=None):
+    def __init__(self, filename, expstartstamp=None, index_dir=None, clock=None, thread_pool_size=4):
         ScenarioParser.__init__(self)
         self.filename = filename
+        self._clock = clock or reactor
+        # If set, the scenario is compiled once into an index in this dir and only the actions of
+        # this peer are loaded from it.
+        self.index_dir = index_dir
+        self._index_filename = None
 
         self._callables = {}
+        self._policies = {}
         self._expstartstamp = expstartstamp
         self._origin = None  # will be set just before run()-ing
         self._my_actions = []
 
+        # Only the call for the next due timestamp is scheduled in the reactor
+        self._pending_actions = []
+        self._next_action = 0
+        self._dispatch_call = None
+        # How late the actions ran compared to their scenario timestamp
+        self.lag_stats = {'batches': 0, 'actions': 0, 'total': 0.0, 'max': 0.0}
+        # How long each callable ran, by name
+        self.action_stats = {}
+
+        # Pool for the EXECUTE_IN_THREAD callables, started when the first one runs
+        self.thread_pool_size = thread_pool_size
+        self._thread_pool = None
+        # Name -> (scenario timestamps, args) of the EXECUTE_COALESCED actions waiting to run
+        self._coalesced_calls = {}
+
+        # If set, every action that runs is traced to this file, see gumby/scenariotrace.py
+        self._trace_filename = None
+        self._tracer = None
+
         self._is_parsed = False
 
     def set_peernumber(self, peernumber):
         self._peernumber = peernumber
 
-    def register(self, clb, name=None):
+    def register(self, clb, name=None, policy=EXECUTE_IN_REACTOR):
         """
         Registers callable to be used from a scenario file. An optional
         different name can be assigned.
+
+        The policy tells how the callable is executed:
+          - EXECUTE_IN_REACTOR: called on the reactor thread when its actions are due.
+          - EXECUTE_IN_THREAD: called on a pool of at most thread_pool_size threads, so it doesn't
+            block the reactor. It must be thread safe.
+          - EXECUTE_COALESCED: all the actions due at the same time are passed to a single call of
+            the callable, as a list with the args of every action, on the next reactor iteration.
         """
+        if policy not in (EXECUTE_IN_REACTOR, EXECUTE_IN_THREAD, EXECUTE_COALESCED):
+            raise ValueError("Unknown execution policy %r" % policy)
         if name is None:
             name = clb.__name__
         self._callables[name] = clb
+        self._policies[name] = policy
+
+    def get_callable(self, name):
+        """
+        Returns the callable registered with the given name.
+        """
+        return self._callables[name]
+
+    def trace_to(self, filename):
+        """
+        Writes a trace of every action that runs to filename, starting when run() is called.
+        """
+        self._trace_filename = filename
+
+    def compile_index(self):
+        """
+        Makes sure there is an up to date index of the scenario in index_dir, compiling it if
+        needed. Returns the path of the index.
+        """
+        # The index depends on the values of the substituted variables too.
+        digest = sha1(MAGIC)
+        substitutions = set()
+        with open(self.filename, "r") as f:
+            for line in f:
+                digest.update(line)
+                if '$' in line:
+                    substitutions.update(self._re_substitution.findall(line))
+        for substitution in sorted(substitutions):
+            digest.update("%s=%r\n" % (substitution, environ.get(substitution[1:])))
+
+        self._index_filename = path.join(self.index_dir, "scenario_%s.idx" % digest.hexdigest())
+        if not path.exists(self._index_filename):
+            # All the instances on a node start at the same time, only let the first one compile it
+            with open(self._index_filename + ".lock", "a") as lock_file:
+                flock(lock_file, LOCK_EX)
+                if not path.exists(self._index_filename):
+                    self._logger.info("Compiling scenario %s to %s", self.filename, self._index_filename)
+                    self._compile_scenario(self.filename, self._index_filename)
+        return self._index_filename
+
+    def _load_own_actions(self):
+        index = ScenarioIndex(self._index_filename or self.compile_index())
+        try:
+            actions = index.get_actions(ALL_PEERS) + index.get_actions(self._peernumber)
+            actions.extend(action for action in index.get_actions(EXCLUDING_PEERS)
+                           if self._parse_for_this_peer(action[5]))
+        finally:
+            index.close()
+
+        actions = map(self._spread_action, actions)
+
+        # Keep the order of the scenario for the actions scheduled at the same time
+        actions.sort(key=lambda action: action[1])
+        return actions
 
     def parse_file(self):
-        for (tstmp, _, clb, args) in self._parse_scenario(self.filename):
+        if self.index_dir:
+            actions = self._load_own_actions()
+        else:
+            actions = self._parse_scenario(self.filename)
+
+        for (tstmp, _, clb, args) in actions:
             if clb not in self._callables:
                 self._logger.error("'%s' is not registered as an action!", clb)
                 continue
@@ -269,7 +536,7 @@ class ScenarioRunner(ScenarioParser):
 
     def run(self):
         """
-        Schedules calls for each scenario line.
+        Starts dispatching the scenario actions at their timestamps.
         """
         self._logger.info("Running scenario from file: %s", self.filename)
 
@@ -279,14 +546,121 @@ class ScenarioRunner(ScenarioParser):
         if self._expstartstamp == None:
             self._expstartstamp = time()
 
-        for tstmp, clb, args in self._my_actions:
-            tstmp = tstmp + self._expstartstamp
-            delay = tstmp - time()
-            reactor.callLater(
-                delay if delay > 0.0 else 0,
-                self._callables[clb],
-                *args
-            )
+        if self._trace_filename:
+            self._tracer = ScenarioTracer(self._trace_filename, self._peernumber, self._expstartstamp)
+            reactor.addSystemEventTrigger('before', 'shutdown', self._tracer.close)
+
+        # The sort is stable, so the actions of the same second keep the scenario order.
+        self._pending_actions = sorted(self._my_actions, key=itemgetter(0))
+        self._next_action = 0
+        self._schedule_next_batch()
+
+    def _schedule_next_batch(self):
+        self._dispatch_call = None
+        if self._next_action < len(self._pending_actions):
+            tstmp = self._pending_actions[self._next_action][0] + self._expstartstamp
+            self._dispatch_call = self._clock.callLater(max(0, tstmp - self._clock.seconds()), self._dispatch_batch)
+
+    def _dispatch_batch(self):
+        """
+        Runs all the actions that are due, in scenario order.
+        """
+        now = self._clock.seconds()
+        lag = 0.0
+        while self._next_action < len(self._pending_actions):
+            tstmp, clb, args = self._pending_actions[self._next_action]
+            if tstmp + self._expstartstamp > now:
+                break
+            self._next_action += 1
+
+            lag = max(lag, now - tstmp - self._expstartstamp)
+            self.lag_stats['actions'] += 1
+            self.lag_stats['total'] += now - tstmp - self._expstartstamp
+            self._execute(clb, tstmp, args)
+
+        self.lag_stats['batches'] += 1
+        self.lag_stats['max'] = max(self.lag_stats['max'], lag)
+        if lag > 1.0:
+            self._logger.warning("Scenario actions running %.2f secs late", lag)
+
+        self._schedule_next_batch()
+
+    def _execute(self, name, tstmp, args):
+        policy = self._policies.get(name, EXECUTE_IN_REACTOR)
+        if policy == EXECUTE_IN_THREAD and IReactorThreads.providedBy(self._clock):
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPool(0, self.thread_pool_size, "ScenarioRunner")
+                self._thread_pool.start()
+                self._clock.addSystemEventTrigger('during', 'shutdown', self._thread_pool.stop)
+            deferred = deferToThreadPool(self._clock, self._thread_pool, self._call, name, args)
+            deferred.addCallback(self._finish_call, name, [tstmp], False)
+
+        elif policy == EXECUTE_COALESCED:
+            if name not in self._coalesced_calls:
+                self._coalesced_calls[name] = ([], [])
+                self._clock.callLater(0, self._run_coalesced, name)
+            tstmps, calls = self._coalesced_calls[name]
+            tstmps.append(tstmp)
+            calls.append(args)
+
+        else:
+            self._finish_call(self._call(name, args), name, [tstmp], True)
+
+    def _run_coalesced(self, name):
+        tstmps, calls = self._coalesced_calls.pop(name)
+        self._finish_call(self._call(name, (calls,)), name, tstmps, True)
+
+    def _call(self, name, args):
+        """
+        Calls a registered callable, returns its start time, run time and the Failure it raised (or None).
+        The EXECUTE_IN_THREAD callables are called from the thread pool.
+        """
+        start = time()
+        try:
+            self._callables[name](*args)
+        except:
+            return start, time() - start, Failure()
+        return start, time() - start, None
+
+    def _finish_call(self, result, name, tstmps, in_reactor):
+        """
+        Records the outcome of a call running the actions of a callable scheduled at tstmps.
+        """
+        start, runtime, failure = result
+        if failure is not None:
+            log.err(failure, "Scenario action %s failed" % name)
+
+        stats = self.action_stats.get(name)
+        if stats is None:
+            stats = self.action_stats[name] = {'calls': 0, 'total': 0.0, 'max': 0.0}
+        stats['calls'] += 1
+        stats['total'] += runtime
+        stats['max'] = max(stats['max'], runtime)
+
+        if in_reactor and runtime > SLOW_ACTION_THRESHOLD:
+            self._logger.warning("Scenario action %s blocked the reactor for %.2f secs", name, runtime)
+
+        if self._tracer:
+            for tstmp in tstmps:
+                self._tracer.trace(tstmp, name, start - self._expstartstamp, runtime, failure)
+
+    def get_action_stats(self):
+        """
+        Returns the amount of calls and the total, mean and max run time of every callable, by name.
+        """
+        stats = {}
+        for name, action_stats in self.action_stats.iteritems():
+            stats[name] = dict(action_stats, mean=action_stats['total'] / action_stats['calls'])
+        return stats
+
+    def get_lag_stats(self):
+        """
+        Returns the amount of dispatched actions and batches, and the mean and max lag between the
+        scenario timestamp of the actions and the time they actually ran.
+        """
+        stats = dict(self.lag_stats)
+        stats['mean'] = stats['total'] / stats['actions'] if stats['actions'] else 0.0
+        return stats
 
     def _parse_for_this_peer(self, peerspec):
         if peerspec:
@@ -302,8 +676,39 @@ class ScenarioRunner(ScenarioParser):
 # scenario.py ends here
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--dry-run':
+        if len(sys.argv) not in (4, 5):
+            print >> sys.stderr, "Usage: %s --dry-run <inputfile> <peer-count> [<report.json>]" % (sys.argv[0])
+            exit(1)
+
+        from gumby.scenariodryrun import ScenarioDryRun
+
+        t1 = time()
+        dry_run = ScenarioDryRun(sys.argv[2], int(sys.argv[3]))
+        dry_run.run()
+        report = dry_run.collect()
+
+        print >> sys.stderr, "Took %.2f to replay %s for %d peers" % (time() - t1, sys.argv[2], report['peers'])
+        print "%(actions)d actions in %(duration)d secs" % report
+        print "Peak: %(peak_actions_per_second)d actions/sec, %(peak_peers_per_second)d peers/sec, " \
+            "%(peak_actions_per_peer_second)d actions/sec on a single peer" % report
+        print "Hotspots:"
+        for hotspot in report['hotspots']:
+            print "  %6d secs: %8d actions by %5d peers, %s" % (
+                hotspot['second'], hotspot['actions'], hotspot['peers'],
+                ", ".join("%s x%d" % item for item in sorted(hotspot['callables'].iteritems(),
+                                                             key=itemgetter(1), reverse=True)))
+        print "Actions per second:"
+        for second, actions in report['per_second']:
+            print "  %6d %8d" % (second, actions)
+
+        if len(sys.argv) == 5:
+            dry_run.write(sys.argv[4])
+        exit(0)
+
     if len(sys.argv) < 2:
         print >> sys.stderr, "Usage: %s <inputfile> [<peer-id>]" % (sys.argv[0])
+        print >> sys.stderr, "       %s --dry-run <inputfile> <peer-count> [<report.json>]" % (sys.argv[0])
         print >> sys.stderr, "Got:", sys.argv
 
         exit(1)
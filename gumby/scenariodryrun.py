@@ -0,0 +1,216 @@
+# scenariodryrun.py ---
+#
+# Filename: scenariodryrun.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 09:26:41 2026 (+0200)
+
+# Commentary:
+#
+# Dry runs of scenario files.
+#
+# Every peer of the experiment gets its own ScenarioRunner, as it would on the nodes, but all of
+# them schedule their actions on the same virtual clock (a twisted.internet.task.Clock) and every
+# callable is replaced by a stub that only counts the action. The clock is then advanced from one
+# due action to the next, so a scenario of hours runs in seconds.
+#
+# The report contains:
+# * The amount of actions per second across all the peers, and how many peers were busy in it.
+# * The amount of actions per second of every peer.
+# * The peak concurrency: the most actions (and peers running actions) in a single second.
+# * The hotspots: the busiest seconds of the experiment with the callables that make them busy,
+#   which are usually the thundering herds the scenario should spread with TIMESPEC windows.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+from collections import Counter, defaultdict
+from functools import partial
+from heapq import heappop, heappush
+from itertools import count
+from tempfile import gettempdir
+
+from twisted.internet.base import DelayedCall
+from twisted.internet.task import Clock
+
+from gumby.scenario import ScenarioRunner
+
+
+class HeapClock(Clock):
+
+    """
+    Clock that keeps its pending calls in a heap. Clock sorts all of them every time a call is
+    scheduled, which with a pending call per peer makes a dry run of thousands of peers quadratic.
+    """
+
+    def __init__(self):
+        Clock.__init__(self)
+        self._heap = []
+        self._sequence = count()
+
+    def callLater(self, when, what, *a, **kw):
+        call = DelayedCall(self.seconds() + when, what, a, kw, lambda call: None, self._push, seconds=self.seconds)
+        self._push(call)
+        return call
+
+    def _push(self, call):
+        # A reset call is pushed again, the old entry is dropped when popped as its time doesn't match.
+        heappush(self._heap, (call.getTime(), next(self._sequence), call))
+
+    def _discardInactive(self):
+        while self._heap and (self._heap[0][2].cancelled or self._heap[0][2].called or
+                              self._heap[0][0] != self._heap[0][2].getTime()):
+            heappop(self._heap)
+
+    def getDelayedCalls(self):
+        return [call for _, _, call in sorted(self._heap) if call.active()]
+
+    def getNextCallTime(self):
+        """
+        Returns the time of the first pending call, or None if there are no pending calls.
+        """
+        self._discardInactive()
+        return self._heap[0][0] if self._heap else None
+
+    def advance(self, amount):
+        self.rightNow += amount
+        self._discardInactive()
+        while self._heap and self._heap[0][0] <= self.rightNow:
+            call = heappop(self._heap)[2]
+            call.called = 1
+            call.func(*call.args, **call.kw)
+            self._discardInactive()
+
+
+class _RecordingCallables(dict):
+
+    """
+    The callables of a dry run peer: every name is registered, and calling it only records the action.
+    """
+
+    def __init__(self, peernumber, dry_run):
+        dict.__init__(self)
+        self._peernumber = peernumber
+        self._dry_run = dry_run
+
+    def __contains__(self, name):
+        return True
+
+    def __missing__(self, name):
+        clb = self[name] = partial(self._dry_run.record, self._peernumber, name)
+        return clb
+
+
+class DryRunScenarioRunner(ScenarioRunner):
+
+    """
+    ScenarioRunner of a single peer of a dry run.
+    """
+
+    def __init__(self, filename, peernumber, dry_run, index_dir):
+        ScenarioRunner.__init__(self, filename, expstartstamp=0, index_dir=index_dir, clock=dry_run.clock)
+        self.set_peernumber(peernumber)
+        self._index_filename = dry_run.index_filename
+        self._callables = _RecordingCallables(peernumber, dry_run)
+
+
+class ScenarioDryRun(object):
+
+    def __init__(self, filename, peers, index_dir=None, hotspots=10):
+        self.filename = filename
+        self.peers = peers
+        self.index_dir = index_dir or gettempdir()
+        self.hotspots = hotspots
+
+        self.clock = HeapClock()
+        self.index_filename = None
+
+        # (second, peer, callable) -> amount of actions, everything else is aggregated from it in collect()
+        self.counts = {}
+
+    def record(self, peernumber, name, *args):
+        key = (int(self.clock.seconds()), peernumber, name)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def run(self):
+        """
+        Replays the scenario for peers 1 to peers.
+        """
+        # All the peers share the same index, so the scenario is only parsed once.
+        self.index_filename = ScenarioRunner(self.filename, index_dir=self.index_dir).compile_index()
+        for peernumber in xrange(1, self.peers + 1):
+            DryRunScenarioRunner(self.filename, peernumber, self, self.index_dir).run()
+
+        next_call = self.clock.getNextCallTime()
+        while next_call is not None:
+            self.clock.advance(next_call - self.clock.seconds())
+            next_call = self.clock.getNextCallTime()
+
+    def collect(self):
+        per_second = Counter()
+        # peer -> second -> amount of actions
+        per_peer_second = defaultdict(Counter)
+        # second -> callable -> amount of actions
+        callables_per_second = defaultdict(Counter)
+        for (second, peernumber, name), actions in self.counts.iteritems():
+            per_second[second] += actions
+            per_peer_second[peernumber][second] += actions
+            callables_per_second[second][name] += actions
+
+        peers_per_second = Counter()
+        for seconds in per_peer_second.itervalues():
+            peers_per_second.update(seconds.iterkeys())
+
+        hotspots = []
+        for second, actions in per_second.most_common(self.hotspots):
+            hotspots.append({'second': second,
+                             'actions': actions,
+                             'peers': peers_per_second[second],
+                             'callables': dict(callables_per_second[second].most_common(5))})
+
+        busiest_peers = sorted(((max(seconds.itervalues()), peernumber)
+                                for peernumber, seconds in per_peer_second.iteritems()), reverse=True)
+
+        return {'peers': self.peers,
+                'actions': sum(per_second.itervalues()),
+                'duration': max(per_second) + 1 if per_second else 0,
+                'peak_actions_per_second': max(per_second.itervalues()) if per_second else 0,
+                'peak_peers_per_second': max(peers_per_second.itervalues()) if peers_per_second else 0,
+                'peak_actions_per_peer_second': busiest_peers[0][0] if busiest_peers else 0,
+                'busiest_peers': [{'peer': peernumber, 'actions_per_second': actions}
+                                  for actions, peernumber in busiest_peers[:self.hotspots]],
+                'hotspots': hotspots,
+                'per_second': sorted(per_second.iteritems()),
+                'per_peer_second': dict((peernumber, sorted(seconds.iteritems()))
+                                        for peernumber, seconds in per_peer_second.iteritems())}
+
+    def write(self, filename):
+        with open(filename, 'w') as report_file:
+            json.dump(self.collect(), report_file, indent=2, sort_keys=True)
+
+#
+# scenariodryrun.py ends here
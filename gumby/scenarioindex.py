@@ -0,0 +1,123 @@
+# scenarioindex.py ---
+#
+# Filename: scenarioindex.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 05:11:52 2026 (+0200)
+
+# Commentary:
+#
+# Precompiled scenario files indexed by peer number.
+#
+# Instead of having every instance parse the whole scenario to find the few lines that apply to it,
+# the scenario is parsed once per node into an index where the actions are grouped by the peer
+# they apply to. The instances then only have to unpack their own actions, the ones for all the
+# peers and the ones excluding some peers (which still need their peerspec to be checked).
+#
+# File layout (all integers are little endian):
+# * Header: magic, key count.
+# * Keys:   one per peer (or ALL_PEERS/EXCLUDING_PEERS), sorted: key, actions offset, actions length.
+# * Blob:   the marshaled list of actions of every key.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import marshal
+import mmap
+import os
+from struct import Struct
+
+MAGIC = "GUMBYSX\x02"
+
+# Keys of the actions not bound to a single peer
+ALL_PEERS = -1
+EXCLUDING_PEERS = -2
+
+_HEADER = Struct("<8sI")
+_KEY = Struct("<iQI")
+
+
+def write_scenario_index(filename, actions):
+    """
+    Writes an index with the given actions (a dict of key -> list of action tuples) to filename. The
+    file is replaced atomically, so several processes can compile the same scenario at the same time.
+    """
+    keys = sorted(actions)
+
+    key_data = []
+    blobs = []
+    blob_size = 0
+    for key in keys:
+        blob = marshal.dumps(actions[key])
+        key_data.append(_KEY.pack(key, blob_size, len(blob)))
+        blobs.append(blob)
+        blob_size += len(blob)
+
+    tmp_filename = "%s.tmp.%d" % (filename, os.getpid())
+    with open(tmp_filename, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, len(keys)))
+        f.write("".join(key_data))
+        f.write("".join(blobs))
+    os.rename(tmp_filename, filename)
+
+
+class ScenarioIndex(object):
+
+    """
+    Read only access to a scenario index written by write_scenario_index().
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a scenario index" % filename)
+        self._blob_offset = _HEADER.size + self.count * _KEY.size
+
+    def get_actions(self, key):
+        """
+        Returns the list of actions stored for key, or an empty list if there are none.
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            found_key, offset, length = _KEY.unpack_from(self._map, _HEADER.size + middle * _KEY.size)
+            if found_key < key:
+                low = middle + 1
+            elif found_key > key:
+                high = middle
+            else:
+                offset += self._blob_offset
+                return marshal.loads(self._map[offset:offset + length])
+        return []
+
+    def close(self):
+        self._map.close()
+
+#
+# scenarioindex.py ends here
@@ -0,0 +1,113 @@
+# scenariotrace.py ---
+#
+# Filename: scenariotrace.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 10:47:05 2026 (+0200)
+
+# Commentary:
+#
+# Traces of the scenario actions run by each peer.
+#
+# When tracing is enabled (see ScenarioRunner.trace_to()) every peer writes a line for each action
+# it runs:
+#
+#   SCHEDULED START DURATION CALLABLE [ERROR]
+#
+# SCHEDULED is the scenario timestamp of the action and START the time it actually started, both
+# in seconds since the experiment start, DURATION is how long the callable ran and ERROR the
+# exception it raised, if any. The first line of the file is a "# peer PEERNUMBER start TIMESTAMP"
+# header with the experiment start timestamp.
+#
+# summarize_traces() merges the traces of all the peers into the distribution of the lag (START -
+# SCHEDULED) and the duration of every callable (see scripts/summarize_scenario_traces.py).
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from collections import defaultdict
+
+from gumby.syncmetrics import summarize
+
+TRACE_FILENAME = "scenario_trace.log"
+
+
+class ScenarioTracer(object):
+
+    def __init__(self, filename, peernumber, expstartstamp):
+        self._file = open(filename, 'w')
+        self._file.write("# peer %s start %.3f\n" % (peernumber, expstartstamp))
+
+    def trace(self, tstmp, name, start, duration, failure=None):
+        if failure is None:
+            self._file.write("%.3f %.3f %.6f %s\n" % (tstmp, start, duration, name))
+        else:
+            error = "%s: %s" % (failure.type.__name__, failure.getErrorMessage())
+            self._file.write("%.3f %.3f %.6f %s %s\n" % (tstmp, start, duration, name, " ".join(error.split())))
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+def read_trace(filename):
+    """
+    Yields a (SCHEDULED, START, DURATION, CALLABLE, ERROR) tuple for every action in a trace file,
+    ERROR is None if the action didn't fail.
+    """
+    with open(filename, 'r') as trace_file:
+        for line in trace_file:
+            if line.startswith('#'):
+                continue
+            parts = line.rstrip('\n').split(' ', 4)
+            if len(parts) < 4:
+                # The peer probably died while writing it
+                continue
+            yield float(parts[0]), float(parts[1]), float(parts[2]), parts[3], parts[4] if len(parts) > 4 else None
+
+
+def summarize_traces(filenames):
+    """
+    Returns the amount of actions and errors, and the distribution of the lag and duration of the
+    actions of every callable in the given trace files, by callable name.
+    """
+    lags = defaultdict(list)
+    durations = defaultdict(list)
+    errors = defaultdict(int)
+    for filename in filenames:
+        for scheduled, start, duration, name, error in read_trace(filename):
+            lags[name].append(start - scheduled)
+            durations[name].append(duration)
+            if error is not None:
+                errors[name] += 1
+
+    return dict((name, {'actions': len(lags[name]),
+                        'errors': errors[name],
+                        'lag': summarize(lags[name]),
+                        'duration': summarize(durations[name])}) for name in lags)
+
+#
+# scenariotrace.py ends here
@@ -49,6 +49,12 @@ workspace_dir = string(default="./")
 remote_workspace_dir = string(default="./")
 output_dir = string(default="output")
 head_nodes = list(default=[])
+workspace_sync = option("manifest", "rsync", default="manifest")
+output_collection = option("stream", "rsync", default="stream")
+output_collection_interval = integer(min=0, default=60)
+output_log_rate = integer(min=0, default=0)
+output_log_sample = integer(min=1, default=1)
+output_spool = boolean(default=False)
 
 tracker_cmd = string(default="")
 tracker_run_remote = boolean(default=False)
@@ -38,6 +38,7 @@
 
 import os
 import logging
+from collections import defaultdict
 
 from twisted.python.log import err, msg
 from twisted.python.failure import Failure
@@ -56,6 +57,8 @@ from twisted.conch.ssh.session import packRequest_pty_req
 
 from struct import unpack, pack
 
+from .commandoutput import CommandOutput
+
 # setDebugging(True)
 
 _ERROR_REASONS = (
@@ -64,8 +67,21 @@ _ERROR_REASONS = (
 )
 
 
+# Seconds a connection that isn't running any command is kept open
+IDLE_TIMEOUT = 300
+# Commands run at the same time on a single connection, sshd refuses more than 10 by default (MaxSessions)
+MAX_CHANNELS_PER_CONNECTION = 8
+
+
+class _CommandNotStarted(Exception):
+
+    """
+    The command could not be started, so it can safely be run again on another connection.
+    """
+
+
 class _CommandTransport(SSHClientTransport):
-    _secured = False
+    connection = None
 
     def __init__(self):
         self._logger = logging.getLogger(self.__class__.__name__)
@@ -75,47 +91,89 @@ class _CommandTransport(SSHClientTransport):
         return succeed(True)
 
     def connectionSecure(self):
-        self._secured = True
-        connection = _CommandConnection(self.factory.command)
-        self.connection = connection
+        self.connection = _CommandConnection(self.factory)
         userauth = SSHUserAuthClient(
             self.factory.user,
             ConchOptions(),
-            connection)
+            self.connection)
         self.requestService(userauth)
 
     def connectionLost(self, reason):
-        nreason = None
-        if self._secured and reason.type is ConnectionDone:
-            if isinstance(self.connection.reason, _ERROR_REASONS):
-                nreason = Failure(self.connection.reason)
-        if nreason is not None:
-            err("Connection lost with reason: %s" % self.connection.reason)
-        else:
-            self._logger.info("Connection lost with reason: %s", reason)
-
-        self.factory.finished.callback(nreason)
+        self._logger.info("Connection to %s lost with reason: %s", self.factory.host, reason.value)
+        SSHClientTransport.connectionLost(self, reason)
 
     def receiveError(self, reason, desc):
         err_msg = "Received error: %s (reasonCode=%d)" % (desc, reason)
         err(err_msg)
-        self.connection.reason = ConnectionLost(err_msg)
+        if self.connection:
+            self.connection.reason = ConnectionLost(err_msg)
 
 
 class _CommandConnection(SSHConnection):
 
-    def __init__(self, command):
+    """
+    An authenticated connection to a host, every command runs in its own channel.
+    """
+
+    def __init__(self, factory):
         SSHConnection.__init__(self)
-        self.command_str = command
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.factory = factory
+        # Set once the connection is lost, the commands still running fail with it
         self.reason = None
+        self.commands = 0
+        self.capacity = factory.pool.max_channels
+        self._idle_call = None
 
     def serviceStarted(self):
-        channel = _CommandChannel(self.command_str, conn=self)
-        self.openChannel(channel)
+        SSHConnection.serviceStarted(self)
+        self.factory.connectionReady(self)
+        if not self.commands:
+            # All the commands waiting for it fit in other connections
+            self._scheduleIdleClose()
+
+    def serviceStopped(self):
+        if not self.reason:
+            self.reason = ConnectionLost("SSH connection to %s lost" % self.factory.host)
+        self._cancelIdleCall()
+        self.factory.connectionStopped(self)
+        SSHConnection.serviceStopped(self)
 
-    def channelClosed(self, channel):
-        SSHConnection.channelClosed(self, channel)
-        self.reason = channel.reason
+    def runCommand(self, command):
+        """
+        Runs command in a new channel, returns the channel's finished Deferred.
+        """
+        self._cancelIdleCall()
+        self.commands += 1
+        channel = _CommandChannel(command, conn=self)
+        self.openChannel(channel)
+        return channel.finished
+
+    def commandFinished(self, refused=False):
+        self.commands -= 1
+        if refused:
+            # The server doesn't allow more channels, don't open more than the ones still running. The
+            # capacity isn't raised again: the limit is the server's (MaxSessions) and doesn't change
+            # while the connection is open, so probing it again would only get more commands refused.
+            # Once the connection is closed when idle, a new one starts at max_channels again.
+            self.capacity = max(self.commands, 1)
+        if not self.commands and not self.reason:
+            self._scheduleIdleClose()
+
+    def _scheduleIdleClose(self):
+        self._idle_call = reactor.callLater(self.factory.pool.idle_timeout, self._closeIdle)
+
+    def _cancelIdleCall(self):
+        if self._idle_call and self._idle_call.active():
+            self._idle_call.cancel()
+        self._idle_call = None
+
+    def _closeIdle(self):
+        self._idle_call = None
+        self._logger.info("Closing idle SSH connection to %s", self.factory.host)
+        self.factory.connectionStopped(self)
         self.transport.loseConnection()
 
 
@@ -127,13 +185,17 @@ class _CommandChannel(SSHChannel):
 
         self._logger = logging.getLogger(self.__class__.__name__)
 
-        self._databytes = ''
-        self._extbytes = ''
         self.command = command
+        self._stdout = CommandOutput(self._logger, 'SSH "%s" STDOUT: %s', (command,), command, 'out')
+        self._stderr = CommandOutput(self._logger, 'SSH "%s" STDERR: %s', (command,), command, 'err')
         self.reason = None
+        # Fires with None when the command succeeds, fails with ProcessTerminated or ConnectionLost otherwise
+        self.finished = Deferred()
 
-    # def openFailed(self, reason):
-    #     self._commandConnected.errback(reason)
+    def openFailed(self, reason):
+        self.conn.commandFinished(refused=True)
+        self.finished.errback(_CommandNotStarted("Could not open a channel to %s: %s" % (self.conn.factory.host,
+                                                                                         reason)))
 
     def channelOpen(self, _):
 
@@ -158,36 +220,26 @@ class _CommandChannel(SSHChannel):
             lambda _: self.conn.sendRequest(self, 'exec', NS(self.command))
         )
 
-    # TODO(emilon): Refactor this to a generic function to be used by dataReceived, extReceived and the OneshotProcessProtocol.
     def dataReceived(self, bytes_):
-        # we could recv more than 1 line and or a partial line.
-        self._databytes += bytes_.replace('\r\n', '\n')
-        remainder = ""
-        for line in self._databytes.splitlines(True):
-            if line.endswith('\n'):
-                self._logger.info('SSH "%s" STDOUT: %s', self.command, line.rstrip())
-            else:
-                # It's a partial line (part of the last one), save it to the buffer instead
-                remainder = line
-        self._databytes = remainder
+        self._stdout.dataReceived(bytes_)
 
     def extReceived(self, _, bytes_):
-        # we could recv more than 1 line and or a partial line.
-        self._extbytes += bytes_.replace('\r\n', '\n')
-        remainder = ""
-        for line in self._extbytes.splitlines(True):
-            if line.endswith('\n'):
-                self._logger.info('SSH "%s" STDERR: %s', self.command, line.rstrip())
-            else:
-                # It's a partial line (part of the last one), save it to the buffer instead
-                remainder = line
-        self._extbytes = remainder
+        self._stderr.dataReceived(bytes_)
 
     def closed(self):
+        self._stdout.close()
+        self._stderr.close()
         self._logger.info("SSH command channel closed")
         if not self.reason:
-            # No command failure
-            self.reason = ConnectionDone("ssh channel closed")
+            # No command failure, unless the connection was lost before it finished
+            self.reason = self.conn.reason or ConnectionDone("ssh channel closed")
+
+        self.conn.commandFinished()
+        if isinstance(self.reason, _ERROR_REASONS):
+            err("Command \"%s\" failed with reason: %s" % (self.command, self.reason))
+            self.finished.errback(Failure(self.reason))
+        else:
+            self.finished.callback(None)
 
     def request_exit_status(self, data):
         """
@@ -215,26 +267,38 @@ class _CommandChannel(SSHChannel):
         self.reason = ProcessTerminated(None, signal, None)
 
 
-class CommandFactory(ClientFactory):
+class _CommandFactory(ClientFactory):
+    protocol = _CommandTransport
 
-    def __init__(self, command, user):
+    def __init__(self, pool, host, user):
         self._logger = logging.getLogger(self.__class__.__name__)
 
-        self.command = command
+        self.pool = pool
+        self.host = host
         self.user = user
-        self.protocol = _CommandTransport
-        self.finished = Deferred()
+        # Fires with the _CommandConnection once it is authenticated
+        self.ready = Deferred()
+
+    def connectionReady(self, connection):
+        self.ready.callback(connection)
+
+    def connectionStopped(self, connection):
+        self.pool.connectionStopped(self.host, connection)
+
+    def clientConnectionFailed(self, connector, reason):
+        self._logger.info("Client connection failed: %s, %s", connector, reason.value)
+        self._notConnected(reason)
 
     def clientConnectionLost(self, connector, reason):
         self._logger.info("Client connection lost: %s, %s, %s", connector, reason, reason.type)
-        if not self.finished.called:  # TODO: This could be prettier
-            if reason.type is ConnectionDone:
-                self.finished.callback(None)
-            else:
-                self.finished.errback(reason)
+        self._notConnected(reason)
 
+    def _notConnected(self, reason):
+        if not self.ready.called:
+            self.ready.errback(_CommandNotStarted("Could not connect to %s: %s" % (self.host, reason.getErrorMessage())))
 
-def runRemoteCMD(host, command):
+
+def _parseHost(host):
     if '@' in host:
         user, host = host.split('@')
     else:
@@ -244,11 +308,95 @@ def runRemoteCMD(host, command):
         port = int(port)
     else:
         port = 22
+    return user, host, port
+
+
+class SSHConnectionPool(object):
+
+    """
+    Keeps the SSH connections to the remote hosts open, so running a command only needs a new channel instead of
+    connecting and authenticating again. A connection that has been idle for idle_timeout seconds is closed, and
+    commands that couldn't be started because their connection failed are retried once on a new connection.
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, max_channels=MAX_CHANNELS_PER_CONNECTION):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.idle_timeout = idle_timeout
+        self.max_channels = max_channels
+
+        # host -> the authenticated connections to it
+        self._connections = defaultdict(list)
+        # host -> the Deferreds waiting for the connection being opened to it
+        self._waiting = {}
+
+    def runCommand(self, host, command, retries=1):
+        """
+        Runs command on host (user@host:port, user and port are optional). Returns a Deferred that fires with None
+        when the command succeeds, or fails with ProcessTerminated or ConnectionLost.
+        """
+        def retry(failure):
+            failure.trap(_CommandNotStarted)
+            if not retries:
+                return failure
+            self._logger.warning("%s, running \"%s\" on a new connection", failure.value, command)
+            return self.runCommand(host, command, retries - 1)
+
+        d = self._getConnection(host)
+        d.addCallback(lambda connection: connection.runCommand(command))
+        d.addErrback(retry)
+        return d
+
+    def connectionStopped(self, host, connection):
+        if connection in self._connections[host]:
+            self._connections[host].remove(connection)
+
+    def closeAll(self):
+        for connections in self._connections.values():
+            for connection in list(connections):
+                connection.transport.loseConnection()
+
+    def _getConnection(self, host):
+        for connection in self._connections[host]:
+            if connection.commands < connection.capacity:
+                return succeed(connection)
+
+        d = Deferred()
+        if host in self._waiting:
+            self._waiting[host].append(d)
+        else:
+            self._waiting[host] = [d]
+            self._connect(host).addCallbacks(self._onConnected, self._onConnectFailed,
+                                             callbackArgs=(host,), errbackArgs=(host,))
+        return d
+
+    def _connect(self, host):
+        user, hostname, port = _parseHost(host)
+        self._logger.info("Opening SSH connection to %s", host)
+        factory = _CommandFactory(self, host, user)
+        reactor.connectTCP(hostname, port, factory)
+        return factory.ready
+
+    def _onConnected(self, connection, host):
+        self._connections[host].append(connection)
+        # Commands that don't fit in this connection open the next one
+        for d in self._waiting.pop(host):
+            self._getConnection(host).chainDeferred(d)
+
+    def _onConnectFailed(self, failure, host):
+        for d in self._waiting.pop(host):
+            d.errback(failure)
+
+
+_pool = SSHConnectionPool()
+
+
+def runRemoteCMD(host, command):
+    return _pool.runCommand(host, command)
 
-    factory = CommandFactory(command, user)
-    reactor.connectTCP(host, port, factory)
 
-    return factory.finished
+def closeRemoteConnections():
+    _pool.closeAll()
 
 #
 # sshrunner.py ends here
@@ -0,0 +1,145 @@
+# stepgraph.py ---
+#
+# Filename: stepgraph.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 16:02:37 2026 (+0200)
+
+# Commentary:
+#
+# Runs the steps of an experiment as a dependency graph.
+#
+# Every step is a callable that may return a Deferred, and lists the steps it requires. A step is
+# started as soon as all of its requirements have finished, so independent steps (like syncing the
+# workspace to one head node while the setup runs on another) overlap instead of waiting for each
+# other. Once a step fails no other step is started, and the graph fails with it.
+#
+# The start time and duration of every step are logged and kept in timings.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import logging
+from collections import OrderedDict
+from time import time
+
+from twisted.internet.defer import Deferred, maybeDeferred
+
+
+class StepGraph(object):
+
+    def __init__(self):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        # name -> (callable, names of the required steps), in the order they were added
+        self._steps = OrderedDict()
+        # name -> (start, duration) of the finished steps, relative to the start of the graph
+        self.timings = OrderedDict()
+
+        self._waiting = None
+        self._running = set()
+        self._failed = False
+        self._start = None
+        self._d = None
+
+    def addStep(self, name, clb, requires=()):
+        """
+        Adds a step that runs clb once all the steps named in requires have finished. The required
+        steps have to be added first, which also keeps the graph free of cycles.
+        """
+        if name in self._steps:
+            raise ValueError("Step %s has already been added" % name)
+        for required in requires:
+            if required not in self._steps:
+                raise ValueError("Step %s requires unknown step %s" % (name, required))
+        self._steps[name] = (clb, set(requires))
+
+    def run(self):
+        """
+        Runs all the steps, returns a Deferred that fires with the timings once all of them have
+        finished, or fails with the failure of the first step that failed.
+        """
+        self._waiting = OrderedDict((name, set(requires)) for name, (_, requires) in self._steps.iteritems())
+        self._start = time()
+        self._d = Deferred()
+        self._startReadySteps()
+        return self._d
+
+    def _startReadySteps(self):
+        ready = [name for name, requires in self._waiting.iteritems() if not requires]
+        for name in ready:
+            del self._waiting[name]
+            self._running.add(name)
+
+        for name in ready:
+            if self._failed:
+                self._running.discard(name)
+                self._waiting[name] = set()
+                continue
+            self._logger.info("Starting step %s", name)
+            start = time()
+            d = maybeDeferred(self._steps[name][0])
+            d.addCallbacks(self._onStepSucceeded, self._onStepFailed,
+                           callbackArgs=(name, start), errbackArgs=(name, start))
+
+        if not self._waiting and not self._running and not self._d.called:
+            self._logTimings()
+            self._d.callback(self.timings)
+
+    def _finishStep(self, name, start):
+        self._running.discard(name)
+        self.timings[name] = (start - self._start, time() - start)
+
+    def _onStepSucceeded(self, _, name, start):
+        self._finishStep(name, start)
+        self._logger.info("Step %s finished in %.2f seconds", name, self.timings[name][1])
+        if self._failed:
+            return
+
+        for requires in self._waiting.itervalues():
+            requires.discard(name)
+        self._startReadySteps()
+
+    def _onStepFailed(self, failure, name, start):
+        self._finishStep(name, start)
+        self._logger.error("Step %s failed after %.2f seconds: %s", name, self.timings[name][1],
+                           failure.getErrorMessage())
+        if not self._failed:
+            self._failed = True
+            self._logTimings()
+            self._d.errback(failure)
+
+    def _logTimings(self):
+        self._logger.info("Step timings (start, duration) in %.2f seconds:", time() - self._start)
+        for name, (start, duration) in sorted(self.timings.iteritems(), key=lambda item: item[1]):
+            self._logger.info("  %-30s %8.2f %8.2f", name, start, duration)
+        for name in sorted(self._running):
+            self._logger.info("  %-30s still running", name)
+        for name in self._waiting:
+            self._logger.info("  %-30s not started", name)
+
+#
+# stepgraph.py ends here
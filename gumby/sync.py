@@ -11,22 +11,51 @@
 #
 # Experiment metainfo and time synchronization server.
 #
-# It receives 3 types of commands:
+# It receives 4 types of commands:
 # * time:<float>  -> Tells the service the local time for the subprocess for sync reasons.
+# * client        -> Tells the service that this connection is a single instance (relays send relay:<int>
+#                    instead, see below). Required for the instances that sent admission (see below), their
+#                    connection isn't counted until then. Older instances are counted right away.
 # * set:key:value -> Sets an arbitrary variable associated with this connection to the
 #                    specified value, can be used to share arbitrary data generated at
 #                    startup between nodes just before starting the experiment.
 # * ready         -> Indicates that this specific instance has ending sending its info
 #                    and its ready to start.
+# * compress:zlib -> Optional, tells the service that this instance can receive the JSON document
+#                    as a compressed frame instead of as a single line.
+# * clock_sync    -> Optional, asks the service to estimate the time offset of this instance with
+#                    several round trips instead of just using the time: command (see below).
 #
 # When the all of the instances we are waiting for are all ready, all the information will
 # be sent back to them in the form of a JSON document. After this, a "go" command will
 # be sent to indicate that they should start running the experiment with the absolute time at which the experiment should start.
 #
+# The JSON document is sent as a line, unless the instance asked for compression. In that case
+# a "zvars:<length>" line is sent followed by <length> bytes of zlib compressed JSON. The document
+# is only encoded once and the same buffer is written to all the subscribers.
+#
+# Peer lookups:
+#
+# Instances only needing the info of a few peers can send "lookup" before "ready". Instead of the
+# whole JSON document they will get a "lookup:<peer count>:<JSON doc with only their own vars>"
+# line, and the connection will be kept open after the "go" signal so they can fetch the records
+# of the peers they need in batches:
+# -> get:3,7,12
+# <- peers:{"3": {...}, "7": {...}, "12": {...}}
+#
+# Peer tables:
+#
+# Instances connected to a sync relay can send "peer_table" before "ready". The relay will then
+# write the vars of all the peers once to a memory mapped file (see gumby/peertable.py) and send
+# them a "table:<path>" line instead of the JSON document. The experiment server ignores it.
+#
 # Example of an expected exchange:
 # [connection is opened by the client]
-# <- id:0
+# -> admission
+# <- admitted
 # -> time:1378479678.11
+# -> client
+# <- id:0
 # -> set:asdf:ooooo
 # -> ready
 # <- {"0": {"host": "127.0.0.1", "time_offset": -0.94, "port": 12000, "asdf": "ooooo"}, "1": {"host": "127.0.0.1", "time_offset": "-1378479680.61", "port": 12001, "asdf": "ooooo"}, "2": {"host": "127.0.0.1", "time_offset": "-1378479682.26", "port": 12002, "asdf": "ooooo"}}
@@ -34,6 +63,73 @@
 # <- go:1388665322.478153
 # [Connection is closed by the server]
 #
+# Clock synchronization:
+#
+# The time: command alone doesn't take the network delay into account. When an instance sends
+# clock_sync, the service does CLOCK_SYNC_SAMPLES NTP style round trips with it:
+# <- ping:<seq>
+# -> pong:<seq>:<instance time>
+# And keeps the offset of the round trip with the lowest RTT. The offset is stored in the
+# time_offset var and half of that RTT (the max error of the estimation) in time_offset_error.
+#
+# Connection admission:
+#
+# The service admits new connections through a token bucket (admission_rate connections per second,
+# with bursts of up to admission_backlog connections). Instances supporting it start by sending
+# "admission" and don't send anything else until the service answers with either:
+# <- admitted       -> The instance can start sending its commands.
+# <- retry:<float>  -> Seconds the client should wait before connecting again, the connection is closed.
+# The retry slots are handed out at the admission rate, so the retries arrive evenly spread. Older
+# instances start sending their commands right away and don't know about retry:, so they are
+# admitted as soon as they connect.
+#
+# Sync relays:
+#
+# When running lots of instances per node, a sync relay can be started on every node so the server only has to deal
+# with one connection per node. The relay waits for all the instances of its node to connect, and then talks to the
+# server on behalf of all of them using the following extra commands:
+# * relay:<int>              -> Tells the server how many instances are behind this connection.
+# * peer:<id>:offset:<float> -> Time offset of an instance relative to the relay.
+# * peer:<id>:set:key:value  -> Same as set:key:value, but for the specified instance.
+#
+# Example of an exchange between a relay and the server:
+# -> admission
+# <- admitted
+# -> time:1378479678.11
+# -> relay:3
+# <- ids:4,5,6
+# -> peer:4:offset:0.01
+# -> peer:4:set:asdf:ooooo
+# [...]
+# -> ready
+# <- {"4": {...}, "5": {...}, "6": {...}, ...}
+# -> vars_received
+# <- go:1388665322.478153
+#
+# The relay fans the JSON document and the go signal (corrected with each instance's offset) back down to the instances
+# using the regular protocol, so the experiment clients don't need to know if they are talking to a relay or not.
+#
+# Persistent connections:
+#
+# Instances sending "persistent" before "ready" keep their connection open after the "go" signal and can use
+# it to coordinate during the experiment (names and keys can't contain colons):
+# -> barrier:<name>        -> Waits until all the persistent instances reach the barrier, the service
+#                             answers with the same line once they did.
+# -> publish:<key>:<value> -> Stores a value.
+# -> wait:<key>            -> Waits for a value, the service answers with value:<key>:<value> as soon
+#                             as it has been published.
+# Relays send "persistent" upstream if any of their instances did, enter a barrier once all of their
+# persistent instances reached it and only forward the first wait for every key.
+#
+# Heartbeats:
+#
+# Instances sending "heartbeat:<float>" before "ready" also keep their connection open and send
+# an "alive" line every <float> seconds during the experiment, and "bye" when they stop. Relays
+# report all of their instances at once with "alive:<alive>:<finished>". Instances that didn't send
+# anything for HEARTBEAT_TIMEOUT_FACTOR intervals and didn't say bye are considered lost. If the
+# service has an abort policy and too many of them are lost for too long, it sends "abort" to all of
+# them and exits with EXPERIMENT_ABORTED_EXIT_CODE, so the runner can collect the output early.
+#
 
 # Change Log:
 #
@@ -60,19 +156,132 @@
 # Code:
 import json
 import logging
+import zlib
+from collections import deque
+from os import getpid, path, unlink
+from tempfile import gettempdir
 from time import time
 
 from twisted.internet import reactor, task
-from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.defer import Deferred, DeferredSemaphore, succeed
+from twisted.internet.interfaces import IPullProducer
 from twisted.internet.protocol import (Factory, ReconnectingClientFactory, connectionDone)
 from twisted.internet.threads import deferToThread
 from twisted.protocols.basic import LineReceiver
+from zope.interface import implementer
+
+from gumby.peerdirectory import PeerDirectory
+from gumby.peertable import PeerTable, write_peer_table
+from gumby.syncmetrics import SyncMetrics
 
 
 EXPERIMENT_SYNC_TIMEOUT = 30
 
+# Max amount of peer records requested in a single get: line
+PEER_LOOKUP_BATCH_SIZE = 500
+
+# Amount of round trips done to estimate the time offset of the clients sending clock_sync
+CLOCK_SYNC_SAMPLES = 8
+
+# Amount of heartbeat intervals without news from an instance before considering it lost
+HEARTBEAT_TIMEOUT_FACTOR = 3
+
+# Seconds to wait for the last lines to be sent when closing a connection before dropping them
+CLOSE_TIMEOUT = 5
+
+# Exit code of the experiment server when it aborts the experiment because too many instances were lost
+EXPERIMENT_ABORTED_EXIT_CODE = 3
+
 logger = logging.getLogger()
 
+
+class AllVarsDocument(object):
+
+    """
+    Holds the JSON document with the vars of all the subscribers and lazily encodes it in the wire format each
+    subscriber wants. Every format is only encoded once, so the same buffer can be written to all the transports.
+    """
+
+    def __init__(self, json_vars=None, compressed=None):
+        self._json_vars = json_vars
+        self._compressed = compressed
+        self._line = None
+        self._frame = None
+
+    @property
+    def json_vars(self):
+        if self._json_vars is None:
+            self._json_vars = zlib.decompress(self._compressed)
+        return self._json_vars
+
+    @property
+    def compressed(self):
+        if self._compressed is None:
+            self._compressed = zlib.compress(self.json_vars)
+        return self._compressed
+
+    def asLine(self):
+        if self._line is None:
+            self._line = self.json_vars + LineReceiver.delimiter
+        return self._line
+
+    def asFrame(self):
+        if self._frame is None:
+            self._frame = "zvars:%d%s%s" % (len(self.compressed), LineReceiver.delimiter, self.compressed)
+        return self._frame
+
+
+@implementer(IPullProducer)
+class AllVarsProducer(object):
+
+    """
+    Writes the document to a subscriber and calls onPushed once the transport sent all of it, as the
+    transport only asks a pull producer for more data once its write buffer is empty.
+    """
+
+    def __init__(self, transport, data, onPushed):
+        self._transport = transport
+        self._data = data
+        self._onPushed = onPushed
+
+    def resumeProducing(self):
+        if self._data is not None:
+            data, self._data = self._data, None
+            self._transport.write(data)
+        else:
+            self._transport.unregisterProducer()
+            self._onPushed()
+
+    def stopProducing(self):
+        # The connection was lost before all of it was sent
+        self._data = None
+
+
+def sendAllVarsGenerator(factory, subscribers, document):
+    for subscriber in subscribers:
+        if subscriber.peer_table and factory.peer_table_path:
+            yield subscriber.writeAllVars("table:%s%s" % (factory.peer_table_path, LineReceiver.delimiter))
+        elif subscriber.lookup:
+            own_vars = json.dumps(factory.getPeerRecords([subscriber.id]))
+            yield subscriber.writeAllVars("lookup:%d:%s%s" % (factory.getPeerCount(), own_vars, LineReceiver.delimiter))
+        elif subscriber.compressed:
+            yield subscriber.writeAllVars(document.asFrame())
+        else:
+            yield subscriber.writeAllVars(document.asLine())
+
+
+def countSubscribers(connections, now):
+    """
+    Returns how many of the subscribers sending heartbeats behind the given connections are alive and
+    how many of them already finished.
+    """
+    alive = finished = 0
+    for connection in connections:
+        if connection.heartbeat_interval:
+            alive += connection.countLiveSubscribers(now)
+            finished += connection.subscribers_finished
+    return alive, finished
+
 #
 # Server side
 #
@@ -82,21 +291,54 @@ class ExperimentServiceProto(LineReceiver):
     # Allow for 4MB long lines (for the json stuff)
     MAX_LENGTH = 2 ** 22
 
-    def __init__(self, factory, id):
+    def __init__(self, factory, id=None):
         self._logger = logging.getLogger(self.__class__.__name__)
 
         self.id = id
         self.factory = factory
         self.ready = False
-        self.state = 'init'
+        self.state = 'hello'
         self.vars = {}
         self.ready_d = None
+        self.compressed = False
+        self.lookup = False
+        self.peer_table = False
+        self.persistent = False
+
+        # Liveness of the subscribers behind this connection, reported with heartbeats during the experiment.
+        self.heartbeat_interval = None
+        self.last_heartbeat = None
+        self.subscribers_alive = 0
+        self.subscribers_finished = 0
+
+        # When this connection got through each phase of the protocol, see gumby/syncmetrics.py
+        self.timestamps = {}
+        self.bytes_pushed = 0
+        self.host = None
+
+        self._clock_samples = 0
+        self._ping_sent = None
+        self._best_rtt = None
+
+        # Relay connections represent several subscribers, each one with its own id and vars. A connection is only
+        # counted once it declared what it is with a client or relay: line (older clients are declared right away).
+        self.declared = False
+        self.relay = False
+        self.subscribers = 1
+        self.ids = []
+        self.peer_vars = {}
 
     def connectionMade(self):
         self._logger.debug("New connection from: %s", str(self.transport.getPeer()))
-        self.factory.setConnectionMade(self)
+        self.timestamps['connected'] = time()
+        self.host = self.transport.getPeer().host
 
     def lineReceived(self, line):
+        if line.startswith('pong:'):
+            # The clock sync round trips can overlap with the other commands
+            self.onPong(line)
+            return
+
         try:
             pto = 'proto_' + self.state
             statehandler = getattr(self, pto)
@@ -108,11 +350,89 @@ class ExperimentServiceProto(LineReceiver):
             if self.state == 'done':
                 self.transport.loseConnection()
 
+    def sendPing(self):
+        self._ping_sent = time()
+        self.sendLine("ping:%d" % self._clock_samples)
+
+    def onPong(self, line):
+        now = time()
+        _, seq, peer_time = line.strip().split(':')
+        if int(seq) != self._clock_samples:
+            self._logger.error('Unexpected pong received "%s"', line)
+            return
+
+        rtt = now - self._ping_sent
+        if self._best_rtt is None or rtt < self._best_rtt:
+            # The peer took its timestamp somewhere during the round trip, assume it was half way.
+            self._best_rtt = rtt
+            self.vars['time_offset'] = float(peer_time) - (self._ping_sent + rtt / 2)
+            self.vars['time_offset_error'] = rtt / 2
+
+        self._clock_samples += 1
+        if self._clock_samples < CLOCK_SYNC_SAMPLES:
+            self.sendPing()
+        else:
+            self._logger.debug("Time offset is %s (+-%s)", self.vars['time_offset'], self.vars['time_offset_error'])
+
     def sendAndWaitForReady(self):
         self.ready_d = Deferred()
-        self.sendLine("id:%s" % self.id)
+        self.timestamps['id_sent'] = time()
+        if self.relay:
+            self.sendLine("ids:%s" % ",".join(str(peer_id) for peer_id in self.ids))
+        else:
+            self.sendLine("id:%s" % self.id)
         return self.ready_d
 
+    def getSubscriberVars(self):
+        """
+        Returns a list of (id, vars) tuples, one for each subscriber behind this connection.
+        """
+        host = self.transport.getPeer().host
+        if self.relay:
+            subscribers = []
+            for peer_id in self.ids:
+                subscriber_vars = self.peer_vars.get(peer_id, {}).copy()
+                # The relay reports the offsets relative to its own clock.
+                subscriber_vars['time_offset'] = subscriber_vars.get('time_offset', 0) + self.vars['time_offset']
+                if 'time_offset_error' in subscriber_vars:
+                    subscriber_vars['time_offset_error'] = float(subscriber_vars['time_offset_error']) + \
+                        self.vars.get('time_offset_error', 0)
+                subscriber_vars['port'] = peer_id + 12000
+                subscriber_vars['host'] = host
+                subscribers.append((peer_id, subscriber_vars))
+            return subscribers
+
+        subscriber_vars = self.vars.copy()
+        subscriber_vars['port'] = self.id + 12000
+        subscriber_vars['host'] = host
+        return [(self.id, subscriber_vars)]
+
+    def keepsConnection(self):
+        return self.lookup or self.persistent or bool(self.heartbeat_interval)
+
+    def countLiveSubscribers(self, now):
+        if self.last_heartbeat is None or now - self.last_heartbeat > HEARTBEAT_TIMEOUT_FACTOR * self.heartbeat_interval:
+            return 0
+        return self.subscribers_alive
+
+    def resetHeartbeat(self):
+        # Consider all of the subscribers alive until we hear otherwise.
+        self.last_heartbeat = time()
+        self.subscribers_alive = self.subscribers - self.subscribers_finished
+
+    def onHeartbeat(self, line):
+        line = line.strip()
+        if line == 'bye':
+            self.subscribers_alive = 0
+            self.subscribers_finished = self.subscribers
+        elif line == 'alive':
+            self.subscribers_alive = 1
+        else:
+            _, alive, finished = line.split(':')
+            self.subscribers_alive = int(alive)
+            self.subscribers_finished = int(finished)
+        self.last_heartbeat = time()
+
     def connectionLost(self, reason=connectionDone):
         self._logger.debug("Lost connection with: %s with ID %s", str(self.transport.getPeer()), self.id)
         self.factory.unregisterConnection(self)
@@ -122,12 +442,28 @@ class ExperimentServiceProto(LineReceiver):
     # Protocol state handlers
     #
 
+    def proto_hello(self, line):
+        if line.strip() != 'admission':
+            # Older clients don't wait to be admitted nor declare themselves, count them as single instances as
+            # soon as their first command arrives
+            self.declared = True
+            self.factory.setConnectionMade(self)
+            return self.proto_init(line)
+
+        retry_delay = self.factory.admitConnection()
+        if retry_delay:
+            self.sendLine("retry:%f" % retry_delay)
+            self.transport.loseConnection()
+            return 'rejected'
+        # Count the time waiting for a retry slot as connecting time
+        self.timestamps['connected'] = time()
+        self.sendLine("admitted")
+        return 'init'
+
     def proto_init(self, line):
         if line.startswith("time"):
+            # A first estimate, replaced by the one of the round trips if the subscriber sends clock_sync
             self.vars["time_offset"] = float(line.strip().split(':')[1]) - time()
-            if abs(self.vars['time_offset']) < 0.5:  # ignore time_offset if smaller than +0.5/-0.5
-                self.vars['time_offset'] = 0
-
             self._logger.debug("Time offset is %s", self.vars["time_offset"])
             return 'init'
 
@@ -137,9 +473,65 @@ class ExperimentServiceProto(LineReceiver):
             self.vars[key] = value
             return 'init'
 
+        elif line.strip() == 'clock_sync':
+            self.sendPing()
+            return 'init'
+
+        elif line.strip() == 'compress:zlib':
+            self._logger.debug("This subscriber accepts compressed frames.")
+            self.compressed = True
+            return 'init'
+
+        elif line.strip() == 'lookup':
+            self._logger.debug("This subscriber will look up the peers on demand.")
+            self.lookup = True
+            return 'init'
+
+        elif line.strip() == 'peer_table':
+            self._logger.debug("This subscriber can read the peer vars from a peer table.")
+            self.peer_table = True
+            return 'init'
+
+        elif line.strip() == 'persistent':
+            self._logger.debug("This subscriber will keep its connection open during the experiment.")
+            self.persistent = True
+            return 'init'
+
+        elif line.startswith('heartbeat:'):
+            self.heartbeat_interval = float(line.strip().split(':')[1])
+            self._logger.debug("This subscriber will send heartbeats every %f secs.", self.heartbeat_interval)
+            return 'init'
+
+        elif line.strip() == 'client' or line.startswith('relay:'):
+            if self.declared:
+                self._logger.error('Unexpected command received "%s", the connection was already declared', line)
+                self._logger.error('closing connection.')
+                return 'done'
+            self.declared = True
+            if line.startswith('relay:'):
+                self.relay = True
+                self.subscribers = int(line.strip().split(':')[1])
+            self.factory.setConnectionMade(self)
+            return 'init'
+
+        elif line.startswith('peer:'):
+            _, peer_id, command = line.strip().split(':', 2)
+            peer_vars = self.peer_vars.setdefault(int(peer_id), {})
+            if command.startswith('offset:'):
+                peer_vars['time_offset'] = float(command.split(':')[1])
+            elif command.startswith('set:'):
+                _, key, value = command.split(':', 2)
+                peer_vars[key] = value
+            else:
+                self._logger.error('Unexpected relayed command received "%s"', line)
+                self._logger.error('closing connection.')
+                return 'done'
+            return 'init'
+
         elif line.strip() == 'ready':
             self._logger.debug("This subscriber is ready now.")
             self.ready = True
+            self.timestamps['ready'] = time()
             self.factory.setConnectionReady(self)
             self.ready_d.callback(self)
             return 'vars_received'
@@ -151,39 +543,147 @@ class ExperimentServiceProto(LineReceiver):
 
     def proto_vars_received(self, line):
         if line.strip() == 'vars_received':
+            self.timestamps['received'] = time()
             self.factory.setConnectionReceived(self)
             return "wait"
+        if self.lookup and line.startswith('get:'):
+            self.sendPeerRecords(line)
+            return "vars_received"
         self._logger.error('Unexpected command received "%s"', line)
         self._logger.error('closing connection.')
         return 'done'
 
+    def proto_rejected(self, line):
+        # The clients wait to be admitted, ignore whatever one sent before getting the retry command anyway.
+        return 'rejected'
+
     def proto_wait(self, line):
+        if self.lookup and line.startswith('get:'):
+            self.sendPeerRecords(line)
+            return 'wait'
+        if self.persistent and line.split(':', 1)[0] in ('barrier', 'publish', 'wait'):
+            self.handleSyncCommand(line)
+            return 'wait'
+        if self.heartbeat_interval and line.split(':', 1)[0].strip() in ('alive', 'bye'):
+            self.onHeartbeat(line)
+            return 'wait'
         self._logger.error('Unexpected command received "%s" while in ready state. Closing connection', line)
         return 'done'
 
+    def writeAllVars(self, data):
+        self.bytes_pushed += len(data)
+        self.transport.registerProducer(AllVarsProducer(self.transport, data, self.onAllVarsPushed), False)
+
+    def onAllVarsPushed(self):
+        self.timestamps['pushed'] = time()
+
+    def sendPeerRecords(self, line):
+        peer_ids = line.strip().split(':', 1)[1].split(',')
+        self.sendLine("peers:%s" % json.dumps(self.factory.getPeerRecords(peer_ids)))
+
+    def handleSyncCommand(self, line):
+        command, name = line.strip().split(':', 1)
+        if command == 'barrier':
+            self.factory.arriveAtBarrier(self, name)
+        elif command == 'publish':
+            key, value = name.split(':', 1)
+            self.factory.publishValue(key, value)
+        else:
+            self.factory.waitForValue(self, name)
+
 
 class ExperimentServiceFactory(Factory):
     protocol = ExperimentServiceProto
 
-    def __init__(self, expected_subscribers, experiment_start_delay):
+    def __init__(self, expected_subscribers, experiment_start_delay, admission_rate=0, admission_backlog=1,
+                 metrics_file=None, abort_lost_fraction=None, abort_grace_period=60):
         self._logger = logging.getLogger(self.__class__.__name__)
 
         self.expected_subscribers = expected_subscribers
         self.experiment_start_delay = experiment_start_delay
+
+        # Phase timing of the experiment set up, only written if we got a file to write it to.
+        self.metrics = SyncMetrics(metrics_file) if metrics_file else None
+        self._markPhase('started')
+
+        # Token bucket used to admit the connections, a rate of 0 admits all of them
+        self.admission_rate = admission_rate
+        self.admission_backlog = admission_backlog
+        self._admission_tokens = admission_backlog
+        self._admission_timestamp = time()
+        self._admission_slots = deque()
         self.parsing_semaphore = DeferredSemaphore(500)
-        self.connection_counter = -1
         self.connections_made = []
         self.connections_ready = []
         self.vars_received = []
 
+        # Relay connections count as several subscribers, so keep track of the amount of subscribers separately.
+        self.subscribers_made = 0
+        self.subscribers_ready = 0
+        self.subscribers_received = 0
+        self.ids_pushed = False
+
         self._made_looping_call = None
         self._subscriber_looping_call = None
         self._subscriber_received_looping_call = None
         self._timeout_delayed_call = None
 
+        self.peer_records = {}
+        self.waiting_for_subscribers = False
+        # Barriers being waited for (name -> arrived connections), published values and connections waiting for them.
+        self.barriers = {}
+        self.published_values = {}
+        self.value_waiters = {}
+        # Peer tables are only written by the sync relays, as they run in the same node as the instances.
+        self.peer_table_path = None
+
+        # Abort the experiment if more than abort_lost_fraction of the subscribers sending heartbeats
+        # are lost for more than abort_grace_period seconds (None disables it).
+        self.abort_lost_fraction = abort_lost_fraction
+        self.abort_grace_period = abort_grace_period
+        self.monitored_subscribers = 0
+        self.finished_subscribers = 0
+        self.lost_subscribers = 0
+        self._lost_since = None
+        self._liveness_looping_call = None
+
     def buildProtocol(self, addr):
-        self.connection_counter += 1
-        return ExperimentServiceProto(self, self.connection_counter + 1)
+        return ExperimentServiceProto(self)
+
+    def _markPhase(self, event):
+        if self.metrics:
+            self.metrics.mark(event, time())
+
+    def _writeMetrics(self):
+        if self.metrics:
+            self._logger.info("Writing the sync metrics to %s", self.metrics.filename)
+            self.metrics.write(self.connections_made)
+
+    def admitConnection(self):
+        """
+        Returns 0 if a new connection can be admitted right now or the amount of seconds the
+        client should wait before retrying.
+        """
+        if not self.admission_rate:
+            return 0
+
+        now = time()
+        self._admission_tokens = min(self.admission_backlog,
+                                     self._admission_tokens + (now - self._admission_timestamp) * self.admission_rate)
+        self._admission_timestamp = now
+
+        # The clients coming back at their retry slot go first.
+        if self._admission_slots and self._admission_slots[0] <= now:
+            self._admission_slots.popleft()
+            return 0
+        if not self._admission_slots and self._admission_tokens >= 1:
+            self._admission_tokens -= 1
+            return 0
+
+        # Hand out the retry slots at the admission rate, so the clients come back one after another.
+        slot = max(now, self._admission_slots[-1] if self._admission_slots else 0) + 1.0 / self.admission_rate
+        self._admission_slots.append(slot)
+        return slot - now
 
     def setConnectionMade(self, proto):
         if not self._timeout_delayed_call:
@@ -191,9 +691,16 @@ class ExperimentServiceFactory(Factory):
         else:
             self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
 
+        if proto.relay:
+            self._logger.info("Sync relay %s is connecting %d subscribers.", proto.host, proto.subscribers)
         self.connections_made.append(proto)
-        if len(self.connections_made) >= self.expected_subscribers:
+        self.subscribers_made += proto.subscribers
+        self._checkConnectionsMade()
+
+    def _checkConnectionsMade(self):
+        if self.subscribers_made >= self.expected_subscribers:
             self._logger.info("All subscribers connected!")
+            self._markPhase('all_connected')
             if self._made_looping_call and self._made_looping_call.running:
                 self._made_looping_call.stop()
 
@@ -204,19 +711,30 @@ class ExperimentServiceFactory(Factory):
                 self._made_looping_call.start(1.0)
 
     def _print_subscribers_made(self):
-        if len(self.connections_made) < self.expected_subscribers:
-            self._logger.info("%d of %d expected subscribers connected.", len(self.connections_made), self.expected_subscribers)
+        if self.subscribers_made < self.expected_subscribers:
+            self._logger.info("%d of %d expected subscribers connected.", self.subscribers_made, self.expected_subscribers)
 
     def pushIdToSubscribers(self):
+        if self.ids_pushed:
+            return
+        self.ids_pushed = True
+
+        # The ids are used as peer numbers in the scenarios, so they have to be contiguous.
+        next_id = 1
         for proto in self.connections_made:
+            proto.ids = range(next_id, next_id + proto.subscribers)
+            proto.id = next_id
+            next_id += proto.subscribers
             self.parsing_semaphore.run(proto.sendAndWaitForReady)
 
     def setConnectionReady(self, proto):
         self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
         self.connections_ready.append(proto)
+        self.subscribers_ready += proto.subscribers
 
-        if len(self.connections_ready) >= self.expected_subscribers:
+        if self.subscribers_ready >= self.expected_subscribers:
             self._logger.info("All subscribers are ready, pushing data!")
+            self._markPhase('all_ready')
             if self._subscriber_looping_call and self._subscriber_looping_call.running:
                 self._subscriber_looping_call.stop()
 
@@ -227,36 +745,68 @@ class ExperimentServiceFactory(Factory):
                 self._subscriber_looping_call.start(1.0)
 
     def _print_subscribers_ready(self):
-        self._logger.info("%d of %d expected subscribers ready.", len(self.connections_ready),
+        self._logger.info("%d of %d expected subscribers ready.", self.subscribers_ready,
                           self.expected_subscribers)
 
     def pushInfoToSubscribers(self):
-        # Generate the json doc
-        vars = {}
+        # Generate the json doc, keep the vars around to answer the peer lookups
         for subscriber in self.connections_ready:
-            subscriber_vars = subscriber.vars.copy()
-            subscriber_vars['port'] = subscriber.id + 12000
-            subscriber_vars['host'] = subscriber.transport.getPeer().host
-            vars[subscriber.id] = subscriber_vars
+            for subscriber_id, subscriber_vars in subscriber.getSubscriberVars():
+                self.peer_records[str(subscriber_id)] = subscriber_vars
 
-        json_vars = json.dumps(vars)
-        del vars
-        self._logger.info("Pushing a %d bytes long json doc.", len(json_vars))
+        document = AllVarsDocument(json.dumps(self.peer_records))
+        self._logger.info("Pushing a %d bytes long json doc.", len(document.json_vars))
 
-        # Send the json doc to the subscribers
-        task.cooperate(self._sendLineToAllGenerator(json_vars))
+        if any(subscriber.compressed and not subscriber.lookup for subscriber in self.connections_ready):
+            self._logger.info("Compressed json doc is %d bytes long.", len(document.compressed))
+        if not all(subscriber.compressed or subscriber.lookup for subscriber in self.connections_ready) and \
+                len(document.json_vars) > ExperimentServiceProto.MAX_LENGTH:
+            self._logger.warning("The json doc exceeds the line length limit of the clients not using compression.")
 
-    def _sendLineToAllGenerator(self, line):
-        for subscriber in self.connections_ready:
-            yield subscriber.sendLine(line)
+        # Send the json doc to the subscribers
+        self._markPhase('push_started')
+        task.cooperate(sendAllVarsGenerator(self, self.connections_ready, document))
+
+    def getPeerCount(self):
+        return len(self.peer_records)
+
+    def getPeerRecords(self, peer_ids):
+        return dict((str(peer_id), self.peer_records[str(peer_id)]) for peer_id in peer_ids
+                    if str(peer_id) in self.peer_records)
+
+    def arriveAtBarrier(self, proto, name):
+        self.barriers.setdefault(name, set()).add(proto)
+        self._releaseBarriers()
+
+    def _releaseBarriers(self):
+        persistent = set(subscriber for subscriber in self.connections_ready if subscriber.persistent)
+        for name, arrived in self.barriers.items():
+            if persistent <= arrived:
+                self._logger.info("All persistent subscribers reached barrier %s.", name)
+                del self.barriers[name]
+                for subscriber in arrived & persistent:
+                    subscriber.sendLine("barrier:%s" % name)
+
+    def publishValue(self, key, value):
+        self.published_values[key] = value
+        for subscriber in self.value_waiters.pop(key, []):
+            subscriber.sendLine("value:%s:%s" % (key, value))
+
+    def waitForValue(self, proto, key):
+        if key in self.published_values:
+            proto.sendLine("value:%s:%s" % (key, self.published_values[key]))
+        else:
+            self.value_waiters.setdefault(key, []).append(proto)
 
     def setConnectionReceived(self, proto):
         self._timeout_delayed_call.reset(EXPERIMENT_SYNC_TIMEOUT)
         self.vars_received.append(proto)
+        self.subscribers_received += proto.subscribers
 
-        if len(self.vars_received) >= self.expected_subscribers:
+        if self.subscribers_received >= self.expected_subscribers:
             self._logger.info("Data sent to all subscribers, giving the go signal in %f secs.",
                               self.experiment_start_delay)
+            self._markPhase('all_received')
             reactor.callLater(0, self.startExperiment)
             self._timeout_delayed_call.cancel()
         else:
@@ -265,7 +815,7 @@ class ExperimentServiceFactory(Factory):
                 self._subscriber_received_looping_call.start(1.0)
 
     def _print_subscribers_received(self):
-        self._logger.info("%d of %d expected subscribers received the data.", len(self.vars_received),
+        self._logger.info("%d of %d expected subscribers received the data.", self.subscribers_received,
                           self.expected_subscribers)
 
     def startExperiment(self):
@@ -275,10 +825,22 @@ class ExperimentServiceFactory(Factory):
         if self._subscriber_received_looping_call and self._subscriber_received_looping_call.running:
             self._subscriber_received_looping_call.stop()
 
+        offset_errors = [peer_vars['time_offset_error'] for peer_vars in self.peer_records.itervalues()
+                         if 'time_offset_error' in peer_vars]
+        if offset_errors:
+            self._logger.info("Time offsets of %d subscribers estimated, max error is %f secs.",
+                              len(offset_errors), max(offset_errors))
+
         start_time = time() + self.experiment_start_delay
         for subscriber in self.connections_ready:
             # Sync the experiment start time among instances
             subscriber.sendLine("go:%f" % (start_time + subscriber.vars['time_offset']))
+        self._markPhase('go')
+        self._writeMetrics()
+
+        monitored = [subscriber for subscriber in self.connections_ready if subscriber.heartbeat_interval]
+        if monitored:
+            self.startLivenessMonitor(monitored)
 
         d = task.deferLater(reactor, 5, lambda: self._logger.info("Done, disconnecting all clients."))
         d.addCallback(lambda _: self.disconnectAll())
@@ -288,23 +850,88 @@ class ExperimentServiceFactory(Factory):
         reactor.runUntilCurrent()
 
         def _disconnectAll():
-            for subscriber in self.connections_ready:
+            # Keep the connections of the subscribers looking up peers on demand or coordinating
+            # during the experiment open.
+            for subscriber in [subscriber for subscriber in self.connections_ready if not subscriber.keepsConnection()]:
                 yield subscriber.transport.loseConnection()
         task.cooperate(_disconnectAll())
 
     def unregisterConnection(self, proto):
         if proto in self.connections_ready:
             self.connections_ready.remove(proto)
+            self.subscribers_ready -= proto.subscribers
         if proto in self.vars_received:
             self.vars_received.remove(proto)
-        if proto.id in self.vars_received:
-            self.vars_received.remove(proto.id)
+            self.subscribers_received -= proto.subscribers
+
+        for waiters in self.value_waiters.itervalues():
+            if proto in waiters:
+                waiters.remove(proto)
+        if proto.persistent:
+            # Don't keep the others waiting for a subscriber that is gone.
+            for arrived in self.barriers.itervalues():
+                arrived.discard(proto)
+            self._releaseBarriers()
+        if proto.heartbeat_interval:
+            self.finished_subscribers += proto.subscribers_finished
 
         self._logger.debug("Connection cleanly unregistered.")
 
+        if self.waiting_for_subscribers and not self.connections_ready:
+            self._logger.info("All the remaining subscribers disconnected, shutting down sync server.")
+            reactor.callLater(0, stopReactor)
+
     def onExperimentStarted(self, _):
-        self._logger.info("Experiment started, shutting down sync server.")
-        reactor.callLater(0, stopReactor)
+        open_subscribers = len([subscriber for subscriber in self.connections_ready if subscriber.keepsConnection()])
+        if open_subscribers:
+            self.waiting_for_subscribers = True
+            self._logger.info("Experiment started, keeping the sync server running for %d subscribers.",
+                              open_subscribers)
+        else:
+            self._logger.info("Experiment started, shutting down sync server.")
+            reactor.callLater(0, stopReactor)
+
+    def startLivenessMonitor(self, subscribers):
+        for subscriber in subscribers:
+            subscriber.resetHeartbeat()
+        self.monitored_subscribers = sum(subscriber.subscribers for subscriber in subscribers)
+        self._logger.info("Monitoring the heartbeats of %d subscribers.", self.monitored_subscribers)
+
+        self._liveness_looping_call = task.LoopingCall(self._checkLiveness)
+        self._liveness_looping_call.start(1.0, now=False)
+
+    def _checkLiveness(self):
+        now = time()
+        alive, finished = countSubscribers(self.connections_ready, now)
+        finished += self.finished_subscribers
+        lost = self.monitored_subscribers - alive - finished
+        if lost != self.lost_subscribers:
+            self._logger.info("%d of %d subscribers lost, %d finished.", lost, self.monitored_subscribers, finished)
+            self.lost_subscribers = lost
+
+        if self.abort_lost_fraction is None:
+            return
+        if lost > self.abort_lost_fraction * self.monitored_subscribers:
+            if self._lost_since is None:
+                self._logger.warning("Too many subscribers lost, aborting the experiment if they don't come back in "
+                                     "%f secs.", self.abort_grace_period)
+                self._lost_since = now
+            elif now - self._lost_since >= self.abort_grace_period:
+                self.abortExperiment()
+        else:
+            self._lost_since = None
+
+    def abortExperiment(self):
+        self._logger.error("%d of %d subscribers lost for more than %f secs, aborting the experiment.",
+                           self.lost_subscribers, self.monitored_subscribers, self.abort_grace_period)
+        self._liveness_looping_call.stop()
+        self.waiting_for_subscribers = False
+        for subscriber in self.connections_ready:
+            if subscriber.heartbeat_interval:
+                subscriber.sendLine("abort")
+        reactor.exitCode = EXPERIMENT_ABORTED_EXIT_CODE
+        # Give the abort lines some time to get out
+        reactor.callLater(1, stopReactor)
 
     def onExperimentStartError(self, failure):
         self._logger.error("Failed to start experiment")
@@ -314,6 +941,7 @@ class ExperimentServiceFactory(Factory):
 
     def onExperimentSetupTimeout(self):
         self._logger.error("Waiting for all peers timed out, exiting.")
+        self._writeMetrics()
         reactor.exitCode = 1
         reactor.callLater(0, stopReactor)
 
@@ -328,25 +956,97 @@ class ExperimentClient(LineReceiver):
     # Allow for 4MB long lines (for the json stuff)
     MAX_LENGTH = 2 ** 22
 
+    # Set to True to only get the vars of the peers requested with fetch_peers() instead of all of them. Only for
+    # clients that call fetch_peers() before looking a peer up, the other peers are unknown to get_peer_id(),
+    # get_peer_ip_port_by_id() and get_peer_vars().
+    peer_lookup = False
+    # Set to True to read the vars of the peers from the node-local peer table when connected to a sync relay.
+    use_peer_table = False
+    # Max amount of decoded peer keys to keep in memory (None means all of them)
+    max_cached_keys = None
+    # Set to True to keep the connection open during the experiment to use barriers and published values.
+    persistent_sync = False
+    # Seconds between the heartbeats sent to the experiment server during the experiment (None disables them).
+    heartbeat_interval = None
+
     def __init__(self, vars):
         self._logger = logging.getLogger(self.__class__.__name__)
 
-        self.state = "id"
+        self.state = "admission"
         self.my_id = None
         self.vars = vars
         self.all_vars = {}
+        self.peer_directory = PeerDirectory()
         self.time_offset = None
+        self._peer_table = None
+
+        self.peer_count = None
+        self._lookup_pending = []
+        self._lookup_waiting = []
+        self._lookup_requests = []
+        self._lookup_delayed_call = None
+
+        self._barrier_waiting = {}
+        self._value_waiting = {}
+        self._heartbeat_looping_call = None
+        self._close_waiting = []
 
     def connectionMade(self):
-        self._logger.debug("Connected to the experiment server")
+        self._logger.debug("Connected to the experiment server, waiting to be admitted")
+        self.sendLine("admission")
+
+    def onAdmitted(self):
+        """
+        Sends the info of this instance once the server admitted the connection, returns the next state.
+        """
         self.sendLine("time:%f" % time())
+        self.sendLine("client")
+        self.sendLine("clock_sync")
+        self.sendLine("compress:zlib")
+        if self.peer_lookup:
+            self.sendLine("lookup")
+        if self.use_peer_table:
+            self.sendLine("peer_table")
+        if self.persistent_sync:
+            self.sendLine("persistent")
+        if self.heartbeat_interval:
+            self.sendLine("heartbeat:%f" % self.heartbeat_interval)
         for key, val in self.vars.iteritems():
             self.sendLine("set:%s:%s" % (key, val))
 
         d = deferToThread(self.onVarsSend)
-        self.state = "id"
+        return "id"
 
     def lineReceived(self, line):
+        if line.startswith("ping:"):
+            # Clock sync round trips can arrive in any state
+            self.sendLine("pong:%s:%f" % (line.strip().split(':')[1], time()))
+            return
+
+        if line.startswith("peers:"):
+            # Peer lookup replies can arrive in any state
+            self.onPeersReceived(line)
+            return
+
+        if line.startswith("barrier:"):
+            self.onBarrierReleased(line.strip().split(':', 1)[1])
+            return
+
+        if line.startswith("value:"):
+            _, key, value = line.strip().split(':', 2)
+            self.onValueReceived(key, value)
+            return
+
+        if line.strip() == "abort":
+            self.onAbort()
+            return
+
+        if line.startswith("retry:"):
+            # The server is busy, it will tell us when to try again.
+            self.factory.retryLater(float(line.strip().split(':')[1]))
+            self.transport.loseConnection()
+            return
+
         try:
             pto = 'proto_' + self.state
             statehandler = getattr(self, pto)
@@ -358,6 +1058,30 @@ class ExperimentClient(LineReceiver):
             if self.state == 'done':
                 self.transport.loseConnection()
 
+    def connectionLost(self, reason=connectionDone):
+        if self._heartbeat_looping_call and self._heartbeat_looping_call.running:
+            self._heartbeat_looping_call.stop()
+        LineReceiver.connectionLost(self, reason)
+        waiting, self._close_waiting = self._close_waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def closeConnection(self):
+        """
+        Closes the connection once everything written to it has been sent, or after CLOSE_TIMEOUT secs.
+
+        Returns a Deferred that fires once the connection is closed.
+        """
+        if not self.connected:
+            return succeed(None)
+
+        d = Deferred()
+        self._close_waiting.append(d)
+        timeout = reactor.callLater(CLOSE_TIMEOUT, self.transport.abortConnection)
+        d.addCallback(lambda _: timeout.active() and timeout.cancel())
+        self.transport.loseConnection()
+        return d
+
     def onVarsSend(self):
         self._logger.debug("onVarsSend: Call not implemented")
 
@@ -371,24 +1095,128 @@ class ExperimentClient(LineReceiver):
         self._logger.debug("startExperiment: Call not implemented")
 
     def get_peer_id(self, ip, port):
-        port = int(port)
-        for peer_id, peer_dict in self.all_vars.iteritems():
-            if peer_dict['host'] == ip and int(peer_dict['port']) == port:
-                return peer_id
-
-        self._logger.error("Could not get_peer_id for %s:%s", ip, port)
+        peer_id = self.peer_directory.get_id(ip, port)
+        if peer_id is None:
+            self._logger.error("Could not get_peer_id for %s:%s", ip, port)
+        return peer_id
 
     def get_peer_ip_port_by_id(self, peer_id):
-        if str(peer_id) in self.all_vars:
-            return self.all_vars[str(peer_id)]['host'], self.all_vars[str(peer_id)]['port']
+        return self.peer_directory.get_address(peer_id)
+
+    def get_peer_vars(self, peer_id):
+        return self.peer_directory.get_vars(peer_id)
 
     def get_peers(self):
-        return self.all_vars.keys()
+        return self.peer_directory.get_ids()
+
+    def fetch_peers(self, peer_ids):
+        """
+        Makes sure the vars of the given peers are available in all_vars. In peer lookup mode, the missing
+        ones will be requested from the experiment server, batching all the requests made in the same
+        reactor iteration.
+
+        Returns a Deferred that fires once all of them are available.
+        """
+        missing = [str(peer_id) for peer_id in peer_ids if str(peer_id) not in self.all_vars]
+        if not missing or not self.peer_lookup:
+            return succeed(None)
+
+        d = Deferred()
+        self._lookup_pending.extend(missing)
+        self._lookup_waiting.append(d)
+        if not self._lookup_delayed_call:
+            self._lookup_delayed_call = reactor.callLater(0, self._sendPeerLookups)
+        return d
+
+    def _sendPeerLookups(self):
+        self._lookup_delayed_call = None
+        peer_ids = sorted(set(self._lookup_pending))
+        waiting = self._lookup_waiting
+        self._lookup_pending = []
+        self._lookup_waiting = []
+
+        for i in xrange(0, len(peer_ids), PEER_LOOKUP_BATCH_SIZE):
+            self.sendLine("get:%s" % ",".join(peer_ids[i:i + PEER_LOOKUP_BATCH_SIZE]))
+            self._lookup_requests.append([])
+        # The replies come in order, so fire the deferreds when the last batch arrives
+        self._lookup_requests[-1] = waiting
+
+    def onPeersReceived(self, line):
+        peers = json.loads(line.split(':', 1)[1])
+        self.all_vars.update(peers)
+        self.peer_directory.update(peers)
+        for d in self._lookup_requests.pop(0):
+            d.callback(None)
+
+    def barrier(self, name):
+        """
+        Waits until all the persistent instances reach the barrier with the given name.
+
+        Returns a Deferred that fires with the name once they did.
+        """
+        d = Deferred()
+        if name not in self._barrier_waiting:
+            self._barrier_waiting[name] = []
+            self.sendLine("barrier:%s" % name)
+        self._barrier_waiting[name].append(d)
+        return d
+
+    def onBarrierReleased(self, name):
+        for d in self._barrier_waiting.pop(name, []):
+            d.callback(name)
+
+    def publish_sync_value(self, key, value):
+        """
+        Publishes a value for the persistent instances waiting for key with wait_for_value().
+        """
+        self.sendLine("publish:%s:%s" % (key, value))
+
+    def wait_for_value(self, key):
+        """
+        Returns a Deferred that fires with the value published for key by any of the persistent instances.
+        """
+        d = Deferred()
+        if key not in self._value_waiting:
+            self._value_waiting[key] = []
+            self.sendLine("wait:%s" % key)
+        self._value_waiting[key].append(d)
+        return d
+
+    def onValueReceived(self, key, value):
+        for d in self._value_waiting.pop(key, []):
+            d.callback(value)
+
+    def startHeartbeats(self):
+        self._heartbeat_looping_call = task.LoopingCall(self.sendLine, "alive")
+        self._heartbeat_looping_call.start(self.heartbeat_interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.sayBye)
+
+    def sayBye(self):
+        """
+        Lets the server know we are done when stopping, so we don't get counted as lost. The shutdown
+        waits for the returned Deferred, so the bye line is sent before the connection is dropped.
+        """
+        if not self.connected:
+            return
+        self._heartbeat_looping_call.stop()
+        self.sendLine("bye")
+        return self.closeConnection()
+
+    def onAbort(self):
+        self._logger.error("The experiment server aborted the experiment, stopping.")
+        reactor.exitCode = 1
+        reactor.callLater(0, stopReactor)
 
     #
     # Protocol state handlers
     #
 
+    def proto_admission(self, line):
+        if line.strip() == "admitted":
+            return self.onAdmitted()
+        self._logger.error("Received an unexpected string from the server, closing connection")
+        return "done"
+
     def proto_id(self, line):
         # We should get a line such as:
         # id:SOMETHING
@@ -404,9 +1232,40 @@ class ExperimentClient(LineReceiver):
             return "done"
 
     def proto_all_vars(self, line):
+        if line.startswith("table:"):
+            self._peer_table = PeerTable(line.strip().split(':', 1)[1])
+            own_vars = {self.my_id: self._peer_table.get_vars(self.my_id)}
+            return self.handleAllVars(AllVarsDocument(json_vars=json.dumps(own_vars)))
+
+        if line.startswith("lookup:"):
+            _, peer_count, own_vars = line.split(':', 2)
+            self.peer_count = int(peer_count)
+            return self.handleAllVars(AllVarsDocument(json_vars=own_vars))
+
+        if line.startswith("zvars:"):
+            # The document comes as a compressed frame right after this line.
+            self._frame_length = int(line.strip().split(':')[1])
+            self._frame_buffer = []
+            self._frame_received = 0
+            self.setRawMode()
+            return "all_vars"
+
+        return self.handleAllVars(AllVarsDocument(json_vars=line))
+
+    def rawDataReceived(self, data):
+        self._frame_buffer.append(data)
+        self._frame_received += len(data)
+        if self._frame_received >= self._frame_length:
+            data = "".join(self._frame_buffer)
+            self._frame_buffer = []
+            self.state = self.handleAllVars(AllVarsDocument(compressed=data[:self._frame_length]))
+            self.setLineMode(data[self._frame_length:])
+
+    def handleAllVars(self, document):
         self._logger.debug("Got experiment variables")
 
-        self.all_vars = json.loads(line)
+        self.all_vars = json.loads(document.json_vars)
+        self.peer_directory = PeerDirectory(self.all_vars, self._peer_table, self.peer_count, self.max_cached_keys)
         self.time_offset = self.all_vars[self.my_id]["time_offset"]
         self.onAllVarsReceived()
 
@@ -420,8 +1279,17 @@ class ExperimentClient(LineReceiver):
             self._logger.info("Starting the experiment in %f secs.", start_delay)
             reactor.callLater(start_delay, self.startExperiment)
             self.factory.stopTrying()
+            if self.heartbeat_interval:
+                self.startHeartbeats()
+            if self.peer_lookup or self.persistent_sync or self.heartbeat_interval:
+                # Keep the connection open to be able to fetch more peers or to sync during the experiment
+                return "open"
             self.transport.loseConnection()
 
+    def proto_open(self, line):
+        self._logger.error("Received an unexpected string from the server: %s", line)
+        return "open"
+
 
 class ExperimentClientFactory(ReconnectingClientFactory):
     maxDelay = 10
@@ -429,23 +1297,334 @@ class ExperimentClientFactory(ReconnectingClientFactory):
     def __init__(self, vars, protocol=ExperimentClient):
         self._logger = logging.getLogger(self.__class__.__name__)
 
+        # Shared by the clients of all the connection attempts
         self.vars = vars
         self.protocol = protocol
+        self._retry_delay = None
 
     def buildProtocol(self, address):
         self._logger.debug("Attempting to connect to the experiment server.")
+        self.resetDelay()
         p = self.protocol(self.vars)
         p.factory = self
         return p
 
+    def retryLater(self, delay):
+        self._retry_delay = delay
+
     def clientConnectionFailed(self, connector, reason):
         self._logger.error("Failed to connect to experiment server (will retry in a while), error was: %s",
                            reason.getErrorMessage())
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
 
     def clientConnectionLost(self, connector, reason):
+        if self._retry_delay is not None:
+            self._logger.info("The experiment server is busy, retrying in %f secs.", self._retry_delay)
+            self.connector = connector
+            self._callID = reactor.callLater(self._retry_delay, self._retryConnect)
+            self._retry_delay = None
+            return True
+
         self._logger.info("The connection with the experiment server was lost with reason: %s",
                           reason.getErrorMessage())
 
+    def _retryConnect(self):
+        self._callID = None
+        self.connector.connect()
+
+#
+# Relay side
+#
+
+
+class ExperimentRelayFactory(Factory):
+
+    """
+    Acts as an experiment server for the instances running on this node and joins all of them into a single connection
+    to the real experiment server.
+    """
+    protocol = ExperimentServiceProto
+
+    def __init__(self, expected_subscribers, peer_table_dir=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.expected_subscribers = expected_subscribers
+        self.peer_table_dir = peer_table_dir or gettempdir()
+        self.peer_table_path = None
+        self.connections_made = []
+        self.connections_ready = []
+        self.vars_received = []
+        self.upstream = None
+        self.ids = None
+        self.started = False
+        self.ids_pushed = False
+        self.document = None
+        self.peer_records = None
+        # Barriers reached by the local persistent subscribers, the ones already entered upstream
+        # and the values received from the experiment server.
+        self.barriers = {}
+        self.barriers_entered = set()
+        self.published_values = {}
+        self.value_waiters = {}
+        # Subscribers sending heartbeats that already finished and disconnected.
+        self.finished_subscribers = 0
+        self._heartbeat_looping_call = None
+
+    def buildProtocol(self, addr):
+        return ExperimentServiceProto(self)
+
+    def admitConnection(self):
+        # All the local subscribers are admitted right away.
+        return 0
+
+    def setUpstream(self, upstream):
+        self.upstream = upstream
+
+    def setIds(self, ids):
+        self.ids = ids
+        self._pushIdToSubscribers()
+
+    def setConnectionMade(self, proto):
+        self.connections_made.append(proto)
+        self._pushIdToSubscribers()
+
+    def _pushIdToSubscribers(self):
+        if self.ids_pushed or self.ids is None or len(self.connections_made) < self.expected_subscribers:
+            return
+        self.ids_pushed = True
+
+        self._logger.info("All local subscribers connected, assigning ids.")
+        for proto, peer_id in zip(self.connections_made, self.ids):
+            proto.id = peer_id
+            proto.sendAndWaitForReady()
+
+    def setConnectionReady(self, proto):
+        self.connections_ready.append(proto)
+        if len(self.connections_ready) >= self.expected_subscribers:
+            self._logger.info("All local subscribers are ready, notifying the experiment server.")
+            self.upstream.sendSubscribersReady(self.connections_ready)
+
+    def pushInfoToSubscribers(self, document):
+        self.document = document
+        if any(subscriber.peer_table for subscriber in self.connections_ready):
+            self.peer_table_path = path.join(self.peer_table_dir, "gumby_peer_table_%d" % getpid())
+            self._logger.info("Writing the peer table to %s", self.peer_table_path)
+            write_peer_table(self.peer_table_path, self._loadPeerRecords())
+        task.cooperate(sendAllVarsGenerator(self, self.connections_ready, document))
+
+    def _loadPeerRecords(self):
+        # Only parse the document if any of the local subscribers wants to look up peers
+        if self.peer_records is None:
+            self.peer_records = json.loads(self.document.json_vars)
+        return self.peer_records
+
+    def getPeerCount(self):
+        return len(self._loadPeerRecords())
+
+    def getPeerRecords(self, peer_ids):
+        peer_records = self._loadPeerRecords()
+        return dict((str(peer_id), peer_records[str(peer_id)]) for peer_id in peer_ids
+                    if str(peer_id) in peer_records)
+
+    def setConnectionReceived(self, proto):
+        self.vars_received.append(proto)
+        if len(self.vars_received) >= self.expected_subscribers:
+            self._logger.info("Data sent to all local subscribers.")
+            self.upstream.sendLine("vars_received")
+
+    def hasPersistentSubscribers(self):
+        return any(subscriber.persistent for subscriber in self.connections_ready)
+
+    def getHeartbeatInterval(self):
+        intervals = [subscriber.heartbeat_interval for subscriber in self.connections_ready
+                     if subscriber.heartbeat_interval]
+        return min(intervals) if intervals else None
+
+    def sendHeartbeat(self):
+        alive, finished = countSubscribers(self.connections_ready, time())
+        self.upstream.sendLine("alive:%d:%d" % (alive, finished + self.finished_subscribers))
+
+    def abortExperiment(self):
+        self._logger.error("The experiment server aborted the experiment, relaying it to the local subscribers.")
+        reactor.exitCode = 1
+        for subscriber in self.connections_ready:
+            if subscriber.heartbeat_interval:
+                subscriber.sendLine("abort")
+
+    def arriveAtBarrier(self, proto, name):
+        self.barriers.setdefault(name, set()).add(proto)
+        self._enterBarriers()
+
+    def _enterBarriers(self):
+        # Enter a barrier upstream once all of the local persistent subscribers reached it.
+        persistent = set(subscriber for subscriber in self.connections_ready if subscriber.persistent)
+        for name, arrived in self.barriers.iteritems():
+            if name not in self.barriers_entered and persistent <= arrived:
+                self.barriers_entered.add(name)
+                self.upstream.sendLine("barrier:%s" % name)
+
+    def onBarrierReleased(self, name):
+        self.barriers_entered.discard(name)
+        for subscriber in self.barriers.pop(name, set()):
+            if subscriber in self.connections_ready:
+                subscriber.sendLine("barrier:%s" % name)
+
+    def publishValue(self, key, value):
+        self.upstream.sendLine("publish:%s:%s" % (key, value))
+
+    def waitForValue(self, proto, key):
+        if key in self.published_values:
+            proto.sendLine("value:%s:%s" % (key, self.published_values[key]))
+            return
+        if key not in self.value_waiters:
+            self.value_waiters[key] = []
+            self.upstream.sendLine("wait:%s" % key)
+        self.value_waiters[key].append(proto)
+
+    def onValueReceived(self, key, value):
+        self.published_values[key] = value
+        for subscriber in self.value_waiters.pop(key, []):
+            subscriber.sendLine("value:%s:%s" % (key, value))
+
+    def startExperiment(self, start_time):
+        self._logger.info("Relaying the go signal to the local subscribers.")
+        self.started = True
+        for subscriber in self.connections_ready:
+            subscriber.sendLine("go:%f" % (start_time + subscriber.vars['time_offset']))
+
+        heartbeat_interval = self.getHeartbeatInterval()
+        if heartbeat_interval:
+            for subscriber in self.connections_ready:
+                if subscriber.heartbeat_interval:
+                    subscriber.resetHeartbeat()
+            self._heartbeat_looping_call = task.LoopingCall(self.sendHeartbeat)
+            self._heartbeat_looping_call.start(heartbeat_interval, now=False)
+
+    def unregisterConnection(self, proto):
+        if proto in self.connections_ready:
+            self.connections_ready.remove(proto)
+        if proto in self.vars_received:
+            self.vars_received.remove(proto)
+        for waiters in self.value_waiters.itervalues():
+            if proto in waiters:
+                waiters.remove(proto)
+        if proto.persistent and self.upstream:
+            for arrived in self.barriers.itervalues():
+                arrived.discard(proto)
+            self._enterBarriers()
+        if proto.heartbeat_interval:
+            self.finished_subscribers += proto.subscribers_finished
+
+        if self.started and not self.connections_ready:
+            self._logger.info("All local subscribers started the experiment, shutting down sync relay.")
+            if self.peer_table_path:
+                # The instances keep their mapping of the table after it gets unlinked.
+                unlink(self.peer_table_path)
+            if self._heartbeat_looping_call:
+                # Make sure the server gets the last heartbeat with all of them finished before stopping
+                self._heartbeat_looping_call.stop()
+                self.sendHeartbeat()
+                self.upstream.closeConnection().addCallback(lambda _: stopReactor())
+            else:
+                reactor.callLater(0, stopReactor)
+
+    def onUpstreamLost(self):
+        if not self.started:
+            self._logger.error("Lost the connection with the experiment server before starting, exiting.")
+            reactor.exitCode = 1
+            reactor.callLater(0, stopReactor)
+
+
+class ExperimentRelayClient(ExperimentClient):
+
+    def __init__(self, relay):
+        ExperimentClient.__init__(self, {})
+
+        self.relay = relay
+
+    def connectionMade(self):
+        self._logger.debug("Connected to the experiment server, waiting to be admitted")
+        self.relay.setUpstream(self)
+        self.sendLine("admission")
+
+    def onAdmitted(self):
+        self.sendLine("time:%f" % time())
+        self.sendLine("clock_sync")
+        self.sendLine("compress:zlib")
+        self.sendLine("relay:%d" % self.relay.expected_subscribers)
+        return "ids"
+
+    def sendSubscribersReady(self, subscribers):
+        for subscriber in subscribers:
+            self.sendLine("peer:%d:offset:%f" % (subscriber.id, subscriber.vars['time_offset']))
+            for key, value in subscriber.vars.iteritems():
+                if key != 'time_offset':
+                    self.sendLine("peer:%d:set:%s:%s" % (subscriber.id, key, value))
+        if self.relay.hasPersistentSubscribers():
+            self.sendLine("persistent")
+        if self.relay.getHeartbeatInterval():
+            self.sendLine("heartbeat:%f" % self.relay.getHeartbeatInterval())
+        self.sendLine("ready")
+
+    def onBarrierReleased(self, name):
+        self.relay.onBarrierReleased(name)
+
+    def onValueReceived(self, key, value):
+        self.relay.onValueReceived(key, value)
+
+    def onAbort(self):
+        self.relay.abortExperiment()
+
+    #
+    # Protocol state handlers
+    #
+
+    def proto_ids(self, line):
+        maybe_ids, ids = line.strip().split(':', 1)
+        if maybe_ids == "ids":
+            self._logger.debug('Got ids: "%s" assigned', ids)
+            self.relay.setIds([int(peer_id) for peer_id in ids.split(',')])
+            return "all_vars"
+        else:
+            self._logger.error("Received an unexpected string from the server, closing connection")
+            return "done"
+
+    def handleAllVars(self, document):
+        self._logger.debug("Got experiment variables, relaying them.")
+        self.relay.pushInfoToSubscribers(document)
+        return "go"
+
+    def proto_go(self, line):
+        self._logger.debug("Got GO signal")
+        if line.strip().startswith("go:"):
+            self.relay.startExperiment(float(line.strip().split(":")[1]))
+            self.factory.stopTrying()
+            if self.relay.hasPersistentSubscribers() or self.relay.getHeartbeatInterval():
+                # Keep relaying the barriers, values and heartbeats of the local subscribers
+                return "open"
+            return "done"
+        self._logger.error("Received an unexpected string from the server, closing connection")
+        return "done"
+
+
+class ExperimentRelayClientFactory(ExperimentClientFactory):
+
+    def __init__(self, relay):
+        ExperimentClientFactory.__init__(self, {}, ExperimentRelayClient)
+
+        self.relay = relay
+
+    def buildProtocol(self, address):
+        self._logger.debug("Attempting to connect to the experiment server.")
+        self.resetDelay()
+        p = ExperimentRelayClient(self.relay)
+        p.factory = self
+        return p
+
+    def clientConnectionLost(self, connector, reason):
+        if not ExperimentClientFactory.clientConnectionLost(self, connector, reason):
+            self.relay.onUpstreamLost()
+
 #
 # Aux stuff
 #
@@ -0,0 +1,131 @@
+# syncmetrics.py ---
+#
+# Filename: syncmetrics.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 04:02:37 2026 (+0200)
+
+# Commentary:
+#
+# Start-up phase metrics of the experiment server.
+#
+# The server protocol timestamps every subscriber connection when it gets through each phase of
+# the sync protocol. Once the experiment is started (or the setup times out) the timestamps are
+# summarized into a JSON document with:
+# * The distribution of the latency of each phase among the connections:
+#   - connect: Since the server started listening until the connection was admitted.
+#   - ready:   Since the id was sent until the connection said it was ready.
+#   - push:    Since the server started pushing the vars until they were written to the connection.
+#   - ack:     Since the vars were written until the connection sent vars_received.
+# * The amount of bytes pushed and how long the push took.
+# * The slowest connections (by the time spent in the ready and ack phases) with their host.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+
+# (name, timestamp where the phase starts, timestamp where it ends). A None start means the server start time.
+# A subscriber is pushed once all of the document has been written to its socket, not when it was queued.
+PHASES = (('connect', None, 'connected'),
+          ('ready', 'id_sent', 'ready'),
+          ('push', 'push_started', 'pushed'),
+          ('ack', 'pushed', 'received'))
+
+
+def summarize(values):
+    """
+    Returns the distribution of a list of values as a dict.
+    """
+    if not values:
+        return {'count': 0}
+
+    values = sorted(values)
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    return {'count': len(values),
+            'min': values[0],
+            'mean': sum(values) / len(values),
+            'median': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+            'max': values[-1]}
+
+
+class SyncMetrics(object):
+
+    def __init__(self, filename, slowest=10):
+        self.filename = filename
+        self.slowest = slowest
+        self.timestamps = {}
+
+    def mark(self, event, timestamp):
+        """
+        Records the first time an event of the server happened (all connected, push started...)
+        """
+        self.timestamps.setdefault(event, timestamp)
+
+    def collect(self, connections):
+        started = self.timestamps['started']
+        phases = dict((name, []) for name, _, _ in PHASES)
+        subscribers = []
+        bytes_pushed = 0
+
+        for proto in connections:
+            stamps = dict(proto.timestamps, push_started=self.timestamps.get('push_started'))
+            latencies = {}
+            for name, start, end in PHASES:
+                start_time = started if start is None else stamps.get(start)
+                if start_time is not None and end in stamps:
+                    latencies[name] = stamps[end] - start_time
+                    phases[name].append(latencies[name])
+            bytes_pushed += proto.bytes_pushed
+            subscribers.append({'host': proto.host,
+                                'ids': list(proto.ids) if proto.relay else [proto.id],
+                                'latencies': latencies})
+
+        # The time the server spent waiting for each connection, the rest depends on the others.
+        subscribers.sort(key=lambda subscriber: subscriber['latencies'].get('ready', 0) +
+                         subscriber['latencies'].get('ack', 0), reverse=True)
+
+        pushed = [proto.timestamps['pushed'] for proto in connections if 'pushed' in proto.timestamps]
+        push_duration = max(pushed) - self.timestamps['push_started'] if pushed else None
+
+        return {'connections': len(connections),
+                'timestamps': dict((event, timestamp - started) for event, timestamp in self.timestamps.iteritems()),
+                'phases': dict((name, summarize(values)) for name, values in phases.iteritems()),
+                'bytes_pushed': bytes_pushed,
+                'push_duration': push_duration,
+                'slowest': subscribers[:self.slowest]}
+
+    def write(self, connections):
+        with open(self.filename, 'w') as metrics_file:
+            json.dump(self.collect(connections), metrics_file, indent=2, sort_keys=True)
+
+#
+# syncmetrics.py ends here
@@ -0,0 +1,101 @@
+# test_scenario.py ---
+#
+# Filename: test_scenario.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 21:14:52 2026 (+0200)
+
+# Commentary:
+#
+# Tests of the execution policies of the ScenarioRunner, run them with: trial gumby.tests
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import threading
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from gumby.scenario import EXECUTE_IN_THREAD, ScenarioRunner
+
+
+class _RecordingRunner(ScenarioRunner):
+
+    """
+    Fires finished once the given amount of calls have been recorded on the reactor thread.
+    """
+
+    def __init__(self, calls, *args, **kwargs):
+        ScenarioRunner.__init__(self, *args, **kwargs)
+        self.calls = calls
+        self.finished = Deferred()
+
+    def _finish_call(self, result, name, tstmps, in_reactor):
+        ScenarioRunner._finish_call(self, result, name, tstmps, in_reactor)
+        self.calls -= 1
+        if not self.calls:
+            self.finished.callback(None)
+
+
+class TestThreadPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.scenario_file = self.mktemp()
+        with open(self.scenario_file, 'w') as f:
+            f.write("@0:0 work 1\n@0:0 work 2\n")
+        self.threads = []
+
+    def work(self, value):
+        self.threads.append((threading.current_thread(), value))
+
+    def test_runs_in_thread_pool(self):
+        runner = _RecordingRunner(2, self.scenario_file, thread_pool_size=2)
+        runner.register(self.work, 'work', EXECUTE_IN_THREAD)
+        runner.run()
+        self.addCleanup(lambda: runner._thread_pool and runner._thread_pool.stop())
+
+        def check(_):
+            self.assertEqual(sorted(value for _, value in self.threads), ['1', '2'])
+            self.assertNotIn(threading.current_thread(), [thread for thread, _ in self.threads])
+            self.assertEqual(runner.get_action_stats()['work']['calls'], 2)
+        return runner.finished.addCallback(check)
+
+    def test_runs_in_place_with_clock(self):
+        # A Clock can't get calls from other threads, like the one of the dry runs
+        clock = Clock()
+        runner = ScenarioRunner(self.scenario_file, expstartstamp=0, clock=clock)
+        runner.register(self.work, 'work', EXECUTE_IN_THREAD)
+        runner.run()
+        clock.advance(1)
+
+        self.assertEqual(self.threads, [(threading.current_thread(), '1'), (threading.current_thread(), '2')])
+        self.assertIsNone(runner._thread_pool)
+        self.assertEqual(runner.get_action_stats()['work']['calls'], 2)
+
+#
+# test_scenario.py ends here
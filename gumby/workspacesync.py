@@ -0,0 +1,208 @@
+# workspacesync.py ---
+#
+# Filename: workspacesync.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 16:41:09 2026 (+0200)
+
+# Commentary:
+#
+# Manifest based workspace syncing.
+#
+# Instead of having rsync stat and checksum the whole workspace on both ends for every run, the
+# workspace is described by a manifest (relative path -> content hash and mode). The hashes are
+# cached by size and mtime, so only the files that were touched are read again.
+#
+# The manifest last sent to every head node is kept locally, and its digest on the head node. When
+# the digest on the head node matches the one recorded locally, only the difference between both
+# manifests is sent: the changed files and the list of deleted ones, in a single compressed tar
+# stream. When the manifests are identical nothing is sent at all, and when the head node doesn't
+# have the expected digest (new head node, wiped workspace...) everything is sent.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+import os
+import stat
+import tarfile
+from fnmatch import fnmatch
+from hashlib import sha1
+from pipes import quote
+
+# Names (of files or directories, at any depth) that are never synced, the same ones rsync excluded
+EXCLUDES = (".git*", ".svn", "local", "output")
+
+# Written to the workspace on the head node by the sync
+MANIFEST_DIGEST_FILENAME = ".gumby_workspace_manifest"
+DELETED_FILENAME = ".gumby_workspace_deleted"
+
+_BLOCK_SIZE = 1 << 20
+
+
+def _excluded(name):
+    return any(fnmatch(name, pattern) for pattern in EXCLUDES)
+
+
+def _hash_file(filename):
+    digest = sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _load_json(filename, default):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def _utf8_keys(entries):
+    # json gives back unicode, while os.walk gives the paths as str
+    return dict((relpath.encode('utf-8'), [value.encode('utf-8') if isinstance(value, unicode) else value
+                                           for value in entry])
+                for relpath, entry in entries.iteritems())
+
+
+def _save_json(filename, obj):
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_filename = "%s.tmp.%d" % (filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(obj, f)
+    os.rename(tmp_filename, filename)
+
+
+def build_manifest(root, cache_filename):
+    """
+    Returns the manifest of the workspace at root: a dict of relative path -> [hash, mode]. The hashes
+    are cached in cache_filename by size and mtime, so unchanged files aren't read again.
+    """
+    cache = _utf8_keys(_load_json(cache_filename, {}))
+    new_cache = {}
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not _excluded(name)]
+        # os.walk doesn't recurse into symlinked directories, they are synced as links
+        for name in filenames + [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]:
+            if _excluded(name):
+                continue
+            filename = os.path.join(dirpath, name)
+            relpath = os.path.relpath(filename, root)
+            st = os.lstat(filename)
+            if stat.S_ISLNK(st.st_mode):
+                manifest[relpath] = ["link:" + os.readlink(filename), None]
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+
+            key = [st.st_size, st.st_mtime]
+            cached = cache.get(relpath)
+            if cached and cached[:2] == key:
+                digest = cached[2]
+            else:
+                digest = _hash_file(filename)
+            new_cache[relpath] = key + [digest]
+            manifest[relpath] = [digest, stat.S_IMODE(st.st_mode)]
+
+    _save_json(cache_filename, new_cache)
+    return manifest
+
+
+def manifest_digest(manifest):
+    return sha1(json.dumps(manifest, sort_keys=True)).hexdigest()
+
+
+def diff_manifests(old, new):
+    """
+    Returns the sorted lists of the paths that have to be sent and the ones that have to be deleted
+    to turn a workspace described by old into one described by new.
+    """
+    changed = sorted(relpath for relpath, entry in new.iteritems() if old.get(relpath) != entry)
+    deleted = sorted(relpath for relpath in old if relpath not in new)
+    return changed, deleted
+
+
+def load_synced_manifest(filename):
+    """
+    Returns the digest and the manifest last synced to a head node, recorded by save_synced_manifest().
+    """
+    synced = _load_json(filename, {})
+    return synced.get('digest'), _utf8_keys(synced.get('files', {}))
+
+
+def save_synced_manifest(filename, manifest):
+    _save_json(filename, {'digest': manifest_digest(manifest), 'files': manifest})
+
+
+def write_sync_archive(root, changed, deleted, archive_filename):
+    """
+    Writes the changed files and the list of deleted ones to a gzipped tar archive, returns the
+    amount of bytes archived.
+    """
+    raw_bytes = 0
+    with tarfile.open(archive_filename, 'w:gz', compresslevel=6) as archive:
+        for relpath in changed:
+            filename = os.path.join(root, relpath)
+            archive.add(filename, arcname=relpath, recursive=False)
+            raw_bytes += os.lstat(filename).st_size
+
+        if deleted:
+            deleted_filename = archive_filename + ".deleted"
+            with open(deleted_filename, 'wb') as f:
+                f.write("\0".join(deleted))
+            archive.add(deleted_filename, arcname=DELETED_FILENAME)
+            os.remove(deleted_filename)
+    return raw_bytes
+
+
+def remote_check_command(remote_dir, digest):
+    """
+    Returns the shell command that clears the output of previous runs in remote_dir, and fails unless
+    the workspace there was last synced with the manifest of the given digest.
+    """
+    return "cd %s && rm -rf output && test \"$(cat %s)\" = %s" % (quote(remote_dir), MANIFEST_DIGEST_FILENAME,
+                                                                quote(digest or "none"))
+
+
+def remote_extract_command(remote_dir, digest):
+    """
+    Returns the shell command that extracts an archive written by write_sync_archive() from its stdin
+    into remote_dir, and records the digest of the manifest it was made for.
+    """
+    return ("mkdir -p %(dir)s && cd %(dir)s && rm -rf output && rm -f %(digest_file)s && tar -xzpf - && "
+            "if [ -f %(deleted)s ]; then xargs -0 rm -f < %(deleted)s && rm -f %(deleted)s; fi && "
+            "echo %(digest)s > %(digest_file)s") % {'dir': quote(remote_dir),
+                                                    'deleted': DELETED_FILENAME,
+                                                    'digest': quote(digest),
+                                                    'digest_file': MANIFEST_DIGEST_FILENAME}
+
+#
+# workspacesync.py ends here
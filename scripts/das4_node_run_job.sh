@@ -60,6 +60,15 @@ rm -fR "$OUTPUT_DIR"
 mkdir -p "$OUTPUT_DIR"
 cd "$OUTPUT_DIR"
 
+# @CONF_OPTION SYNC_USE_RELAY: Run a sync relay on each node so the experiment server only gets one connection per node. (default is false)
+if [ "${SYNC_USE_RELAY,,}" == "true" ]; then
+    echo "Starting the sync relay for the $PROCESSES_IN_THIS_NODE local instances"
+    experiment_relay.py > sync_relay.log 2>&1 &
+    # Make the local instances connect to the relay instead of the experiment server
+    export SYNC_PORT=${SYNC_RELAY_PORT:-$SYNC_PORT}
+    export SYNC_HOST=localhost
+fi
+
 CMDFILE=$(mktemp --tmpdir=/local/$USER/ process_guard_XXXXXXXXXXXXX_$USER)
 
 # @CONF_OPTION DAS4_NODE_COMMAND: The command that will be repeatedly launched in the worker nodes of the cluster. (required)
@@ -67,13 +76,28 @@ for INSTANCE in $(seq 1 1 $PROCESSES_IN_THIS_NODE); do
     echo "$DAS4_NODE_COMMAND" >> $CMDFILE
 done
 
+# @CONF_OPTION OUTPUT_SHIP_INTERVAL: Seconds between shipments of the new output data to the head node while the experiment runs, 0 sends it all at the end with rsync. (default is 30)
+OUTPUT_SHIP_INTERVAL=${OUTPUT_SHIP_INTERVAL:-30}
+if [ "$OUTPUT_SHIP_INTERVAL" != "0" ]; then
+    # Only the bytes appended since the previous shipment are sent, so the last one is small
+    ship_output.py push --interval $OUTPUT_SHIP_INTERVAL --exclude sqlite "$OUTPUT_DIR" "$OUTPUT_DIR_URI/$(hostname)" \
+        > ship_output.log 2>&1 &
+    SHIP_OUTPUT_PID=$!
+fi
+
 # @CONF_OPTION DAS4_NODE_TIMEOUT: Time in seconds to wait for the sub-processes to run before killing them. (required)
 (process_guard.py -f $CMDFILE -t $DAS4_NODE_TIMEOUT -o $OUTPUT_DIR -m $OUTPUT_DIR  -i 5 2>&1 | tee process_guard.log) ||:
 
 rm $CMDFILE
 
 # Now, lets send the generated data back to the head node
-rsync -a --delete-before --exclude="sqlite/" "$OUTPUT_DIR/" "$OUTPUT_DIR_URI/$(hostname)/" 2>&1
+if [ -n "$SHIP_OUTPUT_PID" ]; then
+    # Makes it ship the last deltas and exit
+    kill -TERM $SHIP_OUTPUT_PID
+    wait $SHIP_OUTPUT_PID
+else
+    rsync -a --delete-before --exclude="sqlite/" "$OUTPUT_DIR/" "$OUTPUT_DIR_URI/$(hostname)/" 2>&1
+fi
 
 #
 # das4_node_run_job.sh ends here
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# experiment_relay.py ---
+#
+# Filename: experiment_relay.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sat Oct 17 11:02:13 2026 (+0200)
+
+# Commentary:
+#
+# Node local experiment sync relay.
+#
+# Accepts the connections of all the experiment instances running on this node and talks to the experiment server
+# on behalf of them using a single connection, see gumby/sync.py for the details.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+from os import environ
+
+from gumby.sync import ExperimentRelayFactory, ExperimentRelayClientFactory
+from gumby.log import setupLogging
+
+from twisted.internet import reactor
+
+# @CONF_OPTION SYNC_RELAY_PORT: Port where the sync relay of each node should listen on. (default is SYNC_PORT)
+# @CONF_OPTION SYNC_RELAY_SUBSCRIBERS_AMOUNT: Number of local instances the relay should wait for. (default is PROCESSES_IN_THIS_NODE)
+# @CONF_OPTION SYNC_PEER_TABLE_DIR: Where the relay should write the node-local peer table. (default is the system temp dir)
+
+if __name__ == '__main__':
+    setupLogging()
+    if 'SYNC_RELAY_SUBSCRIBERS_AMOUNT' in environ:
+        expected_subscribers = int(environ['SYNC_RELAY_SUBSCRIBERS_AMOUNT'])
+    else:
+        expected_subscribers = int(environ['PROCESSES_IN_THIS_NODE'])
+
+    relay_port = int(environ.get('SYNC_RELAY_PORT', environ['SYNC_PORT']))
+
+    relay = ExperimentRelayFactory(expected_subscribers, environ.get('SYNC_PEER_TABLE_DIR'))
+
+    reactor.exitCode = 0
+    reactor.listenTCP(relay_port, relay)
+    reactor.connectTCP(environ['SYNC_HOST'], int(environ['SYNC_PORT']), ExperimentRelayClientFactory(relay))
+    reactor.run()
+    exit(reactor.exitCode)
+
+#
+# experiment_relay.py ends here
@@ -59,7 +59,7 @@
 
 # Code:
 
-from os import environ
+from os import environ, path
 
 from gumby.sync import ExperimentServiceFactory
 from gumby.log import setupLogging
@@ -70,6 +70,11 @@ from twisted.internet import reactor
 # @CONF_OPTION SYNC_EXPERIMENT_START_DELAY: Delay the synchronized start of the experiment by this amount of seconds when giving the start signal.
 # @CONF_OPTION SYNC_EXPERIMENT_START_DELAY: The default value should be OK for a few thousand instances. (float, default 5)
 # @CONF_OPTION SYNC_PORT: Port where we should listen on. (required)
+# @CONF_OPTION SYNC_ADMISSION_RATE: Max amount of new connections per second the server will accept, the rest are told when to retry. (float, default 200, 0 disables it)
+# @CONF_OPTION SYNC_ADMISSION_BACKLOG: Amount of connections the server will accept in a burst, also used as the listen backlog. (default 200)
+# @CONF_OPTION SYNC_METRICS_FILE: File where the timing of each phase of the experiment set up is written to as JSON. (default is OUTPUT_DIR/sync_metrics.json)
+# @CONF_OPTION SYNC_ABORT_LOST_FRACTION: Abort the experiment when more than this fraction of the instances sending heartbeats (see SYNC_HEARTBEAT_INTERVAL) are lost. (float, default is to never abort)
+# @CONF_OPTION SYNC_ABORT_GRACE_PERIOD: Seconds the lost instances have to come back before aborting the experiment. (float, default 60)
 
 if __name__ == '__main__':
     setupLogging()
@@ -80,9 +85,20 @@ if __name__ == '__main__':
 
     experiment_start_delay = float(environ.get('SYNC_EXPERIMENT_START_DELAY', 5))
     server_port = int(environ['SYNC_PORT'])
+    admission_rate = float(environ.get('SYNC_ADMISSION_RATE', 200))
+    admission_backlog = int(environ.get('SYNC_ADMISSION_BACKLOG', 200))
+    metrics_file = environ.get('SYNC_METRICS_FILE')
+    if not metrics_file and 'OUTPUT_DIR' in environ:
+        metrics_file = path.join(environ['OUTPUT_DIR'], 'sync_metrics.json')
+    abort_lost_fraction = float(environ['SYNC_ABORT_LOST_FRACTION']) if environ.get('SYNC_ABORT_LOST_FRACTION') else None
+    abort_grace_period = float(environ.get('SYNC_ABORT_GRACE_PERIOD', 60))
 
     reactor.exitCode = 0
-    reactor.listenTCP(server_port, ExperimentServiceFactory(expected_subscribers, experiment_start_delay))
+    reactor.listenTCP(server_port,
+                      ExperimentServiceFactory(expected_subscribers, experiment_start_delay,
+                                               admission_rate, admission_backlog, metrics_file,
+                                               abort_lost_fraction, abort_grace_period),
+                      backlog=admission_backlog)
     reactor.run()
     exit(reactor.exitCode)
 
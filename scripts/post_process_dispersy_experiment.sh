@@ -79,6 +79,9 @@ rm $TEMPFILE
 #Step 3: Extract the resource usage data from the process_guard logs.
 extract_process_guard_stats.py . . $XSTART > /dev/null
 
+#Step 3b: Summarize the scenario action traces, if the peers wrote them (see SCENARIO_TRACE).
+summarize_scenario_traces.py . scenario_trace_summary.json
+
 #Step 4: Reduce the data
 reduce_dispersy_statistics.py . 300
 
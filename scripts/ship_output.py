@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# ship_output.py ---
+#
+# Filename: ship_output.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 17:24:51 2026 (+0200)
+
+# Commentary:
+#
+# Incremental shipping of experiment output directories.
+#
+# The output of the instances is mostly logs that only grow, so instead of copying whole files this
+# only transfers the bytes appended since the previous run. The receiving end tells the sending one
+# where to resume every file from: the size of its copy, along with the digest of the last bytes of
+# it. A file whose copy doesn't match anymore (it was rewritten instead of appended to) is sent again
+# from the start. The deltas are written at their absolute offsets, so an interrupted run is simply
+# resumed by the next one.
+#
+# Commands:
+# * push SRC DEST: sends the deltas of SRC to DEST (a directory or host:directory). With --interval
+#   it ships every INTERVAL seconds, and one last time when it gets a SIGTERM.
+# * pull HOST:SRC DEST: fetches the deltas of SRC on HOST into DEST, --interval works as for push.
+# * send SRC / receive DEST: the remote ends of pull and push, they talk through stdin/stdout.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+import os
+import signal
+import sys
+from fnmatch import fnmatch
+from hashlib import sha1
+from pipes import quote
+from subprocess import PIPE, Popen
+from time import sleep, time
+
+# Amount of bytes before an offset that have to match for a file to be continued from it
+TAIL_SIZE = 4096
+
+_BLOCK_SIZE = 1 << 16
+
+
+def _excluded(name, excludes):
+    return any(fnmatch(name, pattern) for pattern in excludes)
+
+
+def _walk(root, excludes):
+    """
+    Yields the relative path and size of every regular file in root.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not _excluded(name, excludes)]
+        for name in filenames:
+            if _excluded(name, excludes):
+                continue
+            filename = os.path.join(dirpath, name)
+            if os.path.isfile(filename) and not os.path.islink(filename):
+                yield os.path.relpath(filename, root), os.path.getsize(filename)
+
+
+def tail_digest(filename, offset):
+    """
+    Returns the digest of the TAIL_SIZE bytes of filename before offset.
+    """
+    start = max(offset - TAIL_SIZE, 0)
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        return sha1(f.read(offset - start)).hexdigest()
+
+
+def read_offsets(inp):
+    # json gives back unicode, while os.walk gives the paths as str
+    return dict((relpath.encode('utf-8'), offset) for relpath, offset in json.loads(inp.readline() or "{}").iteritems())
+
+
+def directory_offsets(root, excludes):
+    """
+    Returns the offsets (relative path -> [size, tail digest]) of the files in root.
+    """
+    return dict((relpath, [size, tail_digest(os.path.join(root, relpath), size)])
+                for relpath, size in _walk(root, excludes))
+
+
+def find_deltas(root, offsets, excludes):
+    """
+    Returns the (relative path, offset, length) of the bytes of the files in root that aren't covered
+    by offsets. Files that don't match their offset anymore are sent from the start.
+    """
+    deltas = []
+    for relpath, size in _walk(root, excludes):
+        if relpath not in offsets:
+            deltas.append((relpath, 0, size))
+            continue
+
+        offset, digest = offsets[relpath]
+        if size < offset or tail_digest(os.path.join(root, relpath), offset) != digest:
+            deltas.append((relpath, 0, size))
+        elif size > offset:
+            deltas.append((relpath, offset, size - offset))
+    return deltas
+
+
+def write_deltas(root, deltas, out):
+    """
+    Writes the deltas to out: a json header line [relative path, offset, length] followed by the bytes
+    of every delta, and a null line at the end.
+    """
+    for relpath, offset, length in deltas:
+        out.write(json.dumps([relpath, offset, length]) + "\n")
+        with open(os.path.join(root, relpath), 'rb') as f:
+            f.seek(offset)
+            left = length
+            while left:
+                block = f.read(min(left, _BLOCK_SIZE))
+                if not block:
+                    raise IOError("%s was truncated while being shipped" % relpath)
+                out.write(block)
+                left -= len(block)
+    out.write("null\n")
+    out.flush()
+
+
+def apply_deltas(inp, root):
+    """
+    Writes the deltas read from inp to the files in root, returns the amount of deltas and bytes.
+    """
+    count = received = 0
+    while True:
+        header = json.loads(inp.readline() or '"eof"')
+        if header is None:
+            return count, received
+        if header == "eof":
+            raise IOError("Delta stream ended unexpectedly")
+
+        relpath, offset, length = header
+        relpath = relpath.encode('utf-8')
+        filename = os.path.join(root, relpath)
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(filename, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            left = length
+            while left:
+                block = inp.read(min(left, _BLOCK_SIZE))
+                if not block:
+                    raise IOError("Delta stream ended unexpectedly")
+                f.write(block)
+                left -= len(block)
+            f.truncate()
+        count += 1
+        received += length
+
+
+def _remote_command(host, python, script, *args):
+    return ["ssh", host, " ".join([python, quote(script)] + [quote(arg) for arg in args])]
+
+
+def _exclude_args(excludes):
+    return sum((["--exclude", pattern] for pattern in excludes), [])
+
+
+def push(src, dest, options):
+    if ':' in dest:
+        host, directory = dest.split(':', 1)
+        command = _remote_command(host, options.remote_python, options.remote_script, "receive", directory,
+                                  *_exclude_args(options.excludes))
+    else:
+        command = [sys.executable, os.path.abspath(__file__), "receive", dest] + _exclude_args(options.excludes)
+
+    receiver = Popen(command, stdin=PIPE, stdout=PIPE)
+    try:
+        deltas = find_deltas(src, read_offsets(receiver.stdout), options.excludes)
+        write_deltas(src, deltas, receiver.stdin)
+    finally:
+        receiver.stdin.close()
+        receiver.stdout.close()
+    if receiver.wait():
+        raise IOError("Receiving the deltas on %s failed with exit code %d" % (dest, receiver.returncode))
+    return len(deltas), sum(length for _, _, length in deltas)
+
+
+def pull(src, dest, options):
+    host, directory = src.split(':', 1)
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+
+    sender = Popen(_remote_command(host, options.remote_python, options.remote_script, "send", directory,
+                                   *_exclude_args(options.excludes)),
+                   stdin=PIPE, stdout=PIPE)
+    try:
+        sender.stdin.write(json.dumps(directory_offsets(dest, options.excludes)) + "\n")
+        sender.stdin.close()
+        result = apply_deltas(sender.stdout, dest)
+    finally:
+        sender.stdout.close()
+    if sender.wait():
+        raise IOError("Sending the deltas from %s failed with exit code %d" % (src, sender.returncode))
+    return result
+
+
+def send(src, options):
+    offsets = read_offsets(sys.stdin)
+    if not os.path.isdir(src):
+        # Nothing has been written yet
+        sys.stdout.write("null\n")
+        return
+    write_deltas(src, find_deltas(src, offsets, options.excludes), sys.stdout)
+
+
+def receive(dest, options):
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    sys.stdout.write(json.dumps(directory_offsets(dest, options.excludes)) + "\n")
+    sys.stdout.flush()
+    apply_deltas(sys.stdin, dest)
+
+
+def ship(ship_function, src, dest, options):
+    start = time()
+    count, shipped = ship_function(src, dest, options)
+    if count:
+        print "Shipped %d deltas (%.2f MB) from %s to %s in %.2f seconds" % (count, shipped / 1048576.0, src, dest,
+                                                                             time() - start)
+
+
+def ship_every(ship_function, src, dest, options):
+    """
+    Ships every options.interval seconds until a SIGTERM is received, and then one last time.
+    """
+    terminated = []
+    signal.signal(signal.SIGTERM, lambda *_: terminated.append(True))
+
+    while not terminated:
+        try:
+            ship(ship_function, src, dest, options)
+        except (IOError, OSError) as e:
+            print >> sys.stderr, "Shipping %s to %s failed, retrying later: %s" % (src, dest, e)
+        deadline = time() + options.interval
+        while not terminated and time() < deadline:
+            sleep(min(1, options.interval))
+    ship(ship_function, src, dest, options)
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog push SRC DEST | pull HOST:SRC DEST | send SRC | receive DEST")
+    parser.add_option("-e", "--exclude",
+                      metavar='PATTERN',
+                      action="append",
+                      dest="excludes",
+                      default=[],
+                      help="Don't ship the files or directories whose name matches PATTERN (can be specified multiple times)."
+                      )
+    parser.add_option("-i", "--interval",
+                      metavar='SECONDS',
+                      default=0,
+                      type=float,
+                      help="Keep shipping every SECONDS seconds until terminated (push and pull)."
+                      )
+    parser.add_option("--remote-python",
+                      metavar='PYTHON',
+                      default="python",
+                      help="Python interpreter to run the remote end with."
+                      )
+    parser.add_option("--remote-script",
+                      metavar='PATH',
+                      default=os.path.abspath(__file__),
+                      help="Path of this script on the remote host (default is the same path as here)."
+                      )
+    (options, args) = parser.parse_args()
+
+    commands = {'push': (push, 3), 'pull': (pull, 3), 'send': (send, 2), 'receive': (receive, 2)}
+    if not args or args[0] not in commands or len(args) != commands[args[0]][1]:
+        parser.error("Unknown command or wrong amount of arguments.")
+
+    ship_function = commands[args[0]][0]
+    if ship_function in (send, receive):
+        ship_function(args[1], options)
+    elif options.interval:
+        ship_every(ship_function, args[1], args[2], options)
+    else:
+        ship(ship_function, args[1], args[2], options)
+
+#
+# ship_output.py ends here
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# summarize_scenario_traces.py ---
+#
+# Filename: summarize_scenario_traces.py
+# Description:
+# Author:
+# Maintainer:
+# Created: Sun Oct 18 11:02:18 2026 (+0200)
+
+# Commentary:
+#
+# Merges the scenario traces of all the peers found in a dir into the lag and duration percentiles
+# of every scenario callable (see gumby/scenariotrace.py), prints them and optionally writes them
+# as a JSON document.
+#
+
+# Change Log:
+#
+#
+#
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+#
+
+# Code:
+
+import json
+import os
+import sys
+
+from gumby.scenariotrace import TRACE_FILENAME, summarize_traces
+
+
+def find_traces(input_directory):
+    for dirpath, _, filenames in os.walk(input_directory):
+        if TRACE_FILENAME in filenames:
+            yield os.path.join(dirpath, TRACE_FILENAME)
+
+
+def main(input_directory, output_file=None):
+    filenames = list(find_traces(input_directory))
+    if not filenames:
+        print "No scenario traces found in", input_directory
+        return
+
+    summary = summarize_traces(filenames)
+
+    print "Scenario actions of %d peers (lag and duration in secs):" % len(filenames)
+    print "%-30s %9s %7s %8s %8s %8s %8s %10s %10s" % ("callable", "actions", "errors", "lag p50", "lag p90",
+                                                       "lag p99", "lag max", "dur mean", "dur max")
+    for name, stats in sorted(summary.iteritems(), key=lambda item: item[1]['lag']['p99'], reverse=True):
+        print "%-30s %9d %7d %8.3f %8.3f %8.3f %8.3f %10.6f %10.6f" % (
+            name, stats['actions'], stats['errors'], stats['lag']['median'], stats['lag']['p90'],
+            stats['lag']['p99'], stats['lag']['max'], stats['duration']['mean'], stats['duration']['max'])
+
+    if output_file:
+        with open(output_file, 'w') as f:
+            json.dump({'peers': len(filenames), 'callables': summary}, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print "Usage: %s <output-directory> [<summary.json>]" % (sys.argv[0])
+        print >> sys.stderr, sys.argv
+
+        exit(1)
+
+    main(*sys.argv[1:])
+
+#
+# summarize_scenario_traces.py ends here